@@ -0,0 +1,96 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Compare combine_licenses() with simplify() of the combined expression
+
+Run it from the top source directory as:
+
+    python -m benchmark.bench_license
+"""
+
+import argparse
+import random
+import time
+import typing
+
+from pycargoebuild.license import (
+    combine_licenses,
+    get_spdx_licensing,
+    parse_license,
+)
+
+SYMBOLS = [
+    "0BSD", "Apache-2.0", "Apache-2.0 WITH LLVM-exception", "BSD-2-Clause",
+    "BSD-3-Clause", "BSL-1.0", "CC0-1.0", "ISC", "MIT", "MPL-2.0",
+    "Unicode-3.0", "Unicode-DFS-2016", "Unlicense", "Zlib",
+]
+
+
+def get_crate_licenses(crates: int, seed: int) -> typing.List[str]:
+    """Get synthetic license strings for a lockfile with crates"""
+    rng = random.Random(seed)
+    licenses = []
+    for _ in range(crates):
+        choice = rng.random()
+        if choice < 0.5:
+            # the usual suspects
+            licenses.append(rng.choice(["MIT", "MIT OR Apache-2.0",
+                                        "Apache-2.0 OR MIT"]))
+        elif choice < 0.9:
+            licenses.append(" OR ".join(rng.sample(SYMBOLS,
+                                                   rng.randint(2, 5))))
+        else:
+            licenses.append(
+                f"({' OR '.join(rng.sample(SYMBOLS, rng.randint(2, 3)))}) "
+                f"AND {rng.choice(SYMBOLS)}")
+    return licenses
+
+
+def combine_using_simplify(licenses: typing.Set[str]) -> str:
+    combined = " AND ".join(f"( {x} )" for x in licenses)
+    return str(get_spdx_licensing().parse(combined, strict=True).simplify())
+
+
+def combine_using_combiner(licenses: typing.Set[str]) -> str:
+    parse_license.cache_clear()
+    return str(combine_licenses(parse_license(x) for x in licenses))
+
+
+def main() -> None:
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument("--crates", type=int, default=2000,
+                      help="Number of crates (default: 2000)")
+    argp.add_argument("--repeat", type=int, default=5,
+                      help="Number of repetitions (default: 5)")
+    argp.add_argument("--seed", type=int, default=0,
+                      help="Random seed (default: 0)")
+    args = argp.parse_args()
+
+    licenses = set(get_crate_licenses(args.crates, args.seed))
+    # load the licensing outside the timed part
+    get_spdx_licensing()
+    print(f"{args.crates} crates, {len(licenses)} distinct license strings")
+
+    outputs = {}
+    best_times = {}
+    for func in (combine_using_simplify, combine_using_combiner):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            outputs[func] = func(licenses)
+            times.append(time.perf_counter() - start)
+        best_times[func] = min(times)
+        print(f"{func.__name__:>24}: {best_times[func] * 1000:10.2f} ms "
+              f"(best of {args.repeat})")
+
+    assert (outputs[combine_using_simplify] ==
+            outputs[combine_using_combiner]), "results differ"
+    speedup = (best_times[combine_using_simplify] /
+               best_times[combine_using_combiner])
+    print(f"{'speedup':>24}: {speedup:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Benchmark the processing pipeline on synthetic workspaces
+
+For every size, a Cargo.lock file is generated along with matching fake
+.crate tarballs (and git archives for a fraction of crates) in a temporary
+directory.  The results are written as JSON, to permit tracking them
+over time.
+
+Run it from the top source directory as:
+
+    python -m benchmark.bench_pipeline
+"""
+
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tarfile
+import tempfile
+import time
+import typing
+from pathlib import Path
+
+from pycargoebuild import __version__
+from pycargoebuild.__main__ import repack_crates
+from pycargoebuild.cargo import (
+    CRATE_REGISTRY,
+    Crate,
+    PackageMetadata,
+    get_crates,
+)
+from pycargoebuild.ebuild import get_crate_LICENSE, update_ebuild
+from pycargoebuild.fetch import verify_crates
+from pycargoebuild.format import format_license_var
+from pycargoebuild.license import (
+    MAPPING,
+    combine_licenses,
+    parse_license,
+    spdx_to_ebuild,
+)
+
+DEFAULT_SIZES = "100,1000,10000"
+
+LICENSES = [
+    "MIT", "MIT OR Apache-2.0", "Apache-2.0 OR MIT", "Apache-2.0",
+    "BSD-3-Clause", "ISC", "MIT OR Unlicense", "Unlicense OR MIT",
+    "Zlib OR Apache-2.0 OR MIT", "Apache-2.0 WITH LLVM-exception",
+    "(MIT OR Apache-2.0) AND Unicode-DFS-2016", "MPL-2.0", "0BSD",
+    "BSL-1.0", "CC0-1.0",
+]
+
+PKG_META = PackageMetadata(name="bench", version="1.0.0")
+
+EBUILD_TEMPLATE = """\
+EAPI=8
+
+CRATES="
+"
+
+inherit cargo
+
+# Dependent crate licenses
+LICENSE+=""
+"""
+
+
+def add_file(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(data)
+    tar_info.mode = 0o644
+    tar.addfile(tar_info, io.BytesIO(data))
+
+
+def get_cargo_toml(name: str, version: str, license_str: str) -> bytes:
+    return (f'[package]\nname = "{name}"\nversion = "{version}"\n'
+            f'license = "{license_str}"\n').encode()
+
+
+def get_commit(repo: str) -> str:
+    return hashlib.sha1(repo.encode()).hexdigest()
+
+
+def make_workspace(directory: Path,
+                   crates: int,
+                   *,
+                   git_fraction: float,
+                   seed: int,
+                   ) -> Path:
+    """
+    Create a synthetic workspace with specified number of crates
+
+    Returns the path to the distdir.
+    """
+
+    rng = random.Random(seed)
+    distdir = directory / "distdir"
+    distdir.mkdir()
+    packages = ['[[package]]\nname = "bench"\nversion = "1.0.0"\n']
+    # repository name -> list of (name, version, license)
+    git_repos: typing.Dict[str, typing.List[typing.Tuple[str, str, str]]] = {}
+
+    for i in range(crates):
+        name = f"crate-{i}"
+        version = f"{rng.randint(0, 9)}.{rng.randint(0, 99)}.0"
+        license_str = rng.choice(LICENSES)
+        if rng.random() < git_fraction:
+            # group git crates into repositories of up to 5 crates
+            repo = f"repo-{i // 5}"
+            commit = get_commit(repo)
+            git_repos.setdefault(repo, []).append(
+                (name, version, license_str))
+            packages.append(
+                f'[[package]]\nname = "{name}"\nversion = "{version}"\n'
+                f'source = "git+https://github.com/bench/{repo}#{commit}"\n')
+            continue
+
+        path = distdir / f"{name}-{version}.crate"
+        with tarfile.open(path, "w:gz") as tar:
+            add_file(tar, f"{name}-{version}/Cargo.toml",
+                     get_cargo_toml(name, version, license_str))
+            add_file(tar, f"{name}-{version}/src/lib.rs",
+                     rng.randbytes(rng.randint(100, 20000)))
+        checksum = hashlib.sha256(path.read_bytes()).hexdigest()
+        packages.append(
+            f'[[package]]\nname = "{name}"\nversion = "{version}"\n'
+            f'source = "{CRATE_REGISTRY}"\nchecksum = "{checksum}"\n')
+
+    for repo, repo_crates in git_repos.items():
+        commit = get_commit(repo)
+        with tarfile.open(distdir / f"{repo}-{commit}.gh.tar.gz",
+                          "w:gz") as tar:
+            for name, version, license_str in repo_crates:
+                add_file(tar, f"{repo}-{commit}/{name}/Cargo.toml",
+                         get_cargo_toml(name, version, license_str))
+                add_file(tar, f"{repo}-{commit}/{name}/src/lib.rs",
+                         b"// empty\n")
+
+    (directory / "Cargo.lock").write_text(
+        "version = 3\n\n" + "\n".join(packages))
+    (directory / "test.ebuild").write_text(EBUILD_TEMPLATE)
+    return distdir
+
+
+class Result(typing.NamedTuple):
+    crates: int
+    benchmark: str
+    times: typing.List[float]
+
+
+def run_benchmarks(directory: Path,
+                   distdir: Path,
+                   size: int,
+                   *,
+                   repeat: int,
+                   jobs: int,
+                   ) -> typing.List[Result]:
+    def bench(name: str, func: typing.Callable[[], typing.Any]) -> typing.Any:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            ret = func()
+            times.append(time.perf_counter() - start)
+        results.append(Result(crates=size, benchmark=name, times=times))
+        print(f"{size:>6} {name:>24}: {min(times) * 1000:10.2f} ms",
+              file=sys.stderr)
+        return ret
+
+    def read_crates() -> typing.FrozenSet[Crate]:
+        with open(directory / "Cargo.lock", "rb") as f:
+            return frozenset(get_crates(f))
+
+    def repack() -> None:
+        with open(os.devnull, "wb") as f:
+            with tarfile.open(fileobj=f, mode="w|",
+                              format=tarfile.GNU_FORMAT,
+                              encoding="UTF-8") as tar_out:
+                repack_crates(tar_out, crates, distdir, prefix="cargo_home",
+                              jobs=jobs)
+
+    results: typing.List[Result] = []
+    crates = bench("get_crates", read_crates)
+    bench("verify_crates",
+          lambda: verify_crates(crates, distdir=distdir, jobs=jobs))
+    bench("get_crate_LICENSE",
+          lambda: get_crate_LICENSE(crates, distdir, jobs=jobs))
+    combined_license = combine_licenses(parse_license(x) for x in LICENSES)
+    assert combined_license is not None
+    license_str = spdx_to_ebuild(combined_license)
+    bench("format_license_var",
+          lambda: format_license_var(license_str, prefix='LICENSE+=" '))
+    ebuild = (directory / "test.ebuild").read_text()
+    bench("update_ebuild",
+          lambda: update_ebuild(ebuild, PKG_META, crates, distdir,
+                                jobs=jobs))
+    bench("repack_crates", repack)
+    return results
+
+
+def main() -> int:
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument("--sizes", default=DEFAULT_SIZES,
+                      help="Comma-separated list of crate counts "
+                           f"(default: {DEFAULT_SIZES})")
+    argp.add_argument("--git-fraction", type=float, default=0.05,
+                      help="Fraction of git crates (default: 0.05)")
+    argp.add_argument("-j", "--jobs", type=int, default=1,
+                      help="Number of parallel jobs (default: 1)")
+    argp.add_argument("--repeat", type=int, default=3,
+                      help="Number of repetitions (default: 3)")
+    argp.add_argument("--seed", type=int, default=0,
+                      help="Random seed (default: 0)")
+    argp.add_argument("-o", "--output", type=argparse.FileType("w"),
+                      default=sys.stdout,
+                      help="File to write JSON results to (default: stdout)")
+    args = argp.parse_args()
+
+    # map all licenses to themselves
+    for license_str in LICENSES:
+        parsed = parse_license(license_str)
+        assert parsed is not None
+        for symbol in parsed.symbols:
+            MAPPING[str(symbol).lower()] = str(symbol)
+
+    results: typing.List[Result] = []
+    for size in (int(x) for x in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as tempdir:
+            print(f"Generating {size} crates ...", file=sys.stderr)
+            distdir = make_workspace(Path(tempdir), size,
+                                     git_fraction=args.git_fraction,
+                                     seed=args.seed)
+            results.extend(run_benchmarks(Path(tempdir), distdir, size,
+                                          repeat=args.repeat,
+                                          jobs=args.jobs))
+
+    json.dump({
+        "pycargoebuild": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.now(
+            tz=datetime.timezone.utc).isoformat(),
+        "jobs": args.jobs,
+        "repeat": args.repeat,
+        "results": [
+            {**result._asdict(), "best": min(result.times)}
+            for result in results
+        ],
+    }, args.output, indent=2)
+    args.output.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,4 +4,9 @@
 
 """A generator for Rust/Cargo ebuilds written in Python"""
 
+import time
+
 __version__ = "0.15.0"
+
+# used to measure the import time for --startup-profile
+IMPORT_START_TIME = time.perf_counter()
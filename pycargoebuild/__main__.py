@@ -7,13 +7,13 @@ import datetime
 import io
 import json
 import logging
-import lzma
 import os.path
 import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
+import time
 import typing
 from pathlib import Path, PurePosixPath
 
@@ -22,18 +22,54 @@ if sys.version_info >= (3, 11):
 else:
     import tomli as tomllib
 
+from pycargoebuild import IMPORT_START_TIME
+from pycargoebuild.batch import BatchManifestError, load_batch_manifest
+from pycargoebuild.cache import (
+    DEFAULT_MAX_ENTRIES,
+    FileStat,
+    LicenseMappingCache,
+    MetadataCache,
+    PortageConfigCache,
+    PortagePaths,
+    VerificationCache,
+    get_cache_dir,
+    get_portage_config_key,
+)
 from pycargoebuild.cargo import (
     Crate,
     FileCrate,
+    PackageMetadata,
     WorkspaceCargoTomlError,
     get_crates,
     get_package_metadata,
+    iter_tarball_members,
+    read_tarball_members,
+)
+from pycargoebuild.compress import (
+    DEFAULT_XZ_PRESET,
+    DEFAULT_ZSTD_LEVEL,
+    CompressionError,
+    check_preset,
+    get_compression,
+    open_compressed_writer,
+)
+from pycargoebuild.ebuild import (
+    get_ebuild,
+    get_ebuild_CRATES,
+    get_unchanged_crates,
+    update_ebuild,
 )
-from pycargoebuild.ebuild import get_ebuild, update_ebuild
 from pycargoebuild.fetch import (
     ChecksumMismatchError,
+    FetchError,
+    MultipleChecksumMismatchError,
+    MultipleFetchError,
+    check_crates_in_distdir,
     fetch_crates_using_aria2,
+    fetch_crates_using_native,
     fetch_crates_using_wget,
+    get_mirrors,
+    import_crates_from_cargo_cache,
     verify_crates,
 )
 from pycargoebuild.license import (
@@ -41,8 +77,11 @@ from pycargoebuild.license import (
     UnmatchedLicense,
     load_license_mapping,
 )
+from pycargoebuild.metrics import METRICS
+from pycargoebuild.parallel import imap_ordered
+from pycargoebuild.store import CrateStore
 
-FETCHERS = ("aria2", "wget")
+FETCHERS = ("aria2", "wget", "native")
 
 
 class WorkspaceData(typing.NamedTuple):
@@ -50,69 +89,159 @@ class WorkspaceData(typing.NamedTuple):
     workspace_metadata: dict
 
 
-def main(prog_name: str, *argv: str) -> int:
-    argp = argparse.ArgumentParser(prog=os.path.basename(prog_name))
-    argp.add_argument("-c", "--crate-tarball",
-                      action="store_true",
-                      help="Pack fetched crates into a tarball rather than "
-                           "adding them to the CRATES variable")
-    argp.add_argument("-e", "--features",
-                      action="store_true",
-                      help="Add USE flags for Cargo features")
-    argp.add_argument("--crate-tarball-path",
-                      default="{distdir}/{name}-{version}-crates.tar.xz",
-                      help="Path to write crate tarball to (default: "
-                           "{distdir}/{name}-{version}-crates.tar.xz)")
-    argp.add_argument("--crate-tarball-prefix",
-                      default="cargo_home/gentoo",
-                      help="Prefix prepended for all paths in the crate "
-                           "tarball (default: cargo_home/gentoo)")
-    argp.add_argument("--no-write-crate-tarball",
-                      action="store_true",
-                      help="Do not create the crate tarball, just write "
-                           "the ebuild assuming it exists")
-    argp.add_argument("-d", "--distdir",
-                      type=Path,
-                      help="Directory to store downloaded crates in "
-                           "(default: get from Portage)")
-    argp.add_argument("-f", "--force",
-                      action="store_true",
-                      help="Force overwriting the output file")
-    argp.add_argument("-F", "--fetcher",
-                      choices=("auto",) + FETCHERS,
-                      default="auto",
-                      help="Fetcher to use (one of: auto [default], "
-                           f"{', '.join(FETCHERS)})")
-    argp.add_argument("-i", "--input", "--inplace",
-                      type=argparse.FileType("r", encoding="utf-8"),
-                      metavar="INPUT",
-                      help="Update the CRATES and LICENSE variables "
-                           "in the specified ebuild instead of creating "
-                           "one from scratch")
-    argp.add_argument("-l", "--license-mapping",
-                      type=argparse.FileType("r", encoding="utf-8"),
-                      help="Path to license-mapping.conf file (default: "
-                           "get from Portage)")
-    argp.add_argument("-L", "--no-license",
-                      action="store_true",
-                      help="Do not include LICENSEs (e.g. when crates are "
-                           "only used at build time")
-    argp.add_argument("-M", "--no-manifest",
-                      action="store_true",
-                      help="Do not call `pkgdev manifest` (called only if "
-                           "Manifest exists)")
-    argp.add_argument("-o", "--output",
-                      help="Ebuild file to write (default: INPUT if --input "
-                           "is specified, {name}-{version}.ebuild otherwise)")
-    argp.add_argument("--no-config",
-                      action="store_true",
-                      help="Inhibit loading configuration files")
-    argp.add_argument("directory",
-                      type=Path,
-                      default=[Path(".")],
-                      nargs="*",
-                      help="Directory containing Cargo.* files (default: .)")
-    args = argp.parse_args(argv)
+class PackageData(typing.NamedTuple):
+    args: argparse.Namespace
+    crates: typing.FrozenSet[Crate]
+    pkg_meta: PackageMetadata
+    outfile: Path
+    # crates listed in the input ebuild already (in incremental mode)
+    unchanged_crates: typing.FrozenSet[FileCrate] = frozenset()
+
+
+class StartupProfile:
+    """Record the time spent in subsequent startup phases"""
+
+    def __init__(self, start_time: float) -> None:
+        self.last_time = start_time
+        self.phases: typing.List[typing.Tuple[str, float]] = []
+
+    def mark(self, phase: str) -> None:
+        """Mark the end of phase, that started at the end of the previous"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last_time))
+        self.last_time = now
+
+    def report(self) -> None:
+        for phase, duration in self.phases:
+            logging.info(f"{phase:>20}: {duration * 1000:8.1f} ms")
+        total = sum(duration for phase, duration in self.phases)
+        logging.info(f"{'total':>20}: {total * 1000:8.1f} ms")
+
+
+def get_portage_paths(no_cache: bool = False) -> PortagePaths:
+    """
+    Get DISTDIR and ::gentoo location from Portage
+
+    Unless no_cache is True, the paths are cached and Portage is not
+    imported unless its configuration changed since.
+    """
+
+    cache = (None if no_cache else
+             PortageConfigCache(get_cache_dir() / "portage.sqlite"))
+    try:
+        if cache is not None:
+            config_key = get_portage_config_key()
+            paths = cache.get(config_key)
+            if paths is not None and all(x.is_dir() for x in paths):
+                return paths
+
+        from portage import create_trees
+        trees = create_trees()
+        tree = trees[max(trees)]
+        paths = PortagePaths(
+            distdir=Path(tree["porttree"].settings["DISTDIR"]),
+            gentoo_repo=Path(
+                tree["porttree"].dbapi.repositories["gentoo"].location))
+        if cache is not None:
+            cache.put(config_key, paths)
+        return paths
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def repack_crates(tar_out: tarfile.TarFile,
+                  crates: typing.AbstractSet[Crate],
+                  distdir: Path,
+                  *,
+                  prefix: str,
+                  jobs: int = 1,
+                  ) -> None:
+    """
+    Add crates to the crate tarball, under prefix
+
+    If jobs is 1, crate members are streamed directly into the tarball.
+    Otherwise, upcoming crates are decompressed into memory in parallel.
+    """
+
+    start_time = datetime.datetime.now(tz=datetime.timezone.utc)
+    interval = datetime.timedelta(seconds=10)
+    next_ping = start_time + interval
+    sorted_crates = sorted(crates, key=lambda x: x.filename)
+
+    def read_crate(crate: Crate
+                   ) -> typing.List[typing.Tuple[tarfile.TarInfo, bytes]]:
+        start = time.perf_counter()
+        ret = read_tarball_members(distdir / crate.filename)
+        METRICS.add_crate_time("repack", crate.filename,
+                               time.perf_counter() - start)
+        return ret
+
+    crate_members: typing.Callable[
+        [Crate], typing.Iterable[typing.Tuple[tarfile.TarInfo,
+                                              typing.IO[bytes]]]]
+    if jobs > 1:
+        # decompress upcoming crates in parallel, preserving the order
+        buffered_members = imap_ordered(
+            read_crate,
+            (crate for crate in sorted_crates
+             if isinstance(crate, FileCrate)),
+            jobs=jobs)
+
+        def crate_members(crate: Crate
+                          ) -> typing.Iterable[typing.Tuple[
+                              tarfile.TarInfo, typing.IO[bytes]]]:
+            return ((tar_info, io.BytesIO(member_data))
+                    for tar_info, member_data in next(buffered_members))
+    else:
+        def crate_members(crate: Crate
+                          ) -> typing.Iterable[typing.Tuple[
+                              tarfile.TarInfo, typing.IO[bytes]]]:
+            # the time includes writing the members out
+            start = time.perf_counter()
+            yield from iter_tarball_members(distdir / crate.filename)
+            METRICS.add_crate_time("repack", crate.filename,
+                                   time.perf_counter() - start)
+
+    for crate_no, crate in enumerate(sorted_crates):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        if now > next_ping:
+            logging.info(
+                f"Processed {crate_no} out of {len(crates)} crates")
+            next_ping = now + interval
+        if isinstance(crate, FileCrate):
+            crate_dir = crate.get_package_directory(distdir)
+            for tar_info, member_file in crate_members(crate):
+                orig_name = PurePosixPath(tar_info.path)
+                assert orig_name.is_relative_to(crate_dir)
+                new_tar_info = tar_info.replace(
+                    name=f"{prefix}/{orig_name}")
+                tar_out.addfile(new_tar_info, member_file)
+
+            checksum_data = json.dumps(
+                {
+                    "package": crate.checksum,
+                    "files": {},
+                })
+            checksum_info = tarfile.TarInfo()
+            checksum_info.name = (
+                f"{prefix}/{crate_dir}/.cargo-checksum.json")
+            checksum_info.size = len(checksum_data)
+            checksum_info.mode = 0o644
+            tar_out.addfile(checksum_info,
+                            io.BytesIO(checksum_data.encode()))
+    end_time = datetime.datetime.now(tz=datetime.timezone.utc)
+    logging.info(f"Time elapsed during repacking: {end_time - start_time}")
+
+
+@METRICS.timed("config load")
+def load_config(args: argparse.Namespace, profile: StartupProfile) -> dict:
+    """
+    Load the configuration file and license mapping
+
+    args are updated with the defaults from the configuration file
+    and Portage.  Returns the parsed configuration file.
+    """
 
     config_toml = {}
     if not args.no_config:
@@ -131,6 +260,7 @@ def main(prog_name: str, *argv: str) -> int:
             else:
                 logging.info(f"Using configuration file {config_path}")
                 break
+    profile.mark("configuration file")
 
     # load defaults from config file
     config_toml_paths = config_toml.get("paths", {})
@@ -138,6 +268,10 @@ def main(prog_name: str, *argv: str) -> int:
         default_distdir = config_toml_paths.get("distdir")
         if default_distdir is not None:
             args.distdir = Path(default_distdir)
+    if args.crate_store is None:
+        default_crate_store = config_toml_paths.get("crate-store")
+        if default_crate_store is not None:
+            args.crate_store = Path(default_crate_store)
     if args.license_mapping is None:
         default_license_mapping = config_toml_paths.get("license-mapping")
         if default_license_mapping is not None:
@@ -145,21 +279,37 @@ def main(prog_name: str, *argv: str) -> int:
                                         encoding="utf-8")
 
     if args.distdir is None or args.license_mapping is None:
-        from portage import create_trees
-        trees = create_trees()
-        tree = trees[max(trees)]
+        portage_paths = get_portage_paths(args.no_cache)
         if args.distdir is None:
-            args.distdir = Path(tree["porttree"].settings["DISTDIR"])
+            args.distdir = portage_paths.distdir
         if args.license_mapping is None:
-            repo = Path(tree["porttree"].dbapi.repositories["gentoo"].location)
-            args.license_mapping = open(repo / "metadata/license-mapping.conf",
-                                        "r", encoding="utf-8")
+            args.license_mapping = open(
+                portage_paths.gentoo_repo / "metadata/license-mapping.conf",
+                "r", encoding="utf-8")
+        profile.mark("Portage configuration")
 
-    load_license_mapping(args.license_mapping)
+    if args.no_cache:
+        load_license_mapping(args.license_mapping)
+    else:
+        with LicenseMappingCache(
+                get_cache_dir() / "license-mapping.sqlite") as mapping_cache:
+            load_license_mapping(args.license_mapping, mapping_cache)
     args.license_mapping.close()
     MAPPING.update(
         (k.lower(), v) for k, v
         in config_toml.get("license-mapping", {}).items())
+    profile.mark("license mapping")
+    return config_toml
+
+
+def process_packages(args: argparse.Namespace,
+                     package_args: typing.List[argparse.Namespace],
+                     profile: StartupProfile,
+                     ) -> int:
+    config_toml = load_config(args, profile)
+    license_mapping_name = args.license_mapping.name
+    if args.startup_profile:
+        profile.report()
 
     def iterate_parents(directory: Path) -> typing.Generator[Path, None, None]:
         root = directory.absolute().root
@@ -168,6 +318,7 @@ def main(prog_name: str, *argv: str) -> int:
             directory /= ".."
             yield directory
 
+    @METRICS.timed("lockfile parse")
     def get_workspace_root(directory: Path) -> WorkspaceData:
         err: typing.Optional[Exception] = None
         for directory in iterate_parents(directory):
@@ -191,247 +342,586 @@ def main(prog_name: str, *argv: str) -> int:
         raise RuntimeError(
             "Cargo.lock not found in any of the parent directories") from err
 
+    crate_store = (CrateStore(args.crate_store)
+                   if args.crate_store is not None else None)
+    mirrors = (get_mirrors(config_toml["mirrors"])
+               if "mirrors" in config_toml else None)
+    # files whose checksums were verified while fetching
+    verified_paths: typing.Set[Path] = set()
+
     def try_fetcher(name: str,
-                    func: typing.Callable[..., None],
+                    func: typing.Callable[
+                        ..., typing.Optional[typing.Set[Path]]],
                     crates: typing.Iterable[Crate],
                     ) -> bool:
         if args.fetcher == "auto":
             try:
-                func(crates, distdir=args.distdir)
+                verified = func(crates, distdir=args.distdir,
+                                mirrors=mirrors)
             except FileNotFoundError:
                 return False
         elif args.fetcher == name:
-            func(crates, distdir=args.distdir)
+            verified = func(crates, distdir=args.distdir, mirrors=mirrors)
         else:
             return False
+        if verified is not None:
+            verified_paths.update(verified)
         return True
 
+    @METRICS.timed("fetch")
     def fetch_crates(crates: typing.Iterable[Crate]) -> None:
+        if crate_store is not None:
+            verified_paths.update(
+                crate_store.import_crates(crates, distdir=args.distdir))
+        if not args.no_cargo_registry_cache:
+            verified_paths.update(
+                import_crates_from_cargo_cache(crates,
+                                               distdir=args.distdir,
+                                               jobs=args.jobs))
+        if args.offline:
+            check_crates_in_distdir(crates, distdir=args.distdir)
+            return
         if (not try_fetcher("aria2", fetch_crates_using_aria2, crates) and
-                not try_fetcher("wget", fetch_crates_using_wget, crates)):
+                not try_fetcher("wget", fetch_crates_using_wget, crates) and
+                not try_fetcher("native", fetch_crates_using_native, crates)):
             if args.fetcher == "auto":
                 raise RuntimeError(
                     "No supported fetcher found (out of "
                     f"{', '.join(FETCHERS)})")
             assert False, f"Unexpected args.fetcher={args.fetcher}"
 
-    def repack_crates(tar_out: tarfile.TarFile,
-                      crates: typing.Set[Crate],
-                      ) -> None:
-        prefix = args.crate_tarball_prefix
-        start_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        interval = datetime.timedelta(seconds=10)
-        next_ping = start_time + interval
-        for crate_no, crate in enumerate(sorted(crates,
-                                                key=lambda x: x.filename)):
-            now = datetime.datetime.now(tz=datetime.timezone.utc)
-            if now > next_ping:
+    def prepare_package(pkg_args: argparse.Namespace,
+                        ) -> typing.Optional[PackageData]:
+        crates: typing.Set[Crate] = set()
+        pkg_metas = []
+        for directory in pkg_args.directory:
+            try:
+                f = open(directory / "Cargo.toml", "rb")
+            except FileNotFoundError:
+                logging.error(
+                    f"'Cargo.toml' not found in {str(directory)!r}")
                 logging.info(
-                    f"Processed {crate_no} out of {len(crates)} crates")
-                next_ping = now + interval
-            if isinstance(crate, FileCrate):
-                with tarfile.open(args.distdir / crate.filename,
-                                  "r:gz") as tar_in:
-                    crate_dir = crate.get_package_directory(args.distdir)
-                    for tar_info in tar_in:
-                        orig_name = PurePosixPath(tar_info.path)
-                        assert orig_name.is_relative_to(crate_dir)
-                        member_file = tar_in.extractfile(tar_info)
-                        assert member_file is not None
-                        with member_file:
-                            new_tar_info = tar_info.replace(
-                                name=f"{prefix}/{orig_name}")
-                            tar_out.addfile(new_tar_info, member_file)
-
-                    checksum_data = json.dumps(
-                        {
-                            "package": crate.checksum,
-                            "files": {},
-                        })
-                    checksum_info = tarfile.TarInfo()
-                    checksum_info.name = (
-                        f"{prefix}/{crate_dir}/.cargo-checksum.json")
-                    checksum_info.size = len(checksum_data)
-                    checksum_info.mode = 0o644
-                    tar_out.addfile(checksum_info,
-                                    io.BytesIO(checksum_data.encode()))
-        end_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        logging.info(f"Time elapsed during repacking: {end_time - start_time}")
-
-    crates: typing.Set[Crate] = set()
-    pkg_metas = []
-    for directory in args.directory:
+                    "Please pass the path to a directory containing "
+                    "'Cargo.toml' as an argument.")
+                return None
+            with f:
+                workspace = get_workspace_root(directory)
+                crates.update(workspace.crates)
+                try:
+                    pkg_metas.append(
+                        get_package_metadata(f, workspace.workspace_metadata))
+                except WorkspaceCargoTomlError as e:
+                    logging.error(
+                        "The specified directory is a workspace root: "
+                        f"{str(directory)!r}")
+                    logging.info(
+                        "Please run pycargoebuild in one of its members: "
+                        f"{' '.join(e.members)}")
+                    return None
+        pkg_meta = pkg_metas[0]
+
+        if pkg_args.no_license:
+            pkg_meta = pkg_meta.with_replaced_license(None)
+        elif len(pkg_args.directory) > 1:
+            # Combine licenses of multiple packages
+            combined_license = " AND ".join(f"( {pkg.license} )"
+                                            for pkg in pkg_metas
+                                            if pkg.license is not None)
+            pkg_meta = pkg_meta.with_replaced_license(
+                combined_license or None)
+
+        unchanged_crates: typing.FrozenSet[FileCrate] = frozenset()
+        if pkg_args.input is not None:
+            if not pkg_args.input.is_file():
+                logging.error(f"Input file {str(pkg_args.input)!r} "
+                              "does not exist")
+                return None
+            if pkg_args.incremental and not pkg_args.crate_tarball:
+                old_ebuild = pkg_args.input.read_text(encoding="utf-8")
+                try:
+                    old_entries = get_ebuild_CRATES(old_ebuild)
+                except RuntimeError as e:
+                    logging.error(f"{str(pkg_args.input)!r}: {e}")
+                    return None
+                unchanged_crates = get_unchanged_crates(old_ebuild, crates)
+                added = sum(1 for crate in crates
+                            if isinstance(crate, FileCrate)
+                            and crate not in unchanged_crates)
+                logging.info(
+                    f"{pkg_meta.name}: {added} crates added, "
+                    f"{len(old_entries) - len(unchanged_crates)} removed, "
+                    f"{len(unchanged_crates)} unchanged")
+        if pkg_args.input is not None and pkg_args.output is None:
+            # default to overwriting the input file
+            outfile = pkg_args.input
+        else:
+            # This warning is only relevant when constructing a new ebuild,
+            # as otherwise we do not update other metadata.
+            if len(pkg_args.directory) > 1:
+                logging.warning(
+                    "Multiple directories passed, all metadata except for "
+                    "LICENSE will be taken from the first package, "
+                    f"{pkg_meta.name}")
+            output = pkg_args.output
+            if output is None:
+                output = "{name}-{version}.ebuild"
+            outfile = Path(output.format(name=pkg_meta.name,
+                                         version=pkg_meta.version))
+            if not pkg_args.force and outfile.exists():
+                logging.error(
+                    f"{outfile} exists already, pass -f to overwrite it")
+                return None
+
+        return PackageData(args=pkg_args,
+                           crates=frozenset(crates),
+                           pkg_meta=pkg_meta,
+                           outfile=outfile,
+                           unchanged_crates=unchanged_crates)
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    def write_package(package: PackageData,
+                      metadata_cache: typing.Optional[MetadataCache],
+                      ) -> bool:
+        pkg_args = package.args
+        crates = package.crates
+        pkg_meta = package.pkg_meta
+        outfile = package.outfile
+        no_manifest = pkg_args.no_manifest
+
+        if pkg_args.crate_tarball:
+            crate_tarball = Path(
+                pkg_args.crate_tarball_path.format(name=pkg_meta.name,
+                                                   version=pkg_meta.version,
+                                                   distdir=args.distdir))
+            if pkg_args.no_write_crate_tarball:
+                logging.info("Skipping creating crate tarball")
+            else:
+                if not pkg_args.force and crate_tarball.exists():
+                    logging.error(f"{crate_tarball} exists already, pass -f "
+                                  "to overwrite it")
+                    return False
+                write_crate_tarball(crate_tarball,
+                                    crates,
+                                    args.distdir,
+                                    prefix=args.crate_tarball_prefix,
+                                    preset=args.crate_tarball_preset,
+                                    jobs=args.jobs,
+                                    file_mode=0o666 & ~umask)
+                logging.info(f"Crate tarball written to {crate_tarball}")
+
+                # do not regenerate Manifest, crate tarball needs
+                # to be uploaded first
+                no_manifest = True
+
+        input_st = None
         try:
-            f = open(directory / "Cargo.toml", "rb")
-        except FileNotFoundError:
-            logging.error(f"'Cargo.toml' not found in {str(directory)!r}")
+            if pkg_args.input is not None:
+                with open(pkg_args.input, "r", encoding="utf-8") as input_f:
+                    input_st = os.stat(input_f.fileno())
+                    ebuild = update_ebuild(
+                        input_f.read(),
+                        pkg_meta,
+                        crates,
+                        distdir=args.distdir,
+                        crate_license=not pkg_args.no_license,
+                        crate_tarball=(crate_tarball if pkg_args.crate_tarball
+                                       else None),
+                        license_overrides=config_toml.get(
+                            "license-overrides", {}),
+                        metadata_cache=metadata_cache,
+                        jobs=args.jobs,
+                        )
+                logging.warning(
+                    "The in-place mode updates CRATES, GIT_CRATES and crate "
+                    "LICENSE+= variables only, other metadata is left "
+                    "unchanged")
+            else:
+                ebuild = get_ebuild(
+                    pkg_meta,
+                    crates,
+                    distdir=args.distdir,
+                    crate_license=not pkg_args.no_license,
+                    crate_tarball=(crate_tarball if pkg_args.crate_tarball
+                                   else None),
+                    license_overrides=config_toml.get("license-overrides",
+                                                      {}),
+                    use_features=pkg_args.features,
+                    metadata_cache=metadata_cache,
+                    jobs=args.jobs,
+                    )
+        except UnmatchedLicense as e:
+            logging.error(
+                f"The license {e.license_key!r} did not match any entry in "
+                f"{license_mapping_name!r}")
+            if e.crate is not None:
+                logging.info(f"Crate file: {e.crate!r}")
             logging.info(
-                "Please pass the path to a directory containing 'Cargo.toml' "
-                "as an argument.")
-            return 1
-        with f:
-            workspace = get_workspace_root(directory)
-            crates.update(workspace.crates)
+                "1. If that is a valid SPDX-2.0 license identifier, then "
+                "please add it to the license mapping file.  However, please "
+                "make sure to:\n"
+                "a. avoid adding duplicate licenses (multiple SPDX-2.0 "
+                "identifiers can map to the same Gentoo license),\n"
+                "b. add new licenses to appropriate license-groups.\n"
+                "\n"
+                "2. If that is not a valid SPDX-2.0 license identiiers, "
+                "please file a bug upstream.  For the time being, you can use "
+                "a local license mapping file (--license-mapping) or "
+                "per-crate license-overrides in config (see README).")
+            return False
+
+        write_ebuild(outfile, ebuild, input_st=input_st,
+                     file_mode=0o666 & ~umask)
+
+        if not no_manifest and (outfile.parent / "Manifest").exists():
             try:
-                pkg_metas.append(
-                    get_package_metadata(f, workspace.workspace_metadata))
-            except WorkspaceCargoTomlError as e:
-                logging.error("The specified directory is a workspace root: "
-                              f"{str(directory)!r}")
-                logging.info(
-                    "Please run pycargoebuild in one of its members: "
-                    f"{' '.join(e.members)}")
-                return 1
-    pkg_meta = pkg_metas[0]
-
-    if args.no_license:
-        pkg_meta = pkg_meta.with_replaced_license(None)
-    elif len(args.directory) > 1:
-        # Combine licenses of multiple packages
-        combined_license = " AND ".join(f"( {pkg.license} )"
-                                        for pkg in pkg_metas
-                                        if pkg.license is not None)
-        pkg_meta = pkg_meta.with_replaced_license(
-            combined_license or None)
-
-    if args.input is not None and args.output is None:
-        # default to overwriting the input file
-        outfile = Path(args.input.name)
-    else:
-        # This warning is only relevant when constructing a new ebuild,
-        # as otherwise we do not update other metadata.
-        if len(args.directory) > 1:
-            logging.warning(
-                "Multiple directories passed, all metadata except for LICENSE "
-                f"will be taken from the first package, {pkg_meta.name}")
-        if args.output is None:
-            args.output = "{name}-{version}.ebuild"
-        outfile = Path(args.output.format(name=pkg_meta.name,
-                                          version=pkg_meta.version))
-        if not args.force and outfile.exists():
-            logging.error(f"{outfile} exists already, pass -f to overwrite it")
-            return 1
+                subprocess.call(["pkgdev", "manifest"], cwd=outfile.parent)
+            except FileNotFoundError:
+                logging.warning(
+                    "pkgdev not found, Manifest will not be updated")
 
-    fetch_crates(crates)
-    try:
-        verify_crates(crates, distdir=args.distdir)
-    except ChecksumMismatchError as e:
-        logging.error(f"Checksum mismatch for {str(e.path)!r}")
-        logging.info(f"   Found checksum (SHA256): {e.current!r}")
-        logging.info(f"Expected checksum (SHA256): {e.expected!r}")
-        logging.info("Remove the file to try downloading again.")
-        return 1
+        print(f"{outfile}")
+        return True
 
-    umask = os.umask(0)
-    os.umask(umask)
+    def fetch_and_verify(packages: typing.List[PackageData],
+                         metadata_cache: MetadataCache,
+                         *,
+                         max_cache_entries: int,
+                         ) -> bool:
+        # in incremental mode, unchanged crates are not fetched if their
+        # metadata is cached already
+        crates = frozenset().union(*(
+            package.crates - {crate for crate in package.unchanged_crates
+                              if metadata_cache.get(crate) is not None}
+            for package in packages))
+
+        verification_cache = None
+        cache_config = config_toml.get("cache", {})
+        if not args.no_cache and (args.verification_cache or
+                                  cache_config.get("verification", False)):
+            verification_cache = VerificationCache(
+                get_cache_dir() / "verification.sqlite",
+                max_entries=max_cache_entries,
+                reverify=args.reverify)
 
-    if args.crate_tarball:
-        crate_tarball = Path(
-            args.crate_tarball_path.format(name=pkg_meta.name,
-                                           version=pkg_meta.version,
-                                           distdir=args.distdir))
-        if args.no_write_crate_tarball:
-            logging.info("Skipping creating crate tarball")
-        else:
-            if not args.force and crate_tarball.exists():
-                logging.error(f"{crate_tarball} exists already, pass -f to "
-                              "overwrite it")
-                return 1
-            with tempfile.NamedTemporaryFile(mode="wb",
-                                             dir=args.distdir,
-                                             delete=False
-                                             ) as cratef:
-                try:
-                    # typing: https://github.com/python/typeshed/issues/11072
-                    with tarfile.open(fileobj=cratef,
-                                      mode="w:xz",
-                                      format=tarfile.GNU_FORMAT,
-                                      encoding="UTF-8",
-                                      preset=9 | lzma.PRESET_EXTREME,  # type: ignore
-                                      ) as tar_out:  # type: ignore
-                        os.fchmod(cratef.fileno(), 0o666 & ~umask)
-                        logging.info("Repacking crates ...")
-                        repack_crates(tar_out, crates)
-                except BaseException:
-                    Path(cratef.name).unlink()
-                    raise
-            Path(cratef.name).rename(crate_tarball)
-            logging.info(f"Crate tarball written to {crate_tarball}")
-
-            # do not regenerate Manifest, crate tarball needs to be uploaded
-            # first
-            args.no_manifest = True
+        try:
+            fetch_crates(crates)
+            if verification_cache is not None:
+                for crate in crates:
+                    path = args.distdir / crate.filename
+                    if (isinstance(crate, FileCrate) and
+                            path in verified_paths):
+                        verification_cache.add(path,
+                                               FileStat.from_path(path),
+                                               crate.checksum)
+            verify_crates((crate for crate in crates
+                           if args.distdir / crate.filename
+                           not in verified_paths),
+                          distdir=args.distdir,
+                          jobs=args.jobs,
+                          cache=verification_cache)
+        except ChecksumMismatchError as e:
+            errors = (e.errors if isinstance(e, MultipleChecksumMismatchError)
+                      else [e])
+            for error in errors:
+                logging.error(f"Checksum mismatch for {str(error.path)!r}")
+                logging.info(f"   Found checksum (SHA256): {error.current!r}")
+                logging.info(
+                    f"Expected checksum (SHA256): {error.expected!r}")
+                if error.path.exists():
+                    logging.info("Remove the file to try downloading again.")
+            return False
+        except FetchError as e:
+            fetch_errors = (e.errors if isinstance(e, MultipleFetchError)
+                            else [e])
+            logging.error(f"Fetching {len(fetch_errors)} files failed:")
+            for fetch_error in fetch_errors:
+                logging.error(f"  {fetch_error.url}: {fetch_error.reason}")
+            if not args.offline:
+                logging.info("Partial downloads are kept, rerun to resume "
+                             "fetching.")
+            return False
+        finally:
+            if verification_cache is not None:
+                verification_cache.close()
+        if crate_store is not None:
+            crate_store.add_crates(crates, distdir=args.distdir)
+        return True
 
+    ret = 0
+    packages = []
+    for pkg_args in package_args:
+        package = prepare_package(pkg_args)
+        if package is None:
+            if args.batch is None:
+                return 1
+            ret = 1
+            continue
+        packages.append(package)
+
+    # fetch and verify crates of all packages at once; the metadata cache
+    # is shared by all packages, and kept in memory if persistent caches
+    # are disabled
+    max_cache_entries = config_toml.get("cache", {}).get(
+        "max-entries", DEFAULT_MAX_ENTRIES)
+    metadata_cache = MetadataCache(
+        None if args.no_cache else get_cache_dir() / "metadata.sqlite",
+        max_entries=max_cache_entries)
     try:
-        if args.input is not None:
-            ebuild = update_ebuild(
-                args.input.read(),
-                pkg_meta,
-                crates,
-                distdir=args.distdir,
-                crate_license=not args.no_license,
-                crate_tarball=crate_tarball if args.crate_tarball else None,
-                license_overrides=config_toml.get("license-overrides", {}),
-                )
-            logging.warning(
-                "The in-place mode updates CRATES, GIT_CRATES and crate "
-                "LICENSE+= variables only, other metadata is left unchanged")
-        else:
-            ebuild = get_ebuild(
-                pkg_meta,
-                crates,
-                distdir=args.distdir,
-                crate_license=not args.no_license,
-                crate_tarball=crate_tarball if args.crate_tarball else None,
-                license_overrides=config_toml.get("license-overrides", {}),
-                use_features=args.features,
-                )
-    except UnmatchedLicense as e:
-        logging.error(
-            f"The license {e.license_key!r} did not match any entry in "
-            f"{args.license_mapping.name!r}")
-        if e.crate is not None:
-            logging.info(f"Crate file: {e.crate!r}")
-        logging.info(
-            "1. If that is a valid SPDX-2.0 license identifier, then please "
-            "add it to the license mapping file.  However, please make sure "
-            "to:\n"
-            "a. avoid adding duplicate licenses (multiple SPDX-2.0 "
-            "identifiers can map to the same Gentoo license),\n"
-            "b. add new licenses to appropriate license-groups.\n"
-            "\n"
-            "2. If that is not a valid SPDX-2.0 license identiiers, please "
-            "file a bug upstream.  For the time being, you can use a local "
-            "license mapping file (--license-mapping) or per-crate "
-            "license-overrides in config (see README).")
-        return 1
-
+        if not fetch_and_verify(packages, metadata_cache,
+                                max_cache_entries=max_cache_entries):
+            return 1
+        for package in packages:
+            if not write_package(package, metadata_cache):
+                if args.batch is None:
+                    return 1
+                ret = 1
+    finally:
+        metadata_cache.close()
+
+    return ret
+
+
+@METRICS.timed("tarball write")
+def write_crate_tarball(path: Path,
+                        crates: typing.AbstractSet[Crate],
+                        distdir: Path,
+                        *,
+                        prefix: str,
+                        preset: typing.Optional[str],
+                        jobs: int,
+                        file_mode: int,
+                        ) -> None:
+    """Write the crate tarball into path, replacing it atomically"""
+    with tempfile.NamedTemporaryFile(mode="wb",
+                                     dir=distdir,
+                                     delete=False
+                                     ) as cratef:
+        try:
+            os.fchmod(cratef.fileno(), file_mode)
+            with (open_compressed_writer(cratef,
+                                         get_compression(str(path)),
+                                         preset=preset,
+                                         jobs=jobs) as compressed_f,
+                  tarfile.open(fileobj=compressed_f,
+                               mode="w|",
+                               format=tarfile.GNU_FORMAT,
+                               encoding="UTF-8",
+                               ) as tar_out):
+                logging.info("Repacking crates ...")
+                repack_crates(tar_out, crates, distdir, prefix=prefix,
+                              jobs=jobs)
+        except BaseException:
+            Path(cratef.name).unlink()
+            raise
+    Path(cratef.name).rename(path)
+    METRICS.add("bytes_written", path.stat().st_size)
+
+
+@METRICS.timed("ebuild write")
+def write_ebuild(path: Path,
+                 ebuild: str,
+                 *,
+                 input_st: typing.Optional[os.stat_result],
+                 file_mode: int,
+                 ) -> None:
+    """
+    Write the ebuild into path, replacing it atomically
+
+    If input_st is specified, the ownership and mode are copied from it.
+    Otherwise, file_mode is used.
+    """
     with tempfile.NamedTemporaryFile(mode="w",
                                      encoding="utf-8",
-                                     dir=outfile.parent,
+                                     dir=path.parent,
                                      delete=False) as outf:
         try:
-            if args.input is not None:
-                st = os.stat(args.input.fileno())
-                os.chown(outf.fileno(), st.st_uid, st.st_gid)
-                os.chmod(outf.fileno(), stat.S_IMODE(st.st_mode))
-                args.input.close()
+            if input_st is not None:
+                os.chown(outf.fileno(), input_st.st_uid, input_st.st_gid)
+                os.chmod(outf.fileno(), stat.S_IMODE(input_st.st_mode))
             else:
-                os.fchmod(outf.fileno(), 0o666 & ~umask)
+                os.fchmod(outf.fileno(), file_mode)
             outf.write(ebuild)
         except BaseException:
             Path(outf.name).unlink()
             raise
-    Path(outf.name).rename(outfile)
+    Path(outf.name).rename(path)
+    METRICS.add("bytes_written", len(ebuild.encode()))
 
-    if not args.no_manifest and (outfile.parent / "Manifest").exists():
-        try:
-            subprocess.call(["pkgdev", "manifest"], cwd=outfile.parent)
-        except FileNotFoundError:
-            logging.warning("pkgdev not found, Manifest will not be updated")
 
-    print(f"{outfile}")
-    return 0
+def main(prog_name: str, *argv: str) -> int:
+    profile = StartupProfile(IMPORT_START_TIME)
+    profile.mark("imports")
+    argp = argparse.ArgumentParser(prog=os.path.basename(prog_name))
+    argp.add_argument("-b", "--batch",
+                      type=argparse.FileType("rb"),
+                      metavar="MANIFEST",
+                      help="Process all packages listed in the specified "
+                           "batch manifest (see README), fetching "
+                           "and verifying their crates once")
+    argp.add_argument("-c", "--crate-tarball",
+                      action="store_true",
+                      help="Pack fetched crates into a tarball rather than "
+                           "adding them to the CRATES variable")
+    argp.add_argument("-e", "--features",
+                      action="store_true",
+                      help="Add USE flags for Cargo features")
+    argp.add_argument("--crate-tarball-path",
+                      default="{distdir}/{name}-{version}-crates.tar.xz",
+                      help="Path to write crate tarball to, zstd compression "
+                           "is used if it ends with .zst (default: "
+                           "{distdir}/{name}-{version}-crates.tar.xz)")
+    argp.add_argument("--crate-tarball-preset",
+                      help="Compression preset for the crate tarball "
+                           f"(xz: 0-9 optionally followed by 'e', default: "
+                           f"{DEFAULT_XZ_PRESET}; zstd: 1-22, default: "
+                           f"{DEFAULT_ZSTD_LEVEL})")
+    argp.add_argument("--crate-tarball-prefix",
+                      default="cargo_home/gentoo",
+                      help="Prefix prepended for all paths in the crate "
+                           "tarball (default: cargo_home/gentoo)")
+    argp.add_argument("--no-write-crate-tarball",
+                      action="store_true",
+                      help="Do not create the crate tarball, just write "
+                           "the ebuild assuming it exists")
+    argp.add_argument("--crate-store",
+                      type=Path,
+                      metavar="DIR",
+                      help="Content-addressed crate store shared between "
+                           "distdirs, crates are reflinked or hardlinked "
+                           "into distdir from it (default: none)")
+    argp.add_argument("-d", "--distdir",
+                      type=Path,
+                      help="Directory to store downloaded crates in "
+                           "(default: get from Portage)")
+    argp.add_argument("-f", "--force",
+                      action="store_true",
+                      help="Force overwriting the output file")
+    argp.add_argument("-F", "--fetcher",
+                      choices=("auto",) + FETCHERS,
+                      default="auto",
+                      help="Fetcher to use (one of: auto [default], "
+                           f"{', '.join(FETCHERS)})")
+    argp.add_argument("-i", "--input", "--inplace",
+                      type=Path,
+                      metavar="INPUT",
+                      help="Update the CRATES and LICENSE variables "
+                           "in the specified ebuild instead of creating "
+                           "one from scratch")
+    argp.add_argument("--incremental",
+                      action="store_true",
+                      help="With --input, do not fetch crates that are "
+                           "listed in the input ebuild already, and whose "
+                           "metadata is cached")
+    argp.add_argument("-j", "--jobs",
+                      type=int,
+                      default=1,
+                      help="Number of parallel jobs to use when processing "
+                           "crates (0 = number of CPUs, default: 1)")
+    argp.add_argument("-l", "--license-mapping",
+                      type=argparse.FileType("r", encoding="utf-8"),
+                      help="Path to license-mapping.conf file (default: "
+                           "get from Portage)")
+    argp.add_argument("-L", "--no-license",
+                      action="store_true",
+                      help="Do not include LICENSEs (e.g. when crates are "
+                           "only used at build time")
+    argp.add_argument("-M", "--no-manifest",
+                      action="store_true",
+                      help="Do not call `pkgdev manifest` (called only if "
+                           "Manifest exists)")
+    argp.add_argument("-o", "--output",
+                      help="Ebuild file to write (default: INPUT if --input "
+                           "is specified, {name}-{version}.ebuild otherwise)")
+    argp.add_argument("--no-cargo-registry-cache",
+                      action="store_true",
+                      help="Do not reuse crates from the Cargo registry "
+                           "cache (in $CARGO_HOME/registry/cache)")
+    argp.add_argument("--offline",
+                      action="store_true",
+                      help="Do not fetch crates, fail if any crates are "
+                           "missing from distdir (after importing them "
+                           "from the crate store and the Cargo registry "
+                           "cache)")
+    argp.add_argument("--no-config",
+                      action="store_true",
+                      help="Inhibit loading configuration files")
+    argp.add_argument("--no-cache",
+                      action="store_true",
+                      help="Do not use any persistent caches")
+    argp.add_argument("--verification-cache",
+                      action="store_true",
+                      help="Cache checksum verification results and skip "
+                           "verifying crates that did not change since")
+    argp.add_argument("--reverify",
+                      action="store_true",
+                      help="Verify all crates, ignoring the verification "
+                           "cache")
+    argp.add_argument("--metrics",
+                      type=Path,
+                      metavar="FILE",
+                      help="Write timings of the processing phases "
+                           "and other metrics as JSON into FILE")
+    argp.add_argument("--startup-profile",
+                      action="store_true",
+                      help="Report the time spent on imports and loading "
+                           "configuration")
+    argp.add_argument("directory",
+                      type=Path,
+                      nargs="*",
+                      help="Directory containing Cargo.* files (default: .)")
+    args = argp.parse_args(argv)
+    if args.jobs < 0:
+        argp.error("--jobs must not be negative")
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    if args.crate_tarball_preset is not None:
+        try:
+            check_preset(get_compression(args.crate_tarball_path),
+                         args.crate_tarball_preset)
+        except CompressionError as e:
+            argp.error(f"--crate-tarball-preset: {e}")
+
+    if args.batch is not None:
+        if args.directory or args.input is not None or args.output is not None:
+            argp.error("--batch cannot be combined with directories, --input "
+                       "or --output")
+        with args.batch:
+            try:
+                batch_packages = load_batch_manifest(args.batch)
+            except BatchManifestError as e:
+                argp.error(f"--batch: {e}")
+        package_args = []
+        for batch_package in batch_packages:
+            pkg_args = argparse.Namespace(**vars(args))
+            pkg_args.directory = batch_package.directories
+            pkg_args.input = batch_package.input
+            pkg_args.output = batch_package.output
+            for key in ("features", "crate_tarball", "incremental",
+                        "no_license"):
+                value = getattr(batch_package, key)
+                if value is not None:
+                    setattr(pkg_args, key, value)
+            package_args.append(pkg_args)
+    else:
+        if args.incremental and args.input is None:
+            argp.error("--incremental requires --input")
+        if not args.directory:
+            args.directory = [Path(".")]
+        package_args = [args]
+    if args.no_cache and any(pkg_args.incremental
+                             for pkg_args in package_args):
+        logging.warning("--incremental has no effect with --no-cache, "
+                        "all crates will be fetched")
+    profile.mark("argument parsing")
+
+    METRICS.reset()
+    try:
+        return process_packages(args, package_args, profile)
+    finally:
+        if args.metrics is not None:
+            METRICS.write(args.metrics)
 
 
 def entry_point() -> None:
@@ -0,0 +1,105 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import sys
+import typing
+from pathlib import Path
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+
+class BatchManifestError(RuntimeError):
+    pass
+
+
+class BatchPackage(typing.NamedTuple):
+    directories: typing.List[Path]
+    input: typing.Optional[Path] = None
+    output: typing.Optional[str] = None
+    features: typing.Optional[bool] = None
+    crate_tarball: typing.Optional[bool] = None
+    no_license: typing.Optional[bool] = None
+    incremental: typing.Optional[bool] = None
+
+
+BOOLEAN_KEYS = {
+    "features": "features",
+    "crate-tarball": "crate_tarball",
+    "no-license": "no_license",
+    "incremental": "incremental",
+}
+
+
+def load_batch_manifest(f: typing.BinaryIO,
+                        base_dir: typing.Optional[Path] = None,
+                        ) -> typing.List[BatchPackage]:
+    """
+    Read the list of packages to process from a batch manifest
+
+    The manifest is a TOML file containing a [[package]] table for every
+    package, e.g.:
+
+        [[package]]
+        directory = "foo-1.2.3"
+        input = "dev-util/foo/foo-1.2.2.ebuild"
+        output = "dev-util/foo/{name}-{version}.ebuild"
+
+    Relative paths are interpreted relatively to base_dir, that defaults
+    to the directory containing the manifest.  Boolean keys
+    (crate-tarball, features, incremental, no-license) override
+    the respective command-line options.
+    """
+
+    if base_dir is None:
+        base_dir = Path(getattr(f, "name", ".")).parent
+    try:
+        manifest = tomllib.load(f)
+    except tomllib.TOMLDecodeError as e:
+        raise BatchManifestError(
+            f"Error parsing batch manifest: {e}") from e
+
+    packages = manifest.get("package", [])
+    if not isinstance(packages, list) or not packages:
+        raise BatchManifestError(
+            "Batch manifest does not specify any [[package]]")
+
+    ret = []
+    for i, package in enumerate(packages, start=1):
+        package = dict(package)
+        directory = package.pop("directory", None)
+        if isinstance(directory, str):
+            directory = [directory]
+        if (not isinstance(directory, list) or not directory or
+                not all(isinstance(x, str) for x in directory)):
+            raise BatchManifestError(
+                f"Package #{i}: 'directory' must be a string or a non-empty "
+                "list of strings")
+        kwargs: typing.Dict[str, typing.Any] = {
+            "directories": [base_dir / x for x in directory],
+        }
+        for key in ("input", "output"):
+            value = package.pop(key, None)
+            if value is None:
+                continue
+            if not isinstance(value, str):
+                raise BatchManifestError(
+                    f"Package #{i}: {key!r} must be a string")
+            kwargs[key] = (base_dir / value if key == "input"
+                           else str(base_dir / value))
+        for key, attr in BOOLEAN_KEYS.items():
+            value = package.pop(key, None)
+            if value is None:
+                continue
+            if not isinstance(value, bool):
+                raise BatchManifestError(
+                    f"Package #{i}: {key!r} must be a boolean")
+            kwargs[attr] = value
+        if package:
+            raise BatchManifestError(
+                f"Package #{i}: unknown keys: {', '.join(sorted(package))}")
+        ret.append(BatchPackage(**kwargs))
+    return ret
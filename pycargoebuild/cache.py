@@ -0,0 +1,409 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import hashlib
+import json
+import logging
+import marshal
+import os
+import sqlite3
+import sys
+import time
+import typing
+from pathlib import Path
+
+from pycargoebuild.cargo import FileCrate, PackageMetadata
+
+DEFAULT_MAX_ENTRIES = 100000
+
+_CacheT = typing.TypeVar("_CacheT", bound="SQLiteCache")
+
+
+def get_cache_dir() -> Path:
+    """Get the directory to store pycargoebuild caches in"""
+    return (Path(os.path.expanduser(os.environ.get("XDG_CACHE_HOME",
+                                                   "~/.cache"))) /
+            "pycargoebuild")
+
+
+class SQLiteCache:
+    """
+    Base class for caches stored in SQLite databases
+
+    The database is recreated if its version does not match the version
+    of the cache class, or if it is corrupted.  Subclasses need to define
+    the version and schema, and can use _db once the cache is opened.
+    If path is None, the cache is kept in memory only.
+    """
+
+    # bump whenever the schema or the format of stored data changes
+    version: typing.ClassVar[int]
+    schema: typing.ClassVar[typing.Tuple[str, ...]]
+
+    def __init__(self, path: typing.Optional[Path]) -> None:
+        self.path = path
+        if path is None:
+            self._db = self._open()
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self._db = self._open()
+        except sqlite3.DatabaseError as e:
+            logging.warning(f"Cache {str(path)!r} is corrupted, recreating "
+                            f"it ({e})")
+            path.unlink()
+            self._db = self._open()
+
+    def _open(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path or ":memory:", timeout=30)
+        try:
+            (version,) = db.execute("PRAGMA user_version").fetchone()
+            if version != self.version:
+                with db:
+                    tables = db.execute("SELECT name FROM sqlite_master "
+                                        "WHERE type = 'table'").fetchall()
+                    for (table,) in tables:
+                        db.execute(f"DROP TABLE {table}")
+                    for statement in self.schema:
+                        db.execute(statement)
+                    db.execute(f"PRAGMA user_version = {self.version}")
+        except BaseException:
+            db.close()
+            raise
+        return db
+
+    def flush(self) -> None:
+        """Write the pending changes out"""
+
+    def close(self) -> None:
+        """Write the changes out and close the cache"""
+        try:
+            with self._db:
+                self.flush()
+        finally:
+            self._db.close()
+
+    def __enter__(self: _CacheT) -> _CacheT:
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.close()
+
+
+class MetadataCache(SQLiteCache):
+    """
+    Persistent cache of crate metadata, keyed by crate checksum
+
+    Entries are updated in memory and written out when the cache is closed,
+    at which point the least recently used entries above max_entries
+    are evicted.
+    """
+
+    version = 1
+    schema = (
+        ("CREATE TABLE crate_metadata ("
+         "checksum TEXT PRIMARY KEY, "
+         "metadata TEXT NOT NULL, "
+         "last_used INTEGER NOT NULL)"),
+    )
+
+    def __init__(self,
+                 path: typing.Optional[Path],
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ) -> None:
+        super().__init__(path)
+        self.max_entries = max_entries
+        self._new_entries: dict[str, str] = {}
+        self._used: set[str] = set()
+
+    def get(self, crate: FileCrate) -> typing.Optional[PackageMetadata]:
+        """Get cached metadata for crate, None if not cached"""
+        if not crate.checksum:
+            return None
+        value = self._new_entries.get(crate.checksum)
+        if value is None:
+            row = self._db.execute(
+                "SELECT metadata FROM crate_metadata WHERE checksum = ?",
+                (crate.checksum,)).fetchone()
+            if row is None:
+                return None
+            (value,) = row
+            self._used.add(crate.checksum)
+        return PackageMetadata(**json.loads(value))
+
+    def put(self, crate: FileCrate, metadata: PackageMetadata) -> None:
+        """Store metadata for crate"""
+        if crate.checksum:
+            self._new_entries[crate.checksum] = json.dumps(metadata._asdict())
+
+    def flush(self) -> None:
+        now = time.time_ns()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO crate_metadata "
+            "(checksum, metadata, last_used) VALUES (?, ?, ?)",
+            ((checksum, value, now)
+             for checksum, value in self._new_entries.items()))
+        self._db.executemany(
+            "UPDATE crate_metadata SET last_used = ? WHERE checksum = ?",
+            ((now, checksum) for checksum in self._used))
+        self._db.execute(
+            "DELETE FROM crate_metadata WHERE checksum NOT IN "
+            "(SELECT checksum FROM crate_metadata "
+            "ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,))
+        self._new_entries.clear()
+        self._used.clear()
+
+
+class FileStat(typing.NamedTuple):
+    size: int
+    mtime_ns: int
+    inode: int
+
+    @classmethod
+    def from_path(cls, path: Path) -> "FileStat":
+        st = path.stat()
+        return cls(size=st.st_size, mtime_ns=st.st_mtime_ns, inode=st.st_ino)
+
+
+class VerificationCache(SQLiteCache):
+    """
+    Persistent cache of verified file checksums
+
+    Files are assumed to be unchanged if their size, mtime and inode number
+    match the values recorded when they were verified.  If reverify
+    is True, the recorded values are ignored but still updated.
+    """
+
+    version = 1
+    schema = (
+        ("CREATE TABLE verified_files ("
+         "path TEXT PRIMARY KEY, "
+         "size INTEGER NOT NULL, "
+         "mtime_ns INTEGER NOT NULL, "
+         "inode INTEGER NOT NULL, "
+         "checksum TEXT NOT NULL, "
+         "last_used INTEGER NOT NULL)"),
+    )
+
+    def __init__(self,
+                 path: typing.Optional[Path],
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 *,
+                 reverify: bool = False,
+                 ) -> None:
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.reverify = reverify
+        self._new_entries: dict[str, typing.Tuple[FileStat, str]] = {}
+        self._used: set[str] = set()
+
+    def is_verified(self, path: Path, st: FileStat, checksum: str) -> bool:
+        """Check whether path with stat st was verified to have checksum"""
+        if self.reverify:
+            return False
+        key = str(path.absolute())
+        row = self._db.execute(
+            "SELECT size, mtime_ns, inode, checksum FROM verified_files "
+            "WHERE path = ?", (key,)).fetchone()
+        if row is None or (FileStat(*row[:3]), row[3]) != (st, checksum):
+            return False
+        self._used.add(key)
+        return True
+
+    def add(self, path: Path, st: FileStat, checksum: str) -> None:
+        """Record that path with stat st was verified to have checksum"""
+        self._new_entries[str(path.absolute())] = (st, checksum)
+
+    def flush(self) -> None:
+        now = time.time_ns()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO verified_files "
+            "(path, size, mtime_ns, inode, checksum, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            ((path, *st, checksum, now)
+             for path, (st, checksum) in self._new_entries.items()))
+        self._db.executemany(
+            "UPDATE verified_files SET last_used = ? WHERE path = ?",
+            ((now, path) for path in self._used))
+        self._db.execute(
+            "DELETE FROM verified_files WHERE path NOT IN "
+            "(SELECT path FROM verified_files "
+            "ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,))
+        self._new_entries.clear()
+        self._used.clear()
+
+
+# files and directories affecting DISTDIR and repository locations,
+# relative to PORTAGE_CONFIGROOT (EPREFIX is handled separately)
+PORTAGE_CONFIG_PATHS = (
+    "etc/make.conf",
+    "etc/portage/make.conf",
+    "etc/portage/make.profile",
+    "etc/portage/repos.conf",
+    "usr/share/portage/config/make.globals",
+    "usr/share/portage/config/repos.conf",
+)
+PORTAGE_CONFIG_ENV = (
+    "DISTDIR",
+    "EPREFIX",
+    "PORTAGE_CONFIGROOT",
+    "PORTAGE_REPOSITORIES",
+    "PORTDIR",
+    "ROOT",
+)
+
+
+def get_portage_config_key() -> str:
+    """
+    Get the key identifying the current state of Portage configuration
+
+    The key combines the relevant environment variables with the mtimes
+    of Portage configuration files (recursively for directories).
+    """
+
+    config_root = Path(os.environ.get("PORTAGE_CONFIGROOT", "/"))
+    eprefix = os.environ.get("EPREFIX", "").lstrip("/")
+    mtimes: dict[str, typing.Union[int, str, None]] = {}
+    for rel_path in PORTAGE_CONFIG_PATHS:
+        path = config_root / eprefix / rel_path
+        try:
+            mtimes[str(path)] = path.stat().st_mtime_ns
+        except OSError:
+            mtimes[str(path)] = None
+            continue
+        if path.is_symlink():
+            mtimes[f"{path} ->"] = os.readlink(path)
+        if path.is_dir():
+            for dir_path, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(dirs + files):
+                    try:
+                        mtimes[os.path.join(dir_path, name)] = (
+                            os.stat(os.path.join(dir_path, name)).st_mtime_ns)
+                    except OSError:
+                        pass
+    return json.dumps({
+        "env": {key: os.environ.get(key) for key in PORTAGE_CONFIG_ENV},
+        "mtimes": mtimes,
+    }, sort_keys=True)
+
+
+class PortagePaths(typing.NamedTuple):
+    distdir: Path
+    gentoo_repo: Path
+
+
+class PortageConfigCache(SQLiteCache):
+    """
+    Persistent cache of paths obtained from Portage configuration
+
+    The entries are keyed by get_portage_config_key(), so that they
+    are invalidated whenever the configuration changes.  Only the most
+    recent max_entries are kept.
+    """
+
+    version = 1
+    schema = (
+        ("CREATE TABLE portage_paths ("
+         "config_key TEXT PRIMARY KEY, "
+         "distdir TEXT NOT NULL, "
+         "gentoo_repo TEXT NOT NULL, "
+         "last_used INTEGER NOT NULL)"),
+    )
+
+    def __init__(self,
+                 path: typing.Optional[Path],
+                 max_entries: int = 8,
+                 ) -> None:
+        super().__init__(path)
+        self.max_entries = max_entries
+
+    def get(self, config_key: str) -> typing.Optional[PortagePaths]:
+        """Get cached paths for the configuration, None if not cached"""
+        row = self._db.execute(
+            "SELECT distdir, gentoo_repo FROM portage_paths "
+            "WHERE config_key = ?", (config_key,)).fetchone()
+        if row is None:
+            return None
+        return PortagePaths(*(Path(x) for x in row))
+
+    def put(self, config_key: str, paths: PortagePaths) -> None:
+        """Store paths for the configuration"""
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO portage_paths "
+                "(config_key, distdir, gentoo_repo, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (config_key, str(paths.distdir), str(paths.gentoo_repo),
+                 time.time_ns()))
+            self._db.execute(
+                "DELETE FROM portage_paths WHERE config_key NOT IN "
+                "(SELECT config_key FROM portage_paths "
+                "ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,))
+
+
+class LicenseMappingCache(SQLiteCache):
+    """
+    Persistent cache of compiled license mappings
+
+    The mappings are keyed by the SHA256 checksum of the source file
+    contents, and stored as marshalled dicts that can be loaded without
+    parsing the source again.  Only the most recent max_entries are kept.
+    """
+
+    version = 1
+    schema = (
+        ("CREATE TABLE license_mappings ("
+         "source_key TEXT PRIMARY KEY, "
+         "mapping BLOB NOT NULL, "
+         "last_used INTEGER NOT NULL)"),
+    )
+
+    def __init__(self,
+                 path: typing.Optional[Path],
+                 max_entries: int = 8,
+                 ) -> None:
+        super().__init__(path)
+        self.max_entries = max_entries
+
+    @staticmethod
+    def get_key(source: str) -> str:
+        # marshal format can change between Python versions
+        checksum = hashlib.sha256(source.encode()).hexdigest()
+        return f"{sys.implementation.cache_tag}:{checksum}"
+
+    def get(self, source: str) -> typing.Optional[typing.Dict[str, str]]:
+        """Get compiled mapping for source, None if not cached"""
+        key = self.get_key(source)
+        row = self._db.execute(
+            "SELECT mapping FROM license_mappings WHERE source_key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            mapping = marshal.loads(row[0])
+        except (EOFError, TypeError, ValueError):
+            return None
+        with self._db:
+            self._db.execute(
+                "UPDATE license_mappings SET last_used = ? "
+                "WHERE source_key = ?", (time.time_ns(), key))
+        return mapping
+
+    def put(self, source: str, mapping: typing.Dict[str, str]) -> None:
+        """Store compiled mapping for source"""
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO license_mappings "
+                "(source_key, mapping, last_used) VALUES (?, ?, ?)",
+                (self.get_key(source), marshal.dumps(mapping),
+                 time.time_ns()))
+            self._db.execute(
+                "DELETE FROM license_mappings WHERE source_key NOT IN "
+                "(SELECT source_key FROM license_mappings "
+                "ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,))
@@ -2,15 +2,22 @@
 # (c) 2022-2024 Michał Górny <mgorny@gentoo.org>
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import contextlib
 import dataclasses
 import enum
 import functools
+import io
+import itertools
+import re
 import sys
 import tarfile
 import typing
 import urllib.parse
+import weakref
 from pathlib import Path, PurePath
 
+from pycargoebuild.metrics import METRICS
+
 if sys.version_info >= (3, 11):
     import tomllib
 else:
@@ -20,11 +27,101 @@ else:
 CRATE_REGISTRY = "registry+https://github.com/rust-lang/crates.io-index"
 
 
-@dataclasses.dataclass(frozen=True)
+@contextlib.contextmanager
+def open_tarball(path: Path, mode: typing.Literal["r:gz", "r|gz"]
+                 ) -> typing.Generator[tarfile.TarFile, None, None]:
+    """
+    Open the specified tarball, counting bytes read and decompressed
+
+    The counts reflect how far the archive was actually read, e.g. when
+    reading stops as soon as the requested member is found.
+    """
+
+    with open(path, "rb") as f:
+        try:
+            with tarfile.open(fileobj=f, mode=mode) as tar:
+                try:
+                    yield tar
+                finally:
+                    assert tar.fileobj is not None
+                    METRICS.add("bytes_decompressed", tar.fileobj.tell())
+        finally:
+            METRICS.add("bytes_read", f.tell())
+
+
+def read_tarball_member(path: Path, member: PurePath) -> bytes:
+    """
+    Read the specified member from .tar.gz file
+
+    The archive is streamed, and decompression stops as soon as the member
+    is read.  If the member is not a regular file (e.g. a link), the archive
+    is reopened for random access to resolve it.
+    """
+
+    with open_tarball(path, "r|gz") as tar:
+        for tar_info in tar:
+            if PurePath(tar_info.name) != member:
+                continue
+            if tar_info.isfile():
+                tarf = tar.extractfile(tar_info)
+                assert tarf is not None
+                with tarf:
+                    return tarf.read()
+            break
+        else:
+            raise RuntimeError(f"{member} not found in {path.name}")
+
+    with open_tarball(path, "r:gz") as tar:
+        tarf = tar.extractfile(str(member))
+        if tarf is None:
+            raise RuntimeError(f"{member} not found in {path.name}")
+        with tarf:
+            return tarf.read()
+
+
+def iter_tarball_members(path: Path,
+                         ) -> typing.Generator[
+                             typing.Tuple[tarfile.TarInfo, typing.IO[bytes]],
+                             None, None]:
+    """
+    Iterate over all members of .tar.gz file, streaming their contents
+
+    Yields (tar_info, file object) pairs.  Every file object can only be
+    used until the next member is requested.  All members are expected
+    to be regular files.
+    """
+
+    with open_tarball(path, "r:gz") as tar:
+        for tar_info in tar:
+            tarf = tar.extractfile(tar_info)
+            assert tarf is not None
+            with tarf:
+                yield tar_info, tarf
+
+
+def read_tarball_members(path: Path,
+                         ) -> typing.List[typing.Tuple[tarfile.TarInfo,
+                                                       bytes]]:
+    """
+    Read all members of .tar.gz file into memory
+
+    All members are expected to be regular files.
+    """
+
+    return [(tar_info, tarf.read())
+            for tar_info, tarf in iter_tarball_members(path)]
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class Crate:
     name: str
     version: str
 
+    def __post_init__(self) -> None:
+        # the same names and versions recur across lockfiles
+        object.__setattr__(self, "name", sys.intern(self.name))
+        object.__setattr__(self, "version", sys.intern(self.version))
+
     @property
     def filename(self) -> str:
         return f"{self.name}-{self.version}.crate"
@@ -38,14 +135,37 @@ class Crate:
     def get_root_directory(self, distdir: Path) -> typing.Optional[PurePath]:
         return self.get_package_directory(distdir)
 
+    def get_cargo_toml(self, distdir: Path) -> dict:
+        """Get the parsed Cargo.toml of the package"""
+        base_dir = self.get_package_directory(distdir)
+        return tomllib.loads(
+            read_tarball_member(distdir / self.filename,
+                                base_dir / "Cargo.toml").decode())
+
     @property
     def download_url(self) -> str:
         raise NotImplementedError()
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True, init=False, repr=False)
 class FileCrate(Crate):
-    checksum: str
+    # raw SHA256 digest (empty if unknown)
+    digest: bytes
+
+    def __init__(self, name: str, version: str, checksum: str) -> None:
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "digest", bytes.fromhex(checksum))
+        Crate.__post_init__(self)
+
+    def __repr__(self) -> str:
+        return (f"FileCrate(name={self.name!r}, version={self.version!r}, "
+                f"checksum={self.checksum!r})")
+
+    @property
+    def checksum(self) -> str:
+        """SHA256 checksum as a hex string"""
+        return self.digest.hex()
 
     @property
     def download_url(self) -> str:
@@ -64,15 +184,88 @@ class GitHost(enum.Enum):
 
 
 @dataclasses.dataclass(frozen=True)
+class TarballIndex:
+    """Cargo.toml and Cargo.lock files found in a tarball"""
+
+    path: Path
+    # parsed Cargo.toml files, in archive order
+    cargo_tomls: dict[PurePath, dict]
+    # the directory containing the first Cargo.lock or workspace Cargo.toml
+    root_directory: typing.Optional[PurePath]
+
+
+# indexes are kept alive by the crates using them
+tarball_indexes: "weakref.WeakValueDictionary[Path, TarballIndex]" = (
+    weakref.WeakValueDictionary())
+
+
+def get_tarball_index(path: Path) -> TarballIndex:
+    """
+    Index Cargo.toml and Cargo.lock files in the tarball
+
+    The tarball is decompressed only once, and the index is shared by all
+    crates using the same file, for as long as any of them is alive.
+    """
+
+    index = tarball_indexes.get(path)
+    if index is None:
+        index = tarball_indexes[path] = read_tarball_index(path)
+    return index
+
+
+def read_tarball_index(path: Path) -> TarballIndex:
+    """Index Cargo.toml and Cargo.lock files in the tarball"""
+
+    cargo_tomls: dict[PurePath, dict] = {}
+    root_directory = None
+    with open_tarball(path, "r:gz") as crate_tar:
+        while (tar_info := crate_tar.next()) is not None:
+            member = PurePath(tar_info.name)
+            if member.name == "Cargo.lock":
+                if root_directory is None:
+                    root_directory = member.parent
+            elif member.name == "Cargo.toml":
+                tarf = crate_tar.extractfile(tar_info)
+                if tarf is None:
+                    continue
+                with tarf:
+                    try:
+                        # tarfile.ExFileObject() is IO[bytes] while
+                        # tomli/tomllib expects BinaryIO -- but it actually
+                        # is compatible
+                        # https://github.com/hukkin/tomli/issues/214
+                        cargo_toml = tomllib.load(tarf)  # type: ignore
+                    except tomllib.TOMLDecodeError:
+                        # not a real Cargo.toml, e.g. a cargo-generate
+                        # template
+                        continue
+                cargo_tomls[member] = cargo_toml
+                if root_directory is None and "workspace" in cargo_toml:
+                    root_directory = member.parent
+    return TarballIndex(path=path,
+                        cargo_tomls=cargo_tomls,
+                        root_directory=root_directory)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class GitCrate(Crate):
     repository: str
     commit: str
+    repo_host: GitHost = dataclasses.field(init=False, repr=False,
+                                           compare=False)
+    _tarball_index: typing.Optional[TarballIndex] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False)
+    _package_directory: typing.Optional[PurePath] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self) -> None:
-        self.repo_host  # check for supported git hosts
+        Crate.__post_init__(self)
+        object.__setattr__(self, "repository", sys.intern(self.repository))
+        object.__setattr__(self, "commit", sys.intern(self.commit))
+        # this also checks for supported git hosts
+        object.__setattr__(self, "repo_host", self.get_repo_host())
 
-    @functools.cached_property
-    def repo_host(self) -> GitHost:
+    def get_repo_host(self) -> GitHost:
         if self.repository.startswith("https://github.com/"):
             return GitHost.GITHUB
         if self.repository.startswith("https://gitlab.com/"):
@@ -114,51 +307,52 @@ class GitCrate(Crate):
     def filename(self) -> str:
         return f"{self.repo_name}-{self.commit}{self.repo_ext}.tar.gz"
 
-    @functools.cache
+    def get_tarball_index(self, distdir: Path) -> TarballIndex:
+        """Get the index of the tarball, cached in the crate"""
+        path = distdir / self.filename
+        index = self._tarball_index
+        if index is None or index.path != path:
+            index = get_tarball_index(path)
+            object.__setattr__(self, "_tarball_index", index)
+            object.__setattr__(self, "_package_directory", None)
+        return index
+
     def get_workspace_toml(self, distdir: Path) -> dict:
-        filename = self.filename
         root_dir = self.get_root_directory(distdir)
         if root_dir is None:
             return {}
-        with tarfile.open(distdir / filename, "r:gz") as crate_tar:
-            tarf = crate_tar.extractfile(str(root_dir / "Cargo.toml"))
-            if tarf is None:
-                raise RuntimeError(
-                    f"{root_dir}/Cargo.toml not found in {filename}")
-            with tarf:
-                # tarfile.ExFileObject() is IO[bytes] while tomli/tomllib
-                # expects BinaryIO -- but it actually is compatible
-                # https://github.com/hukkin/tomli/issues/214
-                return (tomllib.load(tarf).get("workspace", {})  # type: ignore
-                                          .get("package", {}))
+        tarball_index = self.get_tarball_index(distdir)
+        cargo_toml = tarball_index.cargo_tomls.get(root_dir / "Cargo.toml")
+        if cargo_toml is None:
+            raise RuntimeError(
+                f"{root_dir}/Cargo.toml not found in {self.filename}")
+        return cargo_toml.get("workspace", {}).get("package", {})
 
-    @functools.cache
     def get_package_directory(self, distdir: Path) -> PurePath:
+        tarball_index = self.get_tarball_index(distdir)
+        if self._package_directory is not None:
+            return self._package_directory
         workspace_toml = self.get_workspace_toml(distdir)
         # TODO: perhaps it'd be more correct to follow workspaces
-        with tarfile.open(distdir / self.filename, "r:gz") as crate_tar:
-            while (tar_info := crate_tar.next()) is not None:
-                path = PurePath(tar_info.name)
-                if path.name == "Cargo.toml":
-                    f = crate_tar.extractfile(tar_info)
-                    if f is None:
-                        continue
-
-                    # tarfile.ExFileObject() is IO[bytes] while tomli/tomllib
-                    # expects BinaryIO -- but it actually is compatible
-                    # https://github.com/hukkin/tomli/issues/214
-                    try:
-                        metadata = get_package_metadata(
-                            f, workspace_toml)  # type: ignore
-                    except WorkspaceCargoTomlError:
-                        continue
-                    if (metadata.name == self.name and
-                            metadata.version == self.version):
-                        return path.parent
+        for path, cargo_toml in tarball_index.cargo_tomls.items():
+            try:
+                metadata = parse_package_metadata(cargo_toml, workspace_toml,
+                                                  str(path))
+            except WorkspaceCargoTomlError:
+                continue
+            if (metadata.name == self.name and
+                    metadata.version == self.version):
+                object.__setattr__(self, "_package_directory", path.parent)
+                return path.parent
 
         raise RuntimeError(f"Package {self.name} not found in crate "
                            f"{distdir / self.filename}")
 
+    def get_cargo_toml(self, distdir: Path) -> dict:
+        base_dir = self.get_package_directory(distdir)
+        return self.get_tarball_index(distdir).cargo_tomls[
+            base_dir / "Cargo.toml"]
+
     def get_git_crate_entry(self, distdir: Path) -> str:
         subdir = (str(self.get_package_directory(distdir))
                   .replace(self.commit, "%commit%"))
@@ -171,21 +365,9 @@ class GitCrate(Crate):
             case _ as host:
                 typing.assert_never(host)
 
-    @functools.cache
     def get_root_directory(self, distdir: Path) -> typing.Optional[PurePath]:
         """Get the directory containing Cargo.lock"""
-        with tarfile.open(distdir / self.filename, "r:gz") as crate_tar:
-            while (tar_info := crate_tar.next()) is not None:
-                path = PurePath(tar_info.name)
-                if path.name == "Cargo.lock":
-                    return path.parent
-                if path.name == "Cargo.toml":
-                    tarf = crate_tar.extractfile(tar_info)
-                    assert tarf is not None
-                    with tarf:
-                        if "workspace" in tomllib.load(tarf):  # type: ignore
-                            return path.parent
-        return None
+        return self.get_tarball_index(distdir).root_directory
 
 
 class PackageMetadata(typing.NamedTuple):
@@ -223,50 +405,224 @@ def cargo_to_spdx(license_str: str) -> str:
     return license_str.replace("/", " OR ")
 
 
-def get_crates(f: typing.BinaryIO) -> typing.Generator[Crate, None, None]:
-    """Read crate list from the open ``Cargo.lock`` file"""
-    cargo_lock = tomllib.load(f)
-    lock_version = cargo_lock.get("version", None)
+def get_lock_crate(p: dict,
+                   lock_version: typing.Optional[int],
+                   lock_metadata: dict,
+                   ) -> typing.Optional[Crate]:
+    """
+    Get the crate corresponding to a [[package]] entry from ``Cargo.lock``
+
+    Returns None for local crates.  lock_metadata is the [metadata] table,
+    used to get checksums from version 1 lockfiles.
+    """
+
+    # Skip all crates without "source", they should be local.
+    if "source" not in p:
+        return None
+
+    try:
+        if p["source"] == CRATE_REGISTRY:
+            if lock_version is None:
+                checksum = lock_metadata[
+                    f"checksum {p['name']} {p['version']} "
+                    f"({p['source']})"]
+            else:
+                checksum = p["checksum"]
+            try:
+                return FileCrate(name=p["name"],
+                                 version=p["version"],
+                                 checksum=checksum)
+            except ValueError as e:
+                raise RuntimeError(
+                    f"Invalid checksum for crate: {p!r}") from e
+        elif p["source"].startswith("git+"):
+            parsed_url = urllib.parse.urlsplit(p["source"])
+            if not parsed_url.fragment:
+                raise RuntimeError(
+                    "Git crate with no fragment identifier (i.e. commit "
+                    f"identifier): {p['source']!r}")
+            repo = parsed_url.path.strip("/").removesuffix(".git")
+            if repo.count("/") != 1:
+                raise RuntimeError("Invalid GitHub/GitLab URL: "
+                                   f"{p['source']}")
+            return GitCrate(
+                name=p["name"],
+                version=p["version"],
+                repository=f"https://{parsed_url.netloc}/{repo}",
+                commit=parsed_url.fragment)
+        else:
+            raise RuntimeError(f"Unsupported crate source: {p['source']}")
+    except KeyError as e:
+        raise RuntimeError("Incorrect/insufficient metadata for crate: "
+                           f"{p!r}") from e
+
+
+def check_lock_version(lock_version: typing.Any) -> None:
     if lock_version not in (None, 3, 4):
         raise NotImplementedError(
-            f"Cargo.lock version '{cargo_lock['version']} unsupported")
+            f"Cargo.lock version '{lock_version} unsupported")
+
+
+class UnsupportedLockFormat(Exception):
+    """Cargo.lock uses formatting not supported by the streaming reader"""
+
+
+_WS = r"[ \t]*"
+_KEY = r"([A-Za-z0-9_-]+)"
+_STRING = r'"([^"\\\x00-\x08\x0a-\x1f\x7f]*)"'
+LOCK_IGNORED_RE = re.compile(rf"{_WS}(?:#[^\x00-\x08\x0a-\x1f\x7f]*)?")
+LOCK_TABLE_RE = re.compile(
+    rf"{_WS}(\[\[?){_WS}([A-Za-z0-9_.-]+){_WS}(\]\]?){_WS}")
+LOCK_STRING_RE = re.compile(
+    rf"{_WS}(?:{_KEY}|{_STRING}){_WS}={_WS}{_STRING}{_WS}")
+LOCK_INTEGER_RE = re.compile(rf"{_WS}{_KEY}{_WS}={_WS}(0|[1-9][0-9]*){_WS}")
+LOCK_ARRAY_START_RE = re.compile(rf"{_WS}{_KEY}{_WS}={_WS}\[{_WS}")
+LOCK_ARRAY_ITEM_RE = re.compile(rf"{_WS}{_STRING}{_WS}(,?){_WS}")
+LOCK_ARRAY_END_RE = re.compile(rf"{_WS}\]{_WS}")
 
-    for p in cargo_lock["package"]:
-        # Skip all crates without "source", they should be local.
-        if "source" not in p:
-            continue
+# tables (other than [[package]] and [metadata]) that are known to occur
+# in Cargo.lock, and are skipped by the streaming reader
+LOCK_SKIPPED_TABLES = frozenset(["patch.unused"])
 
+
+def stream_lock_crates(f: typing.BinaryIO
+                       ) -> typing.Generator[Crate, None, None]:
+    """
+    Read crates from Cargo.lock using a line-oriented reader
+
+    Only the regular layout of Cargo.lock is supported, i.e. [[package]]
+    tables containing basic strings and arrays of basic strings,
+    and the [metadata] table.  UnsupportedLockFormat is raised if any
+    other construct is found.  Crates are yielded as soon as their
+    [[package]] table is complete, except for version 1 lockfiles that
+    store checksums in [metadata] at the end of the file.
+    """
+
+    lock_version: typing.Optional[int] = None
+    # None = root table
+    table: typing.Optional[str] = None
+    current: dict = {}
+    seen_tables: typing.Set[str] = set()
+    seen_packages = False
+    # packages awaiting [metadata], for version 1 lockfiles
+    pending: typing.List[dict] = []
+    lock_metadata: typing.Dict[str, str] = {}
+    array_key: typing.Optional[str] = None
+    array: typing.List[str] = []
+    expect_comma = False
+
+    def finish_table() -> typing.Optional[Crate]:
+        if table != "package":
+            return None
+        if lock_version is None:
+            pending.append(current)
+            return None
+        return get_lock_crate(current, lock_version, lock_metadata)
+
+    def set_key(key: str, value: typing.Any) -> None:
+        target = lock_metadata if table == "metadata" else current
+        if key in target:
+            raise UnsupportedLockFormat(f"Duplicate key: {key!r}")
+        target[key] = value
+
+    for raw_line in f:
         try:
-            if p["source"] == CRATE_REGISTRY:
-                if lock_version is None:
-                    checksum = cargo_lock["metadata"][
-                        f"checksum {p['name']} {p['version']} "
-                        f"({p['source']})"]
-                else:
-                    checksum = p["checksum"]
-                yield FileCrate(name=p["name"],
-                                version=p["version"],
-                                checksum=checksum)
-            elif p["source"].startswith("git+"):
-                parsed_url = urllib.parse.urlsplit(p["source"])
-                if not parsed_url.fragment:
-                    raise RuntimeError(
-                        "Git crate with no fragment identifier (i.e. commit "
-                        f"identifier): {p['source']!r}")
-                repo = parsed_url.path.strip("/").removesuffix(".git")
-                if repo.count("/") != 1:
-                    raise RuntimeError("Invalid GitHub/GitLab URL: "
-                                       f"{p['source']}")
-                yield GitCrate(
-                    name=p["name"],
-                    version=p["version"],
-                    repository=f"https://{parsed_url.netloc}/{repo}",
-                    commit=parsed_url.fragment)
-            else:
-                raise RuntimeError(f"Unsupported crate source: {p['source']}")
-        except KeyError as e:
-            raise RuntimeError("Incorrect/insufficient metadata for crate: "
-                               f"{p!r}") from e
+            line = raw_line.decode("utf-8").removesuffix("\n")
+        except UnicodeDecodeError as e:
+            raise UnsupportedLockFormat(str(e)) from e
+        line = line.removesuffix("\r")
+
+        if array_key is not None:
+            if m := LOCK_ARRAY_ITEM_RE.fullmatch(line):
+                if expect_comma:
+                    raise UnsupportedLockFormat("Missing comma in array")
+                array.append(m.group(1))
+                expect_comma = not m.group(2)
+            elif LOCK_ARRAY_END_RE.fullmatch(line):
+                set_key(array_key, array)
+                array_key = None
+            elif not LOCK_IGNORED_RE.fullmatch(line):
+                raise UnsupportedLockFormat(f"Unsupported line: {line!r}")
+        elif LOCK_IGNORED_RE.fullmatch(line):
+            pass
+        elif m := LOCK_TABLE_RE.fullmatch(line):
+            is_array = m.group(1) == "[["
+            if len(m.group(1)) != len(m.group(3)):
+                raise UnsupportedLockFormat(f"Invalid header: {line!r}")
+            name = m.group(2)
+            if crate := finish_table():
+                yield crate
+            if is_array and name == "package":
+                seen_packages = True
+            elif not is_array and name == "metadata":
+                if name in seen_tables:
+                    raise UnsupportedLockFormat("Duplicate [metadata]")
+            elif not is_array or name not in LOCK_SKIPPED_TABLES:
+                raise UnsupportedLockFormat(f"Unsupported table: {line!r}")
+            seen_tables.add(name)
+            table = name
+            current = {}
+        elif table is None:
+            m = LOCK_INTEGER_RE.fullmatch(line)
+            if (m is None or m.group(1) != "version" or
+                    lock_version is not None):
+                raise UnsupportedLockFormat(f"Unsupported line: {line!r}")
+            lock_version = int(m.group(2))
+            check_lock_version(lock_version)
+        elif m := LOCK_STRING_RE.fullmatch(line):
+            if (m.group(1) is None) != (table == "metadata"):
+                raise UnsupportedLockFormat(f"Unsupported key: {line!r}")
+            set_key(m.group(1) or m.group(2), m.group(3))
+        elif ((m := LOCK_ARRAY_START_RE.fullmatch(line)) and
+              table != "metadata"):
+            array_key = m.group(1)
+            array = []
+            expect_comma = False
+        else:
+            raise UnsupportedLockFormat(f"Unsupported line: {line!r}")
+
+    if array_key is not None:
+        raise UnsupportedLockFormat("Unterminated array")
+    if not seen_packages:
+        raise UnsupportedLockFormat("No [[package]] found")
+    if crate := finish_table():
+        yield crate
+    for p in pending:
+        if crate := get_lock_crate(p, lock_version, lock_metadata):
+            yield crate
+
+
+def get_crates(f: typing.BinaryIO) -> typing.Generator[Crate, None, None]:
+    """
+    Read crate list from the open ``Cargo.lock`` file
+
+    The regular layout written by Cargo is read line-by-line, and crates
+    are yielded while reading.  If the file uses any other formatting,
+    it is parsed using tomllib instead.
+    """
+
+    if not f.seekable():
+        f = io.BytesIO(f.read())
+    start = f.tell()
+    yielded = 0
+    try:
+        for crate in stream_lock_crates(f):
+            yield crate
+            yielded += 1
+        return
+    except UnsupportedLockFormat:
+        pass
+
+    f.seek(start)
+    cargo_lock = tomllib.load(f)
+    lock_version = cargo_lock.get("version", None)
+    check_lock_version(lock_version)
+    # skip crates that were yielded by the streaming reader already
+    crates = (get_lock_crate(p, lock_version,
+                             cargo_lock.get("metadata", {}))
+              for p in cargo_lock["package"])
+    yield from itertools.islice(
+        (crate for crate in crates if crate is not None), yielded, None)
 
 
 def get_meta_key(key: str, pkg_meta: dict,
@@ -285,8 +641,15 @@ def get_package_metadata(f: typing.BinaryIO,
                          workspace_pkg_meta: dict = {},
                          ) -> PackageMetadata:
     """Read package from the open ``Cargo.toml`` file"""
-    cargo_toml = tomllib.load(f)
+    return parse_package_metadata(tomllib.load(f), workspace_pkg_meta,
+                                  getattr(f, "name", "Cargo.toml"))
+
 
+def parse_package_metadata(cargo_toml: dict,
+                           workspace_pkg_meta: dict = {},
+                           path: str = "Cargo.toml",
+                           ) -> PackageMetadata:
+    """Read package from the parsed ``Cargo.toml`` data"""
     if "package" not in cargo_toml and "workspace" in cargo_toml:
         raise WorkspaceCargoTomlError(
             cargo_toml["workspace"]["members"])
@@ -302,9 +665,10 @@ def get_package_metadata(f: typing.BinaryIO,
 
     pkg_version = _get_meta_key("version")
     if pkg_version is None:
-        raise ValueError(f"No version found in {f.name}")
+        raise ValueError(f"No version found in {path}")
 
-    features = cargo_toml.get("features", {})
+    # copy the dict, as the parsed data may be shared
+    features = dict(cargo_toml.get("features", {}))
     default_features = features.pop("default", [])
 
     return PackageMetadata(
@@ -0,0 +1,222 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import collections
+import concurrent.futures
+import io
+import lzma
+import os
+import sys
+import typing
+
+# dictionary sizes and compressor memory usage (in MiB) for xz presets 0..9
+XZ_DICT_SIZES_MIB = (0.25, 1, 2, 4, 4, 8, 8, 16, 32, 64)
+XZ_MEMORY_USAGE_MIB = (3, 9, 17, 32, 48, 94, 94, 186, 370, 674)
+DEFAULT_XZ_PRESET = "9e"
+DEFAULT_ZSTD_LEVEL = 19
+
+MiB = 1024 * 1024
+
+
+class CompressionError(RuntimeError):
+    pass
+
+
+def parse_xz_preset(preset: str) -> int:
+    """Convert xz(1)-style preset string (e.g. "9e") to lzma preset"""
+    level = preset.removesuffix("e")
+    if level not in [str(x) for x in range(10)]:
+        raise CompressionError(f"Invalid xz preset: {preset!r}")
+    if level != preset:
+        return int(level) | lzma.PRESET_EXTREME
+    return int(level)
+
+
+def parse_zstd_level(preset: str) -> int:
+    """Convert zstd level string to an integer"""
+    if preset not in [str(x) for x in range(1, 23)]:
+        raise CompressionError(f"Invalid zstd level: {preset!r}")
+    return int(preset)
+
+
+def check_preset(compression: str, preset: str) -> None:
+    """
+    Check whether preset is valid for the specified compression
+
+    Raises CompressionError if it is not.
+    """
+
+    if compression == "xz":
+        parse_xz_preset(preset)
+    elif compression == "zstd":
+        parse_zstd_level(preset)
+    else:
+        raise CompressionError(f"Unsupported compression: {compression!r}")
+
+
+def get_physical_memory() -> typing.Optional[int]:
+    """Get the amount of physical memory, if it can be determined"""
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class ParallelXZWriter(io.RawIOBase):
+    """
+    Writable file object compressing data into .xz format using multiple
+    threads
+
+    The input is split into blocks of fixed size that are compressed
+    as independent .xz streams in parallel, and written out in order.
+    Concatenated .xz streams form a valid .xz file that can be read
+    by xz(1) and tar(1).  Since the block size does not depend
+    on the number of threads, the output is deterministic.
+
+    At most jobs blocks are compressed at a time, and the number of jobs
+    is reduced if the blocks being compressed, along with the block being
+    filled, would not fit in 1/4 of physical memory.  The underlying file
+    object is not closed.
+    """
+
+    def __init__(self,
+                 fileobj: typing.IO[bytes],
+                 *,
+                 preset: int,
+                 jobs: int = 1,
+                 block_size: typing.Optional[int] = None,
+                 ) -> None:
+        super().__init__()
+        level = preset & ~lzma.PRESET_EXTREME
+        if block_size is None:
+            # use the same block size as xz(1) does
+            block_size = max(MiB, int(3 * XZ_DICT_SIZES_MIB[level] * MiB))
+        # limit the number of threads to fit in 1/4 of memory, like xz(1)
+        memory = get_physical_memory()
+        if memory is not None:
+            # encoder, input block and (at most) equally sized output
+            thread_memory = XZ_MEMORY_USAGE_MIB[level] * MiB + 2 * block_size
+            # plus the block being filled
+            jobs = max(1, min(jobs,
+                              (memory // 4 - block_size) // thread_memory))
+
+        self.fileobj = fileobj
+        self.preset = preset
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs)
+        self._max_pending = jobs
+        self._pending: typing.Deque[concurrent.futures.Future[bytes]] = (
+            collections.deque())
+
+    def writable(self) -> bool:
+        return True
+
+    def _compress(self, data: bytearray) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_XZ,
+                             check=lzma.CHECK_CRC64, preset=self.preset)
+
+    def _submit(self, data: bytearray) -> None:
+        while len(self._pending) >= self._max_pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self._pending.append(self._executor.submit(self._compress, data))
+
+    def write(self, data: typing.Any) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            # hand the buffer over rather than copying the block
+            block = self._buffer
+            self._buffer = block[self.block_size:]
+            del block[self.block_size:]
+            self._submit(block)
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._pending:
+                self._submit(self._buffer)
+                self._buffer = bytearray()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
+            super().close()
+
+
+def open_zstd_writer(fileobj: typing.IO[bytes],
+                     *,
+                     level: int,
+                     jobs: int = 1,
+                     ) -> typing.BinaryIO:
+    """
+    Open a writable file object compressing data into .zst format
+
+    Uses compression.zstd on Python 3.14+, and the zstandard package
+    otherwise.  The underlying file object is not closed.
+    """
+
+    if sys.version_info >= (3, 14):
+        from compression import zstd
+
+        options = {zstd.CompressionParameter.compression_level: level}
+        if jobs > 1:
+            options[zstd.CompressionParameter.nb_workers] = jobs
+        return typing.cast("typing.BinaryIO",
+                           zstd.ZstdFile(fileobj, "w", options=options))
+
+    try:
+        import zstandard
+    except ImportError as e:
+        raise CompressionError(
+            "zstd compression requires Python 3.14 or the zstandard "
+            "package") from e
+    return typing.cast(
+        "typing.BinaryIO",
+        zstandard.ZstdCompressor(level=level,
+                                 threads=jobs if jobs > 1 else 0,
+                                 ).stream_writer(fileobj, closefd=False))
+
+
+def get_compression(path: str) -> str:
+    """Get the compression to use for the tarball at path"""
+    if path.endswith(".zst"):
+        return "zstd"
+    return "xz"
+
+
+def open_compressed_writer(fileobj: typing.IO[bytes],
+                           compression: str,
+                           *,
+                           preset: typing.Optional[str] = None,
+                           jobs: int = 1,
+                           ) -> typing.BinaryIO:
+    """
+    Open a writable file object compressing data using specified compression
+
+    compression can be either "xz" or "zstd".  preset is an xz(1)-style
+    preset (e.g. "9e") or a zstd level, respectively.  If not specified,
+    DEFAULT_XZ_PRESET or DEFAULT_ZSTD_LEVEL is used.  If jobs is larger
+    than 1, xz data is compressed in parallel, into multiple streams.
+    Otherwise, a single stream is written.
+    """
+
+    if compression == "xz":
+        xz_preset = parse_xz_preset(preset or DEFAULT_XZ_PRESET)
+        if jobs > 1:
+            return typing.cast("typing.BinaryIO", ParallelXZWriter(
+                fileobj, preset=xz_preset, jobs=jobs))
+        # LZMAFile does not close file objects passed to it
+        return typing.cast("typing.BinaryIO", lzma.LZMAFile(
+            fileobj, "w", format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64,
+            preset=xz_preset))
+    if compression == "zstd":
+        level = (parse_zstd_level(preset) if preset is not None
+                 else DEFAULT_ZSTD_LEVEL)
+        return open_zstd_writer(fileobj, level=level, jobs=jobs)
+    raise CompressionError(f"Unsupported compression: {compression!r}")
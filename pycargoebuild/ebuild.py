@@ -2,29 +2,35 @@
 # (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import concurrent.futures
 import datetime
+import itertools
 import logging
 import re
 import shlex
-import tarfile
+import time
 import typing
 import urllib.parse
 from functools import partial
 from pathlib import Path
 
-import jinja2
-import license_expression
-
 from pycargoebuild import __version__
+from pycargoebuild.cache import MetadataCache
 from pycargoebuild.cargo import (
     Crate,
     FileCrate,
     GitCrate,
     PackageMetadata,
-    get_package_metadata,
+    parse_package_metadata,
 )
 from pycargoebuild.format import format_license_var
-from pycargoebuild.license import UnmatchedLicense, spdx_to_ebuild
+from pycargoebuild.license import (
+    UnmatchedLicense,
+    combine_licenses,
+    parse_license,
+    spdx_to_ebuild,
+)
+from pycargoebuild.metrics import METRICS
 
 EBUILD_TEMPLATE = """\
 # Copyright {{year}} Gentoo Authors
@@ -119,65 +125,179 @@ def get_GIT_CRATES(crates: typing.Iterable[Crate],
     return ""
 
 
+@METRICS.timed("license resolution")
 def get_package_LICENSE(license_str: typing.Optional[str]) -> str:
     """
     Get the value of package's LICENSE string
     """
 
-    spdx = license_expression.get_spdx_licensing()
     if license_str is not None:
-        parsed_pkg_license = spdx.parse(license_str, strict=True).simplify()
-        return format_license_var(spdx_to_ebuild(parsed_pkg_license),
-                                  prefix='LICENSE="')
+        parsed_pkg_license = parse_license(license_str)
+        if parsed_pkg_license is not None:
+            return format_license_var(
+                spdx_to_ebuild(parsed_pkg_license.simplify()),
+                prefix='LICENSE="')
     return ""
 
 
+def read_crate_metadata(crate: Crate, distdir: Path) -> PackageMetadata:
+    """
+    Read the metadata from specified crate
+    """
+
+    return parse_package_metadata(
+        crate.get_cargo_toml(distdir),
+        crate.get_workspace_toml(distdir),
+        f"{crate.filename}/{crate.get_package_directory(distdir)}/Cargo.toml")
+
+
+def timed_read_crate_metadata(crate: Crate, distdir: Path
+                              ) -> typing.Tuple[PackageMetadata, float]:
+    """
+    Read the metadata from specified crate, returning it with time spent
+    """
+
+    start = time.perf_counter()
+    ret = read_crate_metadata(crate, distdir)
+    return ret, time.perf_counter() - start
+
+
+def timed_read_crate_metadata_worker(
+        crate: Crate,
+        distdir: Path,
+        ) -> typing.Tuple[PackageMetadata, float, typing.Dict[str, int]]:
+    """
+    timed_read_crate_metadata() for worker processes, additionally
+    returning the counter increments
+    """
+
+    with METRICS.collect_counters() as counters:
+        ret, seconds = timed_read_crate_metadata(crate, distdir)
+    return ret, seconds, counters
+
+
+def get_crate_metadata(crate: Crate,
+                       distdir: Path,
+                       metadata_cache: typing.Optional[MetadataCache] = None,
+                       ) -> PackageMetadata:
+    """
+    Read the metadata from specified crate, using the cache if available
+    """
+
+    return get_crates_metadata([crate], distdir, metadata_cache)[crate]
+
+
+@METRICS.timed("metadata extraction")
+def get_crates_metadata(crates: typing.Iterable[Crate],
+                        distdir: Path,
+                        metadata_cache: typing.Optional[MetadataCache] = None,
+                        jobs: int = 1,
+                        ) -> typing.Dict[Crate, PackageMetadata]:
+    """
+    Read the metadata from specified crates, using the cache if available
+
+    If jobs is larger than 1, the metadata of registry crates is read
+    in parallel using a process pool.  Git crates are always processed
+    in the current process, as they commonly share a single tarball.
+    """
+
+    ret: typing.Dict[Crate, PackageMetadata] = {}
+    file_crates: typing.List[FileCrate] = []
+    git_crates: typing.List[Crate] = []
+    for crate in crates:
+        if isinstance(crate, FileCrate):
+            if metadata_cache is not None:
+                crate_metadata = metadata_cache.get(crate)
+                if crate_metadata is not None:
+                    ret[crate] = crate_metadata
+                    continue
+            file_crates.append(crate)
+        else:
+            git_crates.append(crate)
+
+    if jobs > 1 and len(file_crates) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(jobs, len(file_crates))) as executor:
+            file_crates_metadata = []
+            for crate_metadata, seconds, counters in executor.map(
+                    timed_read_crate_metadata_worker,
+                    file_crates,
+                    itertools.repeat(distdir),
+                    chunksize=max(1, len(file_crates) // (jobs * 4))):
+                # counters are not shared with worker processes
+                METRICS.add_counters(counters)
+                file_crates_metadata.append((crate_metadata, seconds))
+    else:
+        file_crates_metadata = [timed_read_crate_metadata(crate, distdir)
+                                for crate in file_crates]
+
+    for crate, (crate_metadata, seconds) in zip(file_crates,
+                                                file_crates_metadata):
+        METRICS.add_crate_time("metadata", crate.filename, seconds)
+        if metadata_cache is not None:
+            metadata_cache.put(crate, crate_metadata)
+        ret[crate] = crate_metadata
+    for crate in git_crates:
+        ret[crate], seconds = timed_read_crate_metadata(crate, distdir)
+        METRICS.add_crate_time("metadata", crate.filename, seconds)
+    return ret
+
+
+def get_license_from_metadata(crate: Crate,
+                              distdir: Path,
+                              crate_metadata: PackageMetadata,
+                              ) -> typing.Optional[str]:
+    """
+    Return the license string from crate metadata, warning if it is missing
+    """
+
+    filename = crate.filename
+    base_dir = crate.get_package_directory(distdir)
+    if crate_metadata.license_file is not None:
+        logging.warning(
+            f"Crate {filename!r} (in {str(base_dir)!r}) uses "
+            f"license-file={crate_metadata.license_file!r}, please "
+            "inspect the license manually and add it *separately* "
+            "from crate licenses")
+    elif crate_metadata.license is None:
+        logging.warning(
+            f"Crate {filename!r} (in {str(base_dir)!r}, "
+            f"name={crate_metadata.name!r}) does not specify "
+            "a license!")
+    return crate_metadata.license
+
+
 def get_license_from_crate(crate: Crate,
                            distdir: Path,
+                           metadata_cache: typing.Optional[
+                               MetadataCache] = None,
                            ) -> typing.Optional[str]:
     """
     Read the metadata from specified crate and return its license string
     """
 
-    filename = crate.filename
-    base_dir = crate.get_package_directory(distdir)
-    workspace_toml = crate.get_workspace_toml(distdir)
-    with tarfile.open(distdir / filename, "r:gz") as crate_tar:
-        tarf = crate_tar.extractfile(str(base_dir / "Cargo.toml"))
-        if tarf is None:
-            raise RuntimeError(
-                f"{base_dir}/Cargo.toml not found in {filename}")
-        with tarf:
-            # tarfile.ExFileObject() is IO[bytes] while tomli/tomllib
-            # expects BinaryIO -- but it actually is compatible
-            # https://github.com/hukkin/tomli/issues/214
-            crate_metadata = get_package_metadata(
-                tarf, workspace_toml)  # type: ignore
-            if crate_metadata.license_file is not None:
-                logging.warning(
-                    f"Crate {filename!r} (in {str(base_dir)!r}) uses "
-                    f"license-file={crate_metadata.license_file!r}, please "
-                    "inspect the license manually and add it *separately* "
-                    "from crate licenses")
-            elif crate_metadata.license is None:
-                logging.warning(
-                    f"Crate {filename!r} (in {str(base_dir)!r}, "
-                    f"name={crate_metadata.name!r}) does not specify "
-                    "a license!")
-            return crate_metadata.license
+    return get_license_from_metadata(
+        crate, distdir, get_crate_metadata(crate, distdir, metadata_cache))
 
 
+@METRICS.timed("license resolution")
 def get_crate_LICENSE(crates: typing.Iterable[Crate],
                       distdir: Path,
                       license_overrides: typing.Dict[str, str] = {},
+                      metadata_cache: typing.Optional[MetadataCache] = None,
+                      jobs: int = 1,
                       ) -> str:
     """
     Get the value of LICENSE string for crates
     """
 
-    spdx = license_expression.get_spdx_licensing()
+    crates = list(crates)
+    crates_metadata = get_crates_metadata(
+        (crate for crate in crates if crate.name not in license_overrides),
+        distdir, metadata_cache, jobs)
     crate_licenses = {
-        crate.filename: get_license_from_crate(crate, distdir)
+        crate.filename:
+        get_license_from_metadata(crate, distdir, crates_metadata[crate])
         if crate.name not in license_overrides
         else license_overrides[crate.name]
         for crate in crates
@@ -186,21 +306,27 @@ def get_crate_LICENSE(crates: typing.Iterable[Crate],
     crate_licenses_set.discard(None)
 
     # combine crate licenses and simplify the result
-    combined_license = " AND ".join(f"( {x} )" for x in crate_licenses_set)
-    parsed_license = spdx.parse(combined_license, strict=True)
-    if parsed_license is None:
+    final_license = combine_licenses(
+        parsed for parsed in map(parse_license, crate_licenses_set)
+        if parsed is not None)
+    if final_license is None:
         return ""
-    final_license = parsed_license.simplify()
     try:
         crate_licenses_str = format_license_var(spdx_to_ebuild(final_license),
                                                 prefix='LICENSE+=" ')
     except UnmatchedLicense as e:
         # find the crate using that license
+        symbol_crates: typing.Dict[str, typing.List[str]] = {}
         for crate_name, crate_license in crate_licenses.items():
-            parsed_license = spdx.parse(crate_license, strict=True)
+            parsed_license = (parse_license(crate_license)
+                              if crate_license is not None else None)
             if parsed_license is not None:
-                if e.license_key in (str(x) for x in parsed_license.symbols):
-                    raise UnmatchedLicense(e.license_key, crate_name)
+                for symbol in parsed_license.symbols:
+                    symbol_crates.setdefault(str(symbol), []).append(
+                        crate_name)
+        if e.license_key in symbol_crates:
+            raise UnmatchedLicense(e.license_key,
+                                   symbol_crates[e.license_key][0])
         raise AssertionError("Unable to match unmatched license to a crate")
     # if it's not a multiline string, we need to prepend " "
     if not crate_licenses_str.startswith("\n"):
@@ -228,6 +354,7 @@ def url_dquote_escape(value: str) -> str:
         lambda x: urllib.parse.quote_plus(x.group(0)), value)
 
 
+@METRICS.timed("rendering")
 def get_ebuild(pkg_meta: PackageMetadata,
                crates: typing.Iterable[Crate],
                distdir: Path,
@@ -236,11 +363,15 @@ def get_ebuild(pkg_meta: PackageMetadata,
                crate_tarball: typing.Optional[Path] = None,
                license_overrides: typing.Dict[str, str] = {},
                use_features: bool = False,
+               metadata_cache: typing.Optional[MetadataCache] = None,
+               jobs: int = 1,
                ) -> str:
     """
     Get ebuild contents for passed contents of Cargo.toml and Cargo.lock.
     """
 
+    import jinja2
+
     jinja_env = jinja2.Environment(keep_trailing_newline=True,
                                    trim_blocks=True)
     template = EBUILD_TEMPLATE
@@ -248,7 +379,8 @@ def get_ebuild(pkg_meta: PackageMetadata,
 
     return compiled_template.render(
         crates=get_CRATES(crates if crate_tarball is None else ()),
-        crate_licenses=(get_crate_LICENSE(crates, distdir, license_overrides)
+        crate_licenses=(get_crate_LICENSE(crates, distdir, license_overrides,
+                                          metadata_cache, jobs)
                         if crate_license else None),
         description=bash_dquote_escape(collapse_whitespace(
             pkg_meta.description or "")),
@@ -307,6 +439,7 @@ class GitCratesSubst(CountingSubst):
         return ""
 
 
+@METRICS.timed("rendering")
 def update_ebuild(ebuild: str,
                   pkg_meta: PackageMetadata,
                   crates: typing.Iterable[Crate],
@@ -315,6 +448,8 @@ def update_ebuild(ebuild: str,
                   crate_license: bool = True,
                   crate_tarball: typing.Optional[Path] = None,
                   license_overrides: typing.Dict[str, str] = {},
+                  metadata_cache: typing.Optional[MetadataCache] = None,
+                  jobs: int = 1,
                   ) -> str:
     """
     Update the CRATES, GIT_CRATES and LICENSE in an existing ebuild
@@ -325,7 +460,7 @@ def update_ebuild(ebuild: str,
     git_crates_repl = GitCratesSubst(partial(get_GIT_CRATES, crates, distdir))
     crate_license_repl = (
         CountingSubst(partial(get_crate_LICENSE, crates, distdir,
-                              license_overrides)))
+                              license_overrides, metadata_cache, jobs)))
 
     for regex, repl in ((CRATES_RE, crates_repl),
                         (GIT_CRATES_RE, git_crates_repl),
@@ -346,3 +481,32 @@ def update_ebuild(ebuild: str,
         git_crates_repl.assert_count("GIT_CRATES=", 1)
 
     return ebuild
+
+
+def get_ebuild_CRATES(ebuild: str) -> typing.Set[str]:
+    """
+    Get the set of entries in CRATES of an existing ebuild
+    """
+
+    match = CRATES_RE.search(ebuild)
+    if match is None:
+        raise RuntimeError("CRATES= not found in the ebuild")
+    return set(match.group(0)[len(match.group("start")):-1].split())
+
+
+def get_unchanged_crates(ebuild: str,
+                         crates: typing.Iterable[Crate],
+                         ) -> typing.FrozenSet[FileCrate]:
+    """
+    Get crates that are listed in CRATES of an existing ebuild already
+
+    Both the current name@version and the legacy name-version entries
+    are recognized.
+    """
+
+    old_entries = get_ebuild_CRATES(ebuild)
+    return frozenset(
+        crate for crate in crates
+        if isinstance(crate, FileCrate) and (
+            crate.crate_entry in old_entries or
+            f"{crate.name}-{crate.version}" in old_entries))
@@ -2,14 +2,48 @@
 # (c) 2022-2024 Michał Górny <mgorny@gentoo.org>
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
 import hashlib
+import itertools
+import logging
+import os
+import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import typing
+import urllib.parse
 from pathlib import Path
 
-from pycargoebuild.cargo import Crate, FileCrate
+from pycargoebuild import __version__
+from pycargoebuild.cache import FileStat, VerificationCache
+from pycargoebuild.cargo import Crate, FileCrate, GitCrate
+from pycargoebuild.metrics import METRICS
+
+if typing.TYPE_CHECKING:
+    import http.client
+
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_RETRIES = 4
+DEFAULT_RETRY_DELAY = 1.0
+# from linux/fs.h
+FICLONE = 0x40049409
+HTTP_BUFFER_SIZE = 128 * 1024
+HTTP_REDIRECTS = (301, 302, 303, 307, 308)
+# HTTP statuses indicating a temporary failure
+HTTP_TRANSIENT = (408, 429, 500, 502, 503, 504)
+HTTP_TIMEOUT = 60
+MAX_REDIRECTS = 10
+PARALLEL_VERIFY_MIN_FILES = 16
+USER_AGENT = f"pycargoebuild/{__version__}"
+
+# a single URL or a list of URLs to try in order
+URLList = typing.Union[str, typing.List[str]]
 
 
 class ChecksumMismatchError(RuntimeError):
@@ -26,79 +60,886 @@ class ChecksumMismatchError(RuntimeError):
         self.expected = expected
 
 
-def fetch_crates_using_aria2(crates: typing.Iterable[Crate], *, distdir: Path
+class MultipleChecksumMismatchError(ChecksumMismatchError):
+    """
+    Checksums of multiple files do not match
+
+    The path, current and expected attributes refer to the first mismatch,
+    while errors contains all of them.
+    """
+
+    def __init__(self, errors: typing.List[ChecksumMismatchError]) -> None:
+        first = errors[0]
+        super().__init__(first.path, first.current, first.expected)
+        self.args = ("\n".join(str(e) for e in errors),)
+        self.errors = errors
+
+
+class FetchError(RuntimeError):
+    def __init__(self,
+                 url: str,
+                 reason: str,
+                 *,
+                 transient: bool = False,
+                 ) -> None:
+        super().__init__(f"Fetching {url} failed: {reason}")
+        self.url = url
+        self.reason = reason
+        # whether the failure is likely temporary, and worth retrying
+        self.transient = transient
+
+
+class MultipleFetchError(FetchError):
+    """
+    Fetching multiple files failed
+
+    The url and reason attributes refer to the first failure, while errors
+    contains all of them.
+    """
+
+    def __init__(self, errors: typing.List[FetchError]) -> None:
+        first = errors[0]
+        super().__init__(first.url, first.reason)
+        self.args = ("\n".join(str(e) for e in errors),)
+        self.errors = errors
+
+
+def raise_fetch_errors(errors: typing.List[FetchError]) -> None:
+    """Raise FetchError (or MultipleFetchError) if errors is not empty"""
+    if len(errors) == 1:
+        raise errors[0]
+    if errors:
+        raise MultipleFetchError(errors)
+
+
+@contextlib.contextmanager
+def aggregate_fetch_errors(errors: typing.List[FetchError],
+                           ) -> typing.Generator[None, None, None]:
+    """
+    Raise errors along with FetchErrors raised in the context
+
+    FetchErrors raised from within the context are combined with errors
+    that were collected earlier, and raised as MultipleFetchError.
+    Fetch errors take precedence over checksum mismatches.
+    """
+
+    try:
+        yield
+    except MultipleFetchError as e:
+        errors.extend(e.errors)
+    except FetchError as e:
+        errors.append(e)
+    except ChecksumMismatchError:
+        raise_fetch_errors(errors)
+        raise
+    raise_fetch_errors(errors)
+
+
+class Mirrors(typing.NamedTuple):
+    """
+    Mirrors to fetch crates from, tried in order before upstream
+
+    The mirrors are specified as URL templates, with fields
+    substituted using str.format().  The templates in crates are used
+    for crates from the registry, and can use {name}, {version}
+    and {filename} fields.  The templates in git are used for git
+    archives, and can additionally use {repository} (the repository
+    URL), {repo_name} and {commit}.  If upstream is False, the upstream
+    URLs are not used.
+    """
+
+    crates: typing.List[str] = []
+    git: typing.List[str] = []
+    upstream: bool = True
+
+
+# fields supported in mirror templates
+MIRROR_CRATE_FIELDS = ("name", "version", "filename")
+MIRROR_GIT_FIELDS = MIRROR_CRATE_FIELDS + ("repository", "repo_name",
+                                           "commit")
+
+
+def get_mirrors(config: typing.Dict[str, typing.Any]) -> Mirrors:
+    """
+    Get Mirrors from the [mirrors] table of the configuration file
+
+    Raises RuntimeError if the configuration is invalid.
+    """
+
+    def get_templates(key: str,
+                      fields: typing.Tuple[str, ...],
+                      ) -> typing.List[str]:
+        templates = config.get(key, [])
+        if (not isinstance(templates, list) or
+                not all(isinstance(x, str) for x in templates)):
+            raise RuntimeError(
+                f"mirrors.{key} in configuration file must be a list "
+                "of strings")
+        for template in templates:
+            try:
+                template.format(**{x: x for x in fields})
+            except (KeyError, IndexError, ValueError) as e:
+                raise RuntimeError(
+                    f"Invalid mirror template {template!r} in configuration "
+                    f"file: {e!r} (supported fields: {', '.join(fields)})")
+        return templates
+
+    upstream = config.get("upstream", True)
+    if not isinstance(upstream, bool):
+        raise RuntimeError(
+            "mirrors.upstream in configuration file must be a boolean")
+    return Mirrors(crates=get_templates("crates", MIRROR_CRATE_FIELDS),
+                   git=get_templates("git", MIRROR_GIT_FIELDS),
+                   upstream=upstream)
+
+
+def get_crate_urls(crate: Crate,
+                   mirrors: typing.Optional[Mirrors] = None,
+                   ) -> typing.List[str]:
+    """
+    Get the list of URLs to fetch crate from, in order of preference
+
+    Raises FetchError if no URLs are available, i.e. upstream URLs are
+    disabled and no mirrors are configured for the crate type.
+    """
+
+    if mirrors is None:
+        return [crate.download_url]
+    fields = {
+        "name": crate.name,
+        "version": crate.version,
+        "filename": crate.filename,
+    }
+    if isinstance(crate, GitCrate):
+        fields.update(repository=crate.repository,
+                      repo_name=crate.repo_name,
+                      commit=crate.commit)
+        templates = mirrors.git
+    else:
+        templates = mirrors.crates
+    urls = [template.format(**fields) for template in templates]
+    if mirrors.upstream:
+        urls.append(crate.download_url)
+    if not urls:
+        raise FetchError(crate.filename,
+                         "no mirrors configured and upstream disabled")
+    return urls
+
+
+def get_crates_with_urls(crates: typing.Iterable[Crate],
+                         mirrors: typing.Optional[Mirrors],
+                         errors: typing.List[FetchError],
+                         ) -> typing.List[typing.Tuple[Crate,
+                                                       typing.List[str]]]:
+    """
+    Get unique crates along with the URLs to fetch them from
+
+    Crates that have no URLs are skipped, and the respective FetchErrors
+    are appended to errors, so that the remaining crates can still
+    be fetched.
+    """
+
+    ret = []
+    for crate in {crate.filename: crate for crate in crates}.values():
+        try:
+            ret.append((crate, get_crate_urls(crate, mirrors)))
+        except FetchError as e:
+            errors.append(e)
+    return ret
+
+
+def check_crates_in_distdir(crates: typing.Iterable[Crate],
+                            *,
+                            distdir: Path,
+                            ) -> None:
+    """
+    Check that all crates are present in distdir, without fetching
+
+    Raises FetchError (or MultipleFetchError) listing the missing files.
+    """
+
+    raise_fetch_errors([
+        FetchError(crate.filename, "missing from distdir (offline mode)")
+        for crate in {crate.filename: crate for crate in crates}.values()
+        if not is_fetched(distdir / crate.filename)])
+
+
+def get_part_path(path: Path) -> Path:
+    """Get the path to the partial download of path"""
+    return path.with_name(f".{path.name}.part")
+
+
+def is_fetched(path: Path) -> bool:
+    """
+    Check whether path has been fetched completely
+
+    aria2c keeps a .aria2 control file next to partial (or preallocated)
+    downloads, so the file is incomplete if the control file exists.
+    """
+
+    return path.exists() and not path.with_name(f"{path.name}.aria2").exists()
+
+
+def fetch_crates_using_aria2(crates: typing.Iterable[Crate],
+                             *,
+                             distdir: Path,
+                             max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                             retries: int = DEFAULT_RETRIES,
+                             mirrors: typing.Optional[Mirrors] = None,
                              ) -> None:
     """
     Fetch specified crates into distdir using aria2c(1)
+
+    aria2c retries failed downloads and resumes partial files itself.
+    If mirrors are specified, the URLs are tried in order.  All files
+    are attempted, and if aria2c fails, a FetchError
+    (or MultipleFetchError) listing the files that are still incomplete
+    is raised afterwards.
     """
 
     distdir.mkdir(parents=True, exist_ok=True)
-    with tempfile.NamedTemporaryFile("w+") as file_list_f:
-        by_filename = {crate.filename: crate for crate in crates}
-        for filename, crate in by_filename.items():
-            if not (distdir / filename).exists():
-                file_list_f.write(
-                    f"{crate.download_url}\n\tout={crate.filename}\n")
-
-        if file_list_f.tell() == 0:
-            # no crates to fetch
+    errors: typing.List[FetchError] = []
+    with (aggregate_fetch_errors(errors),
+          tempfile.NamedTemporaryFile("w+") as file_list_f):
+        to_fetch = [(crate, urls) for crate, urls
+                    in get_crates_with_urls(crates, mirrors, errors)
+                    if not is_fetched(distdir / crate.filename)]
+        if not to_fetch:
             return
 
+        for crate, urls in to_fetch:
+            url_list = "\t".join(urls)
+            file_list_f.write(f"{url_list}\n\tout={crate.filename}\n")
+
         file_list_f.flush()
 
-        subprocess.check_call(
-            ["aria2c", "-d", str(distdir), "-i", file_list_f.name],
+        ret = subprocess.call(
+            ["aria2c",
+             "-d", str(distdir),
+             "-i", file_list_f.name,
+             f"--max-concurrent-downloads={max_connections}",
+             "--max-connection-per-server=1",
+             "--split=1",
+             "--uri-selector=inorder",
+             f"--max-tries={retries + 1}",
+             f"--retry-wait={int(DEFAULT_RETRY_DELAY)}",
+             "--continue=true",
+             "--auto-file-renaming=false",
+             ],
             stdout=sys.stderr)
+        if ret != 0:
+            failed = [FetchError(urls[-1], f"aria2c exited with status {ret}")
+                      for crate, urls in to_fetch
+                      if not is_fetched(distdir / crate.filename)]
+            raise_fetch_errors(failed)
+            raise FetchError(", ".join(crate.filename
+                                       for crate, urls in to_fetch),
+                             f"aria2c exited with status {ret}")
 
 
-def fetch_files_using_wget(files: typing.Iterable[typing.Tuple[str, Path]]
-                           ) -> None:
+def fetch_files_using_wget(
+        files: typing.Iterable[typing.Tuple[URLList, Path]],
+        *,
+        retries: int = DEFAULT_RETRIES,
+        ) -> None:
     """
     Fetch specified URLs to the specified filenames using wget(1)
+
+    A list of URLs can be specified for every file, to try them in order
+    until one succeeds.  Files are downloaded into .part files first,
+    and partial downloads are resumed.  All files are attempted,
+    and a MultipleFetchError listing the files that could not be fetched
+    is raised afterwards.
     """
 
-    for url, path in files:
-        if not path.exists():
-            subprocess.check_call(
-                ["wget", "-O", str(path), url],
+    errors = []
+    for urls, path in files:
+        if path.exists():
+            continue
+        part_path = get_part_path(path)
+        for url in [urls] if isinstance(urls, str) else urls:
+            ret = subprocess.call(
+                ["wget",
+                 "--continue",
+                 f"--tries={retries + 1}",
+                 f"--waitretry={int(DEFAULT_RETRY_DELAY * 2 ** retries)}",
+                 "--retry-connrefused",
+                 f"--timeout={HTTP_TIMEOUT}",
+                 "-O", str(part_path),
+                 url],
                 stdout=sys.stderr)
+            if ret == 0:
+                part_path.rename(path)
+                break
+            # wget creates the output file even if the request fails
+            if part_path.exists() and part_path.stat().st_size == 0:
+                part_path.unlink()
+        else:
+            errors.append(FetchError(url, f"wget exited with status {ret}"))
+    raise_fetch_errors(errors)
 
 
-def fetch_crates_using_wget(crates: typing.Iterable[Crate], *, distdir: Path
+def fetch_crates_using_wget(crates: typing.Iterable[Crate],
+                            *,
+                            distdir: Path,
+                            mirrors: typing.Optional[Mirrors] = None,
                             ) -> None:
     """
     Fetch specified crates into distdir using wget(1)
+
+    Crates that have no URLs to fetch from are reported along with
+    the fetch failures, after attempting the remaining crates.
     """
 
     distdir.mkdir(parents=True, exist_ok=True)
-    fetch_files_using_wget(
-        (crate.download_url, distdir / crate.filename) for crate in crates)
+    errors: typing.List[FetchError] = []
+    with aggregate_fetch_errors(errors):
+        fetch_files_using_wget(
+            (urls, distdir / crate.filename)
+            for crate, urls in get_crates_with_urls(crates, mirrors, errors))
 
 
-def verify_files(files: typing.Iterable[typing.Tuple[Path, str]]) -> None:
+class ConnectionPool:
     """
-    Verify checksums of specified files
+    Pool of persistent HTTP connections, reused for subsequent requests
+    to the same host
+
+    The pool itself is not thread-safe.  Connections need to be taken from
+    and returned to it from a single thread, though they can be used
+    in other threads in the meantime.
+    """
+
+    def __init__(self, timeout: float = HTTP_TIMEOUT) -> None:
+        import ssl
+
+        self.timeout = timeout
+        self._ssl_context = ssl.create_default_context()
+        self._idle: typing.Dict[typing.Tuple[str, str],
+                                typing.List["http.client.HTTPConnection"]] = {}
+
+    def get(self, scheme: str, netloc: str
+            ) -> typing.Tuple["http.client.HTTPConnection", bool]:
+        """Get a connection to the host, and whether it is being reused"""
+        import http.client
+
+        idle = self._idle.get((scheme, netloc))
+        if idle:
+            return idle.pop(), True
+        conn: http.client.HTTPConnection
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc,
+                                               timeout=self.timeout,
+                                               context=self._ssl_context)
+        elif scheme == "http":
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise ValueError(f"Unsupported URL scheme: {scheme!r}")
+        return conn, False
+
+    def put(self, scheme: str, netloc: str,
+            conn: "http.client.HTTPConnection") -> None:
+        """Return a connection to the pool, for reuse"""
+        self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self) -> None:
+        """Close all idle connections"""
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle.clear()
+
+
+class HTTPResult(typing.NamedTuple):
+    status: int
+    reason: str
+    location: typing.Optional[str]
+    will_close: bool
+    sha256: typing.Optional[str] = None
+
+
+def http_get(conn: "http.client.HTTPConnection",
+             target: str,
+             outf: typing.IO[bytes],
+             *,
+             offset: int = 0,
+             hasher: typing.Optional["hashlib._Hash"] = None,
+             ) -> HTTPResult:
+    """
+    Perform a GET request over conn, writing the response body to outf
+
+    The body is written only if the request succeeded, and its SHA256
+    checksum is computed while it is being written.  Otherwise, the body
+    is consumed to permit reusing the connection.
+
+    If offset is non-zero, the download is resumed from that offset,
+    and hasher needs to contain the hash of the data preceding it.
+    If the server does not support resuming, outf is truncated
+    and the whole file is fetched again.
+    """
+
+    headers = {"User-Agent": USER_AGENT}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    conn.request("GET", target, headers=headers)
+    response = conn.getresponse()
+    if (offset and response.status == 206 and
+            response.getheader("Content-Range", "").startswith(
+                f"bytes {offset}-")):
+        assert hasher is not None
+        outf.seek(offset)
+    elif response.status == 200:
+        outf.seek(0)
+        outf.truncate()
+        hasher = hashlib.sha256()
+    else:
+        response.read()
+        return HTTPResult(status=response.status,
+                          reason=response.reason,
+                          location=response.getheader("Location"),
+                          will_close=response.will_close)
+
+    buffer = bytearray(HTTP_BUFFER_SIZE)
+    mv = memoryview(buffer)
+    while True:
+        rd = response.readinto(mv)
+        if rd == 0:
+            break
+        hasher.update(mv[:rd])
+        outf.write(mv[:rd])
+        METRICS.add("bytes_fetched", rd)
+    return HTTPResult(status=response.status,
+                      reason=response.reason,
+                      location=None,
+                      will_close=response.will_close,
+                      sha256=hasher.hexdigest())
+
+
+def hash_partial_file(f: typing.IO[bytes]
+                      ) -> typing.Tuple[int, "hashlib._Hash"]:
+    """Get the size and SHA256 hasher for data in partially fetched file"""
+    f.seek(0)
+    hasher = hashlib.sha256()
+    while data := f.read(HTTP_BUFFER_SIZE):
+        hasher.update(data)
+    return f.tell(), hasher
+
+
+async def fetch_file_using_native(url: str,
+                                  path: Path,
+                                  checksum: typing.Optional[str],
+                                  *,
+                                  pool: ConnectionPool,
+                                  executor: concurrent.futures.Executor,
+                                  file_mode: int,
+                                  ) -> None:
+    """
+    Fetch a single URL into path, replacing it atomically
+
+    The data is fetched into a .part file first, and the download
+    is resumed if it exists already.  If checksum is not None, the SHA256
+    checksum of the downloaded data is verified before the file is moved
+    into place.  The .part file is kept if the download fails due to
+    a temporary error, to permit resuming it.
+    """
+
+    import asyncio
+    import http.client
+
+    loop = asyncio.get_running_loop()
+    part_path = get_part_path(path)
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o666)
+    keep_part = False
+    with open(fd, "r+b") as outf:
+        try:
+            try:
+                fcntl.flock(outf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                keep_part = True
+                raise FetchError(url, "being fetched by another process",
+                                 transient=True)
+            os.fchmod(outf.fileno(), file_mode)
+            offset, hasher = await loop.run_in_executor(
+                executor, hash_partial_file, outf)
+            resumed = offset != 0
+            current_url = url
+            redirects = 0
+            while True:
+                parts = urllib.parse.urlsplit(current_url)
+                target = parts.path or "/"
+                if parts.query:
+                    target += f"?{parts.query}"
+                conn, reused = pool.get(parts.scheme, parts.netloc)
+                try:
+                    result = await loop.run_in_executor(
+                        executor,
+                        functools.partial(http_get, conn, target, outf,
+                                          offset=offset, hasher=hasher))
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    outf.flush()
+                    offset, hasher = await loop.run_in_executor(
+                        executor, hash_partial_file, outf)
+                    if reused and isinstance(e, ConnectionError):
+                        # the server may have closed an idle connection,
+                        # retry using a new one
+                        continue
+                    keep_part = offset != 0
+                    raise FetchError(url, str(e), transient=True) from e
+
+                if result.will_close:
+                    conn.close()
+                else:
+                    pool.put(parts.scheme, parts.netloc, conn)
+
+                if result.status in HTTP_REDIRECTS:
+                    redirects += 1
+                    if result.location is None or redirects > MAX_REDIRECTS:
+                        raise FetchError(
+                            url, f"invalid redirect from {current_url}")
+                    current_url = urllib.parse.urljoin(current_url,
+                                                       result.location)
+                    continue
+                if result.status == 416 and offset != 0:
+                    # the partial file is not shorter than the remote file,
+                    # start over
+                    outf.truncate(0)
+                    offset, hasher = 0, hashlib.sha256()
+                    continue
+                if result.sha256 is None:
+                    keep_part = (result.status in HTTP_TRANSIENT and
+                                 offset != 0)
+                    raise FetchError(
+                        url, f"HTTP {result.status} {result.reason}",
+                        transient=result.status in HTTP_TRANSIENT)
+                if checksum is not None and result.sha256 != checksum:
+                    if resumed:
+                        # the partial file may have been corrupted,
+                        # try again from scratch
+                        raise FetchError(
+                            url, "checksum mismatch after resuming",
+                            transient=True)
+                    raise ChecksumMismatchError(path, result.sha256, checksum)
+                break
+        except BaseException as e:
+            if not keep_part and not isinstance(e, (KeyboardInterrupt,
+                                                    asyncio.CancelledError)):
+                part_path.unlink()
+            raise
+    part_path.rename(path)
+
+
+def fetch_files_using_native(
+        files: typing.Iterable[typing.Tuple[URLList,
+                                            Path,
+                                            typing.Optional[str]]],
+        *,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+        retries: int = DEFAULT_RETRIES,
+        retry_delay: float = DEFAULT_RETRY_DELAY,
+        ) -> typing.Set[Path]:
+    """
+    Fetch specified URLs to the specified filenames using the built-in
+    HTTP client
+
+    Files are fetched concurrently, using at most max_connections
+    simultaneous connections, and at most max_connections_per_host
+    to a single host.  Connections are kept alive and reused.
+    The SHA256 checksum of each file is verified while fetching,
+    unless it is None.  Returns the set of paths that were fetched
+    and verified.
+
+    A list of URLs can be specified for every file.  The URLs are tried
+    in order, and the next one is used if fetching fails or the checksum
+    does not match.  Temporary failures are retried up to retries times
+    (for every URL), with exponential backoff starting at retry_delay
+    seconds.
+
+    All files are attempted, and the failures are raised afterwards:
+    FetchError (or MultipleFetchError) if any files could not be fetched,
+    ChecksumMismatchError (or MultipleChecksumMismatchError) if any
+    checksums did not match.
+    """
+
+    file_list = [([urls] if isinstance(urls, str) else urls, path, checksum)
+                 for urls, path, checksum in files
+                 if not path.exists()]
+    if not file_list:
+        return set()
+
+    import asyncio
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    async def fetch_all() -> None:
+        pool = ConnectionPool()
+        semaphore = asyncio.Semaphore(max_connections)
+        host_semaphores: typing.Dict[str, asyncio.Semaphore] = {}
+
+        async def fetch_url(url: str,
+                            path: Path,
+                            checksum: typing.Optional[str],
+                            ) -> None:
+            host = urllib.parse.urlsplit(url).netloc
+            host_semaphore = host_semaphores.setdefault(
+                host, asyncio.Semaphore(max_connections_per_host))
+            for attempt in range(retries + 1):
+                try:
+                    async with host_semaphore, semaphore:
+                        await fetch_file_using_native(
+                            url,
+                            path,
+                            checksum,
+                            pool=pool,
+                            executor=executor,
+                            file_mode=0o666 & ~umask)
+                    return
+                except FetchError as e:
+                    if not e.transient or attempt == retries:
+                        raise
+                    delay = retry_delay * 2 ** attempt
+                    logging.warning(f"{e}, retrying in {delay:.1f} s")
+                    await asyncio.sleep(delay)
+
+        async def fetch_one(urls: typing.List[str],
+                            path: Path,
+                            checksum: typing.Optional[str],
+                            ) -> None:
+            for url in urls[:-1]:
+                try:
+                    await fetch_url(url, path, checksum)
+                    return
+                except (FetchError, ChecksumMismatchError) as e:
+                    logging.warning(f"{e}, trying next mirror")
+            await fetch_url(urls[-1], path, checksum)
+
+        try:
+            results = await asyncio.gather(
+                *itertools.starmap(fetch_one, file_list),
+                return_exceptions=True)
+        finally:
+            pool.close()
+
+        fetch_errors = []
+        checksum_errors = []
+        for result in results:
+            if isinstance(result, FetchError):
+                fetch_errors.append(result)
+            elif isinstance(result, ChecksumMismatchError):
+                checksum_errors.append(result)
+            elif isinstance(result, BaseException):
+                raise result
+        raise_fetch_errors(fetch_errors)
+        if len(checksum_errors) == 1:
+            raise checksum_errors[0]
+        if checksum_errors:
+            raise MultipleChecksumMismatchError(checksum_errors)
+
+    logging.info(f"Fetching {len(file_list)} files ...")
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_connections) as executor:
+        asyncio.run(fetch_all())
+    return {path for urls, path, checksum in file_list
+            if checksum is not None}
+
+
+def fetch_crates_using_native(crates: typing.Iterable[Crate],
+                              *,
+                              distdir: Path,
+                              mirrors: typing.Optional[Mirrors] = None,
+                              ) -> typing.Set[Path]:
+    """
+    Fetch specified crates into distdir using the built-in HTTP client
+
+    Returns the set of paths that were fetched and verified.  Crates
+    that have no URLs to fetch from are reported along with the fetch
+    failures, after attempting the remaining crates.
+    """
+
+    distdir.mkdir(parents=True, exist_ok=True)
+    errors: typing.List[FetchError] = []
+    with aggregate_fetch_errors(errors):
+        return fetch_files_using_native(
+            (urls,
+             distdir / crate.filename,
+             crate.checksum if isinstance(crate, FileCrate) else None)
+            for crate, urls in get_crates_with_urls(crates, mirrors, errors))
+
+
+def sha256_file(path: Path) -> str:
+    """
+    Compute the SHA256 checksum of the specified file
     """
 
     buffer = bytearray(128 * 1024)
     mv = memoryview(buffer)
+    size = 0
+    with open(path, "rb", buffering=0) as f:
+        hasher = hashlib.sha256()
+        while True:
+            rd = f.readinto(mv)
+            if rd == 0:
+                break
+            hasher.update(mv[:rd])
+            size += rd
+    METRICS.add("bytes_read", size)
+    return hasher.hexdigest()
+
+
+def timed_sha256_file(path: Path) -> str:
+    """sha256_file() recording the time spent as per-crate metric"""
+    start = time.perf_counter()
+    ret = sha256_file(path)
+    METRICS.add_crate_time("verify", path.name, time.perf_counter() - start)
+    return ret
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """
+    Atomically create dst as a reflink, hardlink or copy of src
+
+    The first method supported by the filesystem is used.
+    """
+
+    with tempfile.TemporaryDirectory(dir=dst.parent,
+                                     prefix=".pycargoebuild-") as tmpdir:
+        tmp = Path(tmpdir) / dst.name
+        try:
+            with open(src, "rb") as srcf, open(tmp, "xb") as tmpf:
+                fcntl.ioctl(tmpf.fileno(), FICLONE, srcf.fileno())
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+        tmp.rename(dst)
+
+
+def get_cargo_home() -> Path:
+    """Get the Cargo home directory"""
+    return Path(os.path.expanduser(os.environ.get("CARGO_HOME", "~/.cargo")))
+
+
+def import_crates_from_cargo_cache(crates: typing.Iterable[Crate],
+                                   *,
+                                   distdir: Path,
+                                   cargo_home: typing.Optional[Path] = None,
+                                   jobs: int = 1,
+                                   ) -> typing.Set[Path]:
+    """
+    Import crates missing from distdir from Cargo registry cache
+
+    Crates found in the cache are verified, and then reflinked, hardlinked
+    or copied into distdir.  Returns the set of paths that were imported
+    and verified.
+    """
+
+    if cargo_home is None:
+        cargo_home = get_cargo_home()
+    cache_dirs = sorted(x for x in (cargo_home / "registry/cache").glob("*")
+                        if x.is_dir())
+    if not cache_dirs:
+        return set()
+
+    candidates = []
+    for crate in {crate.filename: crate for crate in crates}.values():
+        if not isinstance(crate, FileCrate):
+            continue
+        path = distdir / crate.filename
+        if path.exists():
+            continue
+        for cache_dir in cache_dirs:
+            cached_path = cache_dir / crate.filename
+            if cached_path.is_file():
+                candidates.append((cached_path, path, crate.checksum))
+                break
+
+    cached_paths = [cached_path for cached_path, path, checksum in candidates]
+    if jobs > 1 and len(candidates) >= PARALLEL_VERIFY_MIN_FILES:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+            current_checksums = list(executor.map(sha256_file, cached_paths))
+    else:
+        current_checksums = [sha256_file(path) for path in cached_paths]
+
+    imported = set()
+    distdir.mkdir(parents=True, exist_ok=True)
+    for (cached_path, path, expected), current in zip(candidates,
+                                                      current_checksums):
+        if current != expected:
+            logging.warning(
+                f"Checksum mismatch for {str(cached_path)!r} in Cargo "
+                "registry cache, ignoring it")
+            continue
+        link_or_copy(cached_path, path)
+        imported.add(path)
+
+    if imported:
+        logging.info(f"Imported {len(imported)} crates from Cargo registry "
+                     "cache")
+    return imported
+
+
+@METRICS.timed("verify")
+def verify_files(files: typing.Iterable[typing.Tuple[Path, str]],
+                 *,
+                 jobs: int = 1,
+                 cache: typing.Optional[VerificationCache] = None,
+                 ) -> None:
+    """
+    Verify checksums of specified files
+
+    If jobs is larger than 1 and there are enough files, they are hashed
+    in parallel using a thread pool.  All files are verified, and all
+    mismatches are reported.  If cache is specified, files that were
+    verified already and did not change since are not hashed again.
+    """
+
+    to_hash: typing.List[
+        typing.Tuple[Path, str, typing.Optional[FileStat]]] = []
     for path, checksum in files:
-        with open(path, "rb", buffering=0) as f:
-            hasher = hashlib.sha256()
-            while True:
-                rd = f.readinto(mv)
-                if rd == 0:
-                    break
-                hasher.update(mv[:rd])
-            if hasher.hexdigest() != checksum:
-                raise ChecksumMismatchError(path, hasher.hexdigest(), checksum)
+        st: typing.Optional[FileStat] = None
+        if cache is not None:
+            st = FileStat.from_path(path)
+            if cache.is_verified(path, st, checksum):
+                continue
+        to_hash.append((path, checksum, st))
+
+    paths = [path for path, checksum, st in to_hash]
+    if jobs > 1 and len(paths) >= PARALLEL_VERIFY_MIN_FILES:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+            current_checksums = list(executor.map(timed_sha256_file, paths))
+    else:
+        current_checksums = [timed_sha256_file(path) for path in paths]
+
+    errors = []
+    for (path, expected, st), current in zip(to_hash, current_checksums):
+        if current != expected:
+            errors.append(ChecksumMismatchError(path, current, expected))
+        elif cache is not None:
+            assert st is not None
+            cache.add(path, st, current)
+    if len(errors) == 1:
+        raise errors[0]
+    if errors:
+        raise MultipleChecksumMismatchError(errors)
 
 
-def verify_crates(crates: typing.Iterable[Crate], *, distdir: Path) -> None:
+def verify_crates(crates: typing.Iterable[Crate],
+                  *,
+                  distdir: Path,
+                  jobs: int = 1,
+                  cache: typing.Optional[VerificationCache] = None,
+                  ) -> None:
     """
     Verify checksums of crates fetched into distdir
     """
 
-    verify_files((distdir / crate.filename, crate.checksum)
-                 for crate in crates
-                 if isinstance(crate, FileCrate))
+    verify_files(((distdir / crate.filename, crate.checksum)
+                  for crate in crates
+                  if isinstance(crate, FileCrate)),
+                 jobs=jobs,
+                 cache=cache)
@@ -3,10 +3,14 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import configparser
+import functools
 import logging
 import typing
 
-import license_expression
+if typing.TYPE_CHECKING:
+    import license_expression
+
+    from pycargoebuild.cache import LicenseMappingCache
 
 MAPPING: typing.Dict[str, str] = {}
 
@@ -23,17 +27,110 @@ class UnmatchedLicense(RuntimeError):
         self.crate = crate
 
 
-def load_license_mapping(f: typing.IO["str"]) -> None:
-    """Read license mapping from the specified file"""
+def compile_license_mapping(source: str) -> typing.Dict[str, str]:
+    """Parse license mapping file contents into a dict"""
     conf = configparser.ConfigParser(comment_prefixes=("#",),
                                      delimiters=("=",),
                                      empty_lines_in_values=False,
                                      interpolation=None)
-    conf.read_file(f)
-    MAPPING.update((k.lower(), v) for k, v in conf.items("spdx-to-ebuild"))
+    conf.read_string(source)
+    return {k.lower(): v for k, v in conf.items("spdx-to-ebuild")}
+
+
+def load_license_mapping(f: typing.IO["str"],
+                         cache: typing.Optional["LicenseMappingCache"] = None,
+                         ) -> None:
+    """
+    Read license mapping from the specified file
+
+    If cache is specified, the compiled mapping is taken from the cache
+    if the file did not change, and stored there otherwise.
+    """
+
+    source = f.read()
+    mapping = cache.get(source) if cache is not None else None
+    if mapping is None:
+        mapping = compile_license_mapping(source)
+        if cache is not None:
+            cache.put(source, mapping)
+    MAPPING.update(mapping)
+
+
+@functools.cache
+def get_spdx_licensing() -> "license_expression.Licensing":
+    """Get the (cached) SPDX licensing, importing license_expression lazily"""
+    import license_expression
+
+    return license_expression.get_spdx_licensing()
+
 
+@functools.cache
+def parse_license(license_str: str,
+                  ) -> typing.Optional["license_expression.LicenseExpression"]:
+    """
+    Parse SPDX license expression (strictly)
+
+    The results are cached, as the same license strings are used
+    by many crates.  Returns None if the string is empty.
+    """
+    return get_spdx_licensing().parse(license_str, strict=True)
+
+
+def combine_licenses(licenses: typing.Iterable[
+                         "license_expression.LicenseExpression"],
+                     ) -> typing.Optional[
+                         "license_expression.LicenseExpression"]:
+    """
+    Combine license expressions using AND, and simplify the result
 
-def symbol_to_ebuild(license_symbol: license_expression.LicenseSymbol) -> str:
+    The result is equivalent to calling simplify() on the combined
+    expression, except that the combining is done at the set level:
+    the simplified expressions are flattened and deduplicated, and OR-clauses
+    absorbed by other clauses (e.g. A AND (A OR B) -> A) are removed.
+    Returns None if there are no licenses.
+    """
+    licenses = list(licenses)
+    if not licenses:
+        return None
+
+    import license_expression
+
+    clauses: typing.Dict["license_expression.LicenseExpression", None] = {}
+    for expr in licenses:
+        simplified = expr.simplify()
+        if isinstance(simplified, license_expression.AND):
+            clauses.update(dict.fromkeys(simplified.args))
+        else:
+            clauses[simplified] = None
+
+    or_clauses = {clause: frozenset(clause.args) for clause in clauses
+                  if isinstance(clause, license_expression.OR)}
+    other_clauses = frozenset(clause for clause in clauses
+                              if clause not in or_clauses)
+    result = []
+    for clause in clauses:
+        args = or_clauses.get(clause)
+        if args is not None:
+            # A AND (A OR B) -> A
+            if not other_clauses.isdisjoint(args):
+                continue
+            # (A OR B) AND (A OR B OR C) -> A OR B
+            if any(other_args < args for other_args in or_clauses.values()):
+                continue
+        result.append(clause)
+
+    if not result:
+        return None
+    if len(result) == 1:
+        return result[0]
+    result.sort()
+    combined = get_spdx_licensing().AND(*result)
+    combined.iscanonical = True
+    return combined
+
+
+def symbol_to_ebuild(license_symbol: "license_expression.LicenseSymbol",
+                     ) -> str:
     full_key = str(license_symbol).lower()
     full_match = MAPPING.get(full_key)
     no_plus = MAPPING.get(full_key.replace("+", ""))
@@ -60,11 +157,13 @@ def symbol_to_ebuild(license_symbol: license_expression.LicenseSymbol) -> str:
     raise UnmatchedLicense(str(license_symbol))
 
 
-def spdx_to_ebuild(spdx: license_expression.Renderable) -> str:
+def spdx_to_ebuild(spdx: "license_expression.Renderable") -> str:
     """
     Convert SPDX license expression to ebuild license string.
     """
-    def sub(x: license_expression.LicenseExpression, in_or: bool
+    import license_expression
+
+    def sub(x: "license_expression.LicenseExpression", in_or: bool
             ) -> typing.Generator[str, None, None]:
         if isinstance(x, license_expression.AND):
             if in_or:
@@ -0,0 +1,161 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextlib
+import functools
+import json
+import operator
+import threading
+import time
+import typing
+from pathlib import Path
+
+DEFAULT_OUTLIERS = 10
+
+_FuncT = typing.TypeVar("_FuncT", bound=typing.Callable[..., typing.Any])
+
+
+class PhaseTimes(typing.NamedTuple):
+    wall: float = 0.0
+    cpu: float = 0.0
+    calls: int = 0
+
+
+class _Frame:
+    __slots__ = ("wall", "cpu", "child_wall", "child_cpu")
+
+    def __init__(self) -> None:
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+
+
+class Metrics:
+    """
+    Collector of timings and counters for the processing phases
+
+    Phase times are exclusive, i.e. the time spent in a nested phase
+    is not included in the time of the enclosing phase.  CPU time is
+    the process time of all threads (but not of subprocesses).  Counters
+    and per-crate times can be updated from multiple threads.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Reset all collected metrics"""
+        self.phases: typing.Dict[str, PhaseTimes] = {}
+        self.counters: typing.Dict[str, int] = {}
+        self.crate_times: typing.Dict[str, typing.Dict[str, float]] = {}
+        self._stack: typing.List[_Frame] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Generator[None, None, None]:
+        """Measure the time spent in the context as phase name"""
+        frame = _Frame()
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            wall = time.perf_counter() - frame.wall
+            cpu = time.process_time() - frame.cpu
+            if self._stack:
+                self._stack[-1].child_wall += wall
+                self._stack[-1].child_cpu += cpu
+            old = self.phases.get(name, PhaseTimes())
+            self.phases[name] = PhaseTimes(
+                wall=old.wall + wall - frame.child_wall,
+                cpu=old.cpu + cpu - frame.child_cpu,
+                calls=old.calls + 1)
+
+    def timed(self, name: str) -> typing.Callable[[_FuncT], _FuncT]:
+        """Decorator measuring the time spent in function as phase name"""
+        def decorator(func: _FuncT) -> _FuncT:
+            @functools.wraps(func)
+            def wrapper(*args: typing.Any, **kwargs: typing.Any
+                        ) -> typing.Any:
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return typing.cast("_FuncT", wrapper)
+        return decorator
+
+    def add(self, counter: str, value: int) -> None:
+        """Add value to the specified counter"""
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_counters(self, counters: typing.Mapping[str, int]) -> None:
+        """Add values to the specified counters"""
+        with self._lock:
+            for counter, value in counters.items():
+                self.counters[counter] = (self.counters.get(counter, 0) +
+                                          value)
+
+    @contextlib.contextmanager
+    def collect_counters(self
+                         ) -> typing.Generator[typing.Dict[str, int],
+                                               None, None]:
+        """
+        Collect the counter increments made in the context into a dict
+
+        This is meant to be used in worker processes, whose counters are
+        lost otherwise, to pass the increments back to the parent process.
+        The dict is filled when the context exits.  Increments made
+        by other threads in the meantime are included.
+        """
+
+        with self._lock:
+            before = dict(self.counters)
+        collected: typing.Dict[str, int] = {}
+        try:
+            yield collected
+        finally:
+            with self._lock:
+                collected.update(
+                    (counter, value - before.get(counter, 0))
+                    for counter, value in self.counters.items()
+                    if value != before.get(counter, 0))
+
+    def add_crate_time(self, category: str, crate: str, seconds: float
+                       ) -> None:
+        """Record the time spent processing crate in category"""
+        with self._lock:
+            times = self.crate_times.setdefault(category, {})
+            times[crate] = times.get(crate, 0.0) + seconds
+
+    def to_dict(self, outliers: int = DEFAULT_OUTLIERS) -> dict:
+        """Get the metrics as a JSON-serializable dict"""
+        crates = {}
+        for category, times in self.crate_times.items():
+            total = sum(times.values())
+            crates[category] = {
+                "count": len(times),
+                "total": total,
+                "mean": total / len(times),
+                "outliers": [
+                    {"crate": crate, "time": seconds}
+                    for crate, seconds in sorted(times.items(),
+                                                 key=operator.itemgetter(1),
+                                                 reverse=True)[:outliers]
+                ],
+            }
+        return {
+            "phases": {name: phase._asdict()
+                       for name, phase in self.phases.items()},
+            "counters": dict(self.counters),
+            "crates": crates,
+        }
+
+    def write(self, path: Path) -> None:
+        """Write the metrics as JSON into path"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+
+
+METRICS = Metrics()
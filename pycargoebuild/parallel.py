@@ -0,0 +1,49 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import collections
+import concurrent.futures
+import typing
+
+_T = typing.TypeVar("_T")
+_R = typing.TypeVar("_R")
+
+
+def imap_ordered(func: typing.Callable[[_T], _R],
+                 iterable: typing.Iterable[_T],
+                 *,
+                 jobs: int = 1,
+                 lookahead: typing.Optional[int] = None,
+                 ) -> typing.Generator[_R, None, None]:
+    """
+    Lazily apply func to items of iterable using a thread pool
+
+    Results are yielded in input order.  At most lookahead items
+    (default: 2 * jobs) are processed ahead of the consumer, to limit
+    memory use.  If jobs is 1, func is called directly, without threads.
+    """
+
+    if jobs <= 1:
+        yield from map(func, iterable)
+        return
+
+    if lookahead is None:
+        lookahead = 2 * jobs
+    it = iter(iterable)
+    pending: typing.Deque[concurrent.futures.Future[_R]] = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for item in it:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= lookahead:
+                    break
+            while pending:
+                result = pending.popleft().result()
+                for item in it:
+                    pending.append(executor.submit(func, item))
+                    break
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,145 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import typing
+from pathlib import Path
+
+from pycargoebuild.cache import FileStat, VerificationCache
+from pycargoebuild.cargo import Crate, FileCrate
+from pycargoebuild.fetch import link_or_copy
+
+
+class CrateStore:
+    """
+    Content-addressed store of crate files, shared between distdirs
+
+    Crates are stored as sha256/<xx>/<checksum> files inside the store
+    directory.  Files are added only after their checksum has been
+    verified, so a file present in the store is known to match its
+    checksum, and so is every distdir file hardlinked to it.  Distdir
+    files that were reflinked or copied to or from the store are recorded
+    in a verification cache inside the store instead, and are assumed
+    to match as long as their size, mtime and inode do not change.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    def open_verification_cache(self) -> VerificationCache:
+        """Open the cache of distdir files matching the stored files"""
+        return VerificationCache(self.root / "verified.sqlite")
+
+    def get_path(self, checksum: str) -> Path:
+        """Get the path to the stored file with specified checksum"""
+        return self.root / "sha256" / checksum[:2] / checksum
+
+    def is_stored(self, path: Path, checksum: str) -> bool:
+        """Check whether path is a hardlink to the stored file"""
+        try:
+            return path.samefile(self.get_path(checksum))
+        except FileNotFoundError:
+            return False
+
+    def is_verified(self,
+                    path: Path,
+                    checksum: str,
+                    cache: VerificationCache,
+                    ) -> bool:
+        """
+        Check whether path is known to match the stored file
+
+        This is the case if it is hardlinked to the stored file,
+        or if it was reflinked or copied and it did not change since.
+        """
+
+        if self.is_stored(path, checksum):
+            return True
+        try:
+            st = FileStat.from_path(path)
+        except FileNotFoundError:
+            return False
+        return cache.is_verified(path, st, checksum)
+
+    def record_copy(self,
+                    path: Path,
+                    checksum: str,
+                    cache: VerificationCache,
+                    ) -> None:
+        """Record path in the cache, if it is not hardlinked to the store"""
+        if not self.is_stored(path, checksum):
+            cache.add(path, FileStat.from_path(path), checksum)
+
+    def import_crates(self,
+                      crates: typing.Iterable[Crate],
+                      *,
+                      distdir: Path,
+                      ) -> typing.Set[Path]:
+        """
+        Materialize crates missing from distdir from the store
+
+        The crates are reflinked, hardlinked or copied into distdir.
+        Returns the set of paths in distdir that are known to match
+        their checksums, i.e. the imported crates and crates that are
+        hardlinked to the store already.
+        """
+
+        verified = set()
+        imported = 0
+        with self.open_verification_cache() as cache:
+            for crate in {crate.filename: crate for crate in crates
+                          }.values():
+                if not isinstance(crate, FileCrate) or not crate.checksum:
+                    continue
+                path = distdir / crate.filename
+                if path.exists():
+                    if self.is_verified(path, crate.checksum, cache):
+                        verified.add(path)
+                    continue
+                stored_path = self.get_path(crate.checksum)
+                if not stored_path.is_file():
+                    continue
+                distdir.mkdir(parents=True, exist_ok=True)
+                link_or_copy(stored_path, path)
+                self.record_copy(path, crate.checksum, cache)
+                verified.add(path)
+                imported += 1
+
+        if imported:
+            logging.info(f"Imported {imported} crates from crate store")
+        return verified
+
+    def add_crates(self,
+                   crates: typing.Iterable[Crate],
+                   *,
+                   distdir: Path,
+                   ) -> int:
+        """
+        Add crates from distdir to the store
+
+        The crates must have been verified already.  Crates that are
+        in the store already are skipped.  Returns the number of crates
+        added.
+        """
+
+        added = 0
+        with self.open_verification_cache() as cache:
+            for crate in {crate.filename: crate for crate in crates
+                          }.values():
+                if not isinstance(crate, FileCrate) or not crate.checksum:
+                    continue
+                stored_path = self.get_path(crate.checksum)
+                if stored_path.exists():
+                    continue
+                path = distdir / crate.filename
+                if not path.is_file():
+                    continue
+                stored_path.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(path, stored_path)
+                self.record_copy(path, crate.checksum, cache)
+                added += 1
+
+        if added:
+            logging.info(f"Added {added} crates to crate store")
+        return added
@@ -2,7 +2,11 @@
 # (c) 2022-2024 Michał Górny <mgorny@gentoo.org>
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import http.server
 import io
+import threading
+import time
+import typing
 
 import pytest
 
@@ -24,3 +28,92 @@ Unlicense = Unlicense
 def real_license_mapping() -> None:
     with io.StringIO(TEST_LICENSE_MAPPING_CONF) as f:
         load_license_mapping(f)
+
+
+class StandInHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StandInHTTPServer"
+
+    def do_GET(self) -> None:
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.active,
+                                         self.server.max_active)
+        try:
+            self.handle_get()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def handle_get(self) -> None:
+        self.server.requests.append((self.client_address, self.path))
+        if (range_header := self.headers.get("Range")) is not None:
+            self.server.ranges.append((self.path, range_header))
+        time.sleep(self.server.delay)
+        if self.server.failures.get(self.path, 0) > 0:
+            self.server.failures[self.path] -= 1
+            self.send_error(503)
+            return
+        if (location := self.server.redirects.get(self.path)) is not None:
+            self.send_response(302)
+            self.send_header("Location", location)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        if range_header is not None:
+            start = int(range_header.removeprefix("bytes=").rstrip("-"))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             f"bytes {start}-{len(data) - 1}/{len(data)}")
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args: typing.Any) -> None:
+        pass
+
+
+class StandInHTTPServer(http.server.ThreadingHTTPServer):
+    """Local HTTP server standing in for crates.io and git hosts"""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StandInHTTPRequestHandler)
+        self.files: typing.Dict[str, bytes] = {}
+        self.redirects: typing.Dict[str, str] = {}
+        self.requests: typing.List[typing.Tuple[typing.Any, str]] = []
+        # (path, Range header) for requests with Range
+        self.ranges: typing.List[typing.Tuple[str, str]] = []
+        # number of 503 responses to send before serving the path
+        self.failures: typing.Dict[str, int] = {}
+        # delay before responding, in seconds
+        self.delay = 0.0
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+
+@pytest.fixture
+def http_server() -> typing.Generator[StandInHTTPServer, None, None]:
+    server = StandInHTTPServer()
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={"poll_interval": 0.01},
+                              daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
@@ -0,0 +1,66 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+from pathlib import Path
+
+import pytest
+
+from pycargoebuild.batch import (
+    BatchManifestError,
+    BatchPackage,
+    load_batch_manifest,
+)
+
+
+def test_load_batch_manifest():
+    manifest = io.BytesIO(b"""
+[[package]]
+directory = "foo"
+
+[[package]]
+directory = ["bar/a", "bar/b"]
+input = "dev-util/bar/bar-1.ebuild"
+output = "dev-util/bar/{name}-{version}.ebuild"
+crate-tarball = true
+features = true
+no-license = false
+incremental = true
+""")
+    assert load_batch_manifest(manifest, Path("/base")) == [
+        BatchPackage(directories=[Path("/base/foo")]),
+        BatchPackage(
+            directories=[Path("/base/bar/a"), Path("/base/bar/b")],
+            input=Path("/base/dev-util/bar/bar-1.ebuild"),
+            output="/base/dev-util/bar/{name}-{version}.ebuild",
+            features=True,
+            crate_tarball=True,
+            no_license=False,
+            incremental=True),
+    ]
+
+
+def test_load_batch_manifest_relative(tmp_path):
+    manifest = tmp_path / "batch.toml"
+    manifest.write_text('[[package]]\ndirectory = "foo"\n')
+    with open(manifest, "rb") as f:
+        assert load_batch_manifest(f) == [
+            BatchPackage(directories=[tmp_path / "foo"]),
+        ]
+
+
+@pytest.mark.parametrize(
+    "data",
+    ["",
+     "[[package]]\n",
+     "[[package]]\ndirectory = []\n",
+     "[[package]]\ndirectory = 1\n",
+     "[[package]]\ndirectory = 'foo'\ninput = 1\n",
+     "[[package]]\ndirectory = 'foo'\nfeatures = 'yes'\n",
+     "[[package]]\ndirectory = 'foo'\nfoo = 'bar'\n",
+     "[[package]\n",
+     ])
+def test_load_batch_manifest_invalid(data):
+    with pytest.raises(BatchManifestError):
+        load_batch_manifest(io.BytesIO(data.encode()), Path("/base"))
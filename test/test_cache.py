@@ -0,0 +1,115 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import sqlite3
+from pathlib import Path
+
+from pycargoebuild.cache import (
+    MetadataCache,
+    PortageConfigCache,
+    PortagePaths,
+    get_portage_config_key,
+)
+from pycargoebuild.cargo import FileCrate, PackageMetadata
+
+FOO_CSUM = "37d2046a395cbfcb2712ff5c96a727b1966876080047c56717009dbbc235f566"
+BAR_CSUM = "22d39d98821d4b60c3fcbd0fead3c873ddd568971cc530070254b769e18623f3"
+
+FOO = FileCrate("foo", "1", FOO_CSUM)
+BAR = FileCrate("bar", "2", BAR_CSUM)
+FOO_META = PackageMetadata(name="foo",
+                           version="1",
+                           features={"a": True, "b": False},
+                           license="MIT OR Apache-2.0")
+BAR_META = PackageMetadata(name="bar",
+                           version="2",
+                           license_file="COPYING")
+
+
+def test_metadata_cache(tmp_path):
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get(FOO) is None
+        cache.put(FOO, FOO_META)
+        cache.put(BAR, BAR_META)
+        assert cache.get(FOO) == FOO_META
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get(FOO) == FOO_META
+        assert cache.get(BAR) == BAR_META
+
+
+def test_metadata_cache_in_memory():
+    with MetadataCache(None) as cache:
+        cache.put(FOO, FOO_META)
+        cache.flush()
+        assert cache.get(FOO) == FOO_META
+
+
+def test_metadata_cache_no_checksum(tmp_path):
+    crate = FileCrate("foo", "1", "")
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        cache.put(crate, FOO_META)
+        assert cache.get(crate) is None
+
+
+def test_metadata_cache_eviction(tmp_path):
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        cache.put(FOO, FOO_META)
+    with MetadataCache(tmp_path / "cache.sqlite", max_entries=1) as cache:
+        cache.put(BAR, BAR_META)
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get(FOO) is None
+        assert cache.get(BAR) == BAR_META
+
+
+def test_metadata_cache_version(tmp_path):
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        cache.put(FOO, FOO_META)
+    db = sqlite3.connect(tmp_path / "cache.sqlite")
+    db.execute("PRAGMA user_version = 0")
+    db.close()
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get(FOO) is None
+
+
+def test_metadata_cache_corrupted(tmp_path):
+    (tmp_path / "cache.sqlite").write_bytes(b"not really a database" * 100)
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        cache.put(FOO, FOO_META)
+    with MetadataCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get(FOO) == FOO_META
+
+
+def test_portage_config_cache(tmp_path):
+    paths = PortagePaths(distdir=Path("/distfiles"),
+                         gentoo_repo=Path("/gentoo"))
+    with PortageConfigCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get("foo") is None
+        cache.put("foo", paths)
+    with PortageConfigCache(tmp_path / "cache.sqlite",
+                            max_entries=1) as cache:
+        assert cache.get("foo") == paths
+        cache.put("bar", paths)
+        assert cache.get("foo") is None
+        assert cache.get("bar") == paths
+
+
+def test_portage_config_key(tmp_path, monkeypatch):
+    monkeypatch.setenv("PORTAGE_CONFIGROOT", str(tmp_path))
+    monkeypatch.delenv("EPREFIX", raising=False)
+    monkeypatch.delenv("DISTDIR", raising=False)
+    key = get_portage_config_key()
+    assert get_portage_config_key() == key
+
+    repos_conf = tmp_path / "etc/portage/repos.conf"
+    repos_conf.mkdir(parents=True)
+    (repos_conf / "gentoo.conf").write_text("[gentoo]\n")
+    new_key = get_portage_config_key()
+    assert new_key != key
+    os.utime(repos_conf / "gentoo.conf", ns=(0, 0))
+    assert get_portage_config_key() != new_key
+
+    new_key = get_portage_config_key()
+    monkeypatch.setenv("DISTDIR", "/distfiles")
+    assert get_portage_config_key() != new_key
@@ -2,13 +2,23 @@
 # (c) 2022-2024 Michał Górny <mgorny@gentoo.org>
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import gc
 import io
+import os
+import pickle
+import sys
 import tarfile
 import typing
+import unittest.mock
 from pathlib import PurePath
 
 import pytest
 
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
 from pycargoebuild.cargo import (
     FileCrate,
     GitCrate,
@@ -16,7 +26,10 @@ from pycargoebuild.cargo import (
     cargo_to_spdx,
     get_crates,
     get_package_metadata,
+    read_tarball_member,
+    tarball_indexes,
 )
+from pycargoebuild.metrics import METRICS
 
 CARGO_LOCK_TOML = b'''
     version = 3
@@ -147,6 +160,128 @@ def test_get_crates_prehistoric():
                 ) == [x for x in CRATES if isinstance(x, FileCrate)]
 
 
+CARGO_LOCK_REGULAR = b"""\
+# This file is automatically @generated by Cargo.
+# It is not intended for manual editing.
+version = 4
+
+[[package]]
+name = "fsevent-sys"
+version = "4.1.0"
+source = "registry+https://github.com/rust-lang/crates.io-index"
+checksum = "76ee7a02da4d231650c7cea31349b889be2f45ddb3ef3032d2ec8185f6313fd2"
+dependencies = [
+ "libc",
+]
+
+[[package]]
+name = "libc"
+version = "0.2.124"
+source = "registry+https://github.com/rust-lang/crates.io-index"
+checksum = "21a41fed9d98f27ab1c6d161da622a4fa35e8a54a8adc24bbf3ddd0ef70b0e50"
+
+[[package]]
+name = "test"
+version = "1.2.3"
+dependencies = [
+ "fsevent-sys",
+ "regex-syntax",
+]
+
+[[package]]
+name = "regex-syntax"
+version = "0.6.28"
+source = "git+https://github.com/01mf02/regex.git?rev=90eebbd\
+#90eebbdb9396ca10510130327073a3d596674d04"
+
+[[patch.unused]]
+name = "foo"
+version = "1.0.0"
+"""
+
+REGULAR_CRATES = [
+    FileCrate("fsevent-sys", "4.1.0", "76ee7a02da4d231650c7cea31349b889"
+                                      "be2f45ddb3ef3032d2ec8185f6313fd2"),
+    FileCrate("libc", "0.2.124", "21a41fed9d98f27ab1c6d161da622a4f"
+                                 "a35e8a54a8adc24bbf3ddd0ef70b0e50"),
+    GitCrate("regex-syntax", "0.6.28",
+             "https://github.com/01mf02/regex",
+             "90eebbdb9396ca10510130327073a3d596674d04"),
+]
+
+
+def test_get_crates_streaming():
+    with unittest.mock.patch("pycargoebuild.cargo.tomllib.load",
+                             side_effect=AssertionError("tomllib used")):
+        assert list(get_crates(io.BytesIO(CARGO_LOCK_REGULAR))
+                    ) == REGULAR_CRATES
+
+
+def test_get_crates_streaming_prehistoric():
+    with unittest.mock.patch("pycargoebuild.cargo.tomllib.load",
+                             side_effect=AssertionError("tomllib used")):
+        assert list(get_crates(io.BytesIO(PREHISTORIC_CARGO_LOCK_TOML))
+                    ) == [x for x in CRATES if isinstance(x, FileCrate)]
+
+
+@pytest.mark.parametrize(
+    "old,new",
+    [('dependencies = [\n "libc",\n]\n',
+      'dependencies = [\n "libc" # comment\n]\n'),
+     ('version = "0.2.124"', "version = '0.2.124'"),
+     ('name = "test"', 'name = "\\u0074est"'),
+     ('dependencies = [\n "fsevent-sys",\n "regex-syntax",\n]',
+      'dependencies = ["fsevent-sys", "regex-syntax"]'),
+     ("[[patch.unused]]", "[[patch.unused]]  # comment"),
+     ("[[patch.unused]]", "[patch.unused]\n[[package]]"),
+     ('version = "1.0.0"\n', 'version = "1.0.0"\n[workspace]\nx = 1\n'),
+     ])
+def test_get_crates_fallback(old, new):
+    """Test that unusual formatting is handled via tomllib"""
+    data = CARGO_LOCK_REGULAR.replace(old.encode(), new.encode(), 1)
+    assert data != CARGO_LOCK_REGULAR
+    with unittest.mock.patch("pycargoebuild.cargo.tomllib.load",
+                             wraps=tomllib.load) as tomllib_load:
+        assert list(get_crates(io.BytesIO(data))) == REGULAR_CRATES
+    tomllib_load.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "old,new",
+    [('name = "libc"\n', 'name = "libc"\nname = "libc"\n'),
+     ("version = 4", "version = 4\nversion = 4"),
+     ('dependencies = [\n "libc",\n',
+      ('dependencies = [\n "libc"\n'
+       ' "foo",\n')),
+     ("[[patch.unused]]", "[[patch.unused]"),
+     ])
+def test_get_crates_invalid(old, new):
+    data = CARGO_LOCK_REGULAR.replace(old.encode(), new.encode(), 1)
+    assert data != CARGO_LOCK_REGULAR
+    with pytest.raises(tomllib.TOMLDecodeError):
+        list(get_crates(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize("version", [1, 2, 5])
+def test_get_crates_unsupported_version(version):
+    data = CARGO_LOCK_REGULAR.replace(b"version = 4",
+                                      f"version = {version}".encode())
+    with pytest.raises(NotImplementedError):
+        list(get_crates(io.BytesIO(data)))
+
+
+def test_get_crates_invalid_checksum():
+    data = CARGO_LOCK_REGULAR.replace(b'checksum = "21a', b'checksum = "x1a')
+    with pytest.raises(RuntimeError, match="Invalid checksum"):
+        list(get_crates(io.BytesIO(data)))
+
+
+def test_get_crates_missing_checksum():
+    data = CARGO_LOCK_REGULAR.replace(b'checksum = "21a', b'foo = "21a')
+    with pytest.raises(RuntimeError, match="insufficient metadata"):
+        list(get_crates(io.BytesIO(data)))
+
+
 @pytest.mark.parametrize("exclude", ["", "description", "homepage", "license"])
 def test_get_package_metadata(exclude):
     data: typing.Dict[str, typing.Optional[str]] = {
@@ -254,6 +389,11 @@ version = "0.1"
 license = "MIT"
 """
 
+TEMPLATE_CARGO_TOML = b"""\
+[package]
+name = {{ project-name }}
+"""
+
 
 @pytest.mark.parametrize(
     "name,expected",
@@ -272,6 +412,10 @@ def test_git_crate_package_directory(tmp_path, name, expected):
         tar_info = tarfile.TarInfo(f"{basename}/Cargo.toml")
         tar_info.size = len(TOP_CARGO_TOML)
         tarf.addfile(tar_info, io.BytesIO(TOP_CARGO_TOML))
+        # invalid Cargo.toml files (e.g. templates) should be ignored
+        tar_info = tarfile.TarInfo(f"{basename}/template/Cargo.toml")
+        tar_info.size = len(TEMPLATE_CARGO_TOML)
+        tarf.addfile(tar_info, io.BytesIO(TEMPLATE_CARGO_TOML))
         tar_info = tarfile.TarInfo(f"{basename}/sub/Cargo.toml")
         tar_info.size = len(SUB_CARGO_TOML)
         tarf.addfile(tar_info, io.BytesIO(SUB_CARGO_TOML))
@@ -304,3 +448,96 @@ def test_git_crate_root_directory(tmp_path, have_lock):
             tarf.addfile(tar_info, io.BytesIO(b""))
 
     assert crate.get_root_directory(tmp_path) == PurePath(basename)
+
+
+def test_git_crate_single_pass(tmp_path):
+    commit = "5ace474ad2e92da836de60afd9014cbae7bdd481"
+    crates = [GitCrate(name, "0.1",
+                       "https://github.com/projg2/pycargoebuild",
+                       commit)
+              for name in ("toplevel", "subpkg")]
+    basename = f"pycargoebuild-{commit}"
+
+    with tarfile.open(tmp_path / f"{basename}.gh.tar.gz", "x:gz") as tarf:
+        tar_info = tarfile.TarInfo(f"{basename}/Cargo.toml")
+        tar_info.size = len(TOP_CARGO_TOML)
+        tarf.addfile(tar_info, io.BytesIO(TOP_CARGO_TOML))
+        tar_info = tarfile.TarInfo(f"{basename}/sub/Cargo.toml")
+        tar_info.size = len(SUB_CARGO_TOML)
+        tarf.addfile(tar_info, io.BytesIO(SUB_CARGO_TOML))
+
+    with unittest.mock.patch("pycargoebuild.cargo.tarfile.open",
+                             wraps=tarfile.open) as tar_open:
+        for crate in crates:
+            assert crate.get_root_directory(tmp_path) == PurePath(basename)
+            assert crate.get_workspace_toml(tmp_path) == {}
+            assert (crate.get_cargo_toml(tmp_path)["package"]["name"] ==
+                    crate.name)
+    tar_open.assert_called_once()
+
+
+def test_git_crate_index_collected(tmp_path):
+    commit = "5ace474ad2e92da836de60afd9014cbae7bdd481"
+    basename = f"pycargoebuild-{commit}"
+    with tarfile.open(tmp_path / f"{basename}.gh.tar.gz", "x:gz") as tarf:
+        tar_info = tarfile.TarInfo(f"{basename}/Cargo.toml")
+        tar_info.size = len(TOP_CARGO_TOML)
+        tarf.addfile(tar_info, io.BytesIO(TOP_CARGO_TOML))
+
+    crate = GitCrate("toplevel", "0.1",
+                     "https://github.com/projg2/pycargoebuild", commit)
+    assert crate.get_package_directory(tmp_path) == PurePath(basename)
+    assert tmp_path / crate.filename in tarball_indexes
+    del crate
+    gc.collect()
+    assert tmp_path / f"{basename}.gh.tar.gz" not in tarball_indexes
+
+
+def test_file_crate_checksum():
+    checksum = ("21a41fed9d98f27ab1c6d161da622a4f"
+                "a35e8a54a8adc24bbf3ddd0ef70b0e50")
+    crate = FileCrate("libc", "0.2.124", checksum.upper())
+    assert crate.digest == bytes.fromhex(checksum)
+    assert crate.checksum == checksum
+    assert crate == FileCrate("libc", "0.2.124", checksum)
+    assert pickle.loads(pickle.dumps(crate)) == crate
+    assert not hasattr(crate, "__dict__")
+    with pytest.raises(ValueError):
+        FileCrate("libc", "0.2.124", "not-hex")
+
+
+def test_read_tarball_member_early(tmp_path):
+    path = tmp_path / "foo-1.crate"
+    with tarfile.open(path, "x:gz") as tarf:
+        tar_info = tarfile.TarInfo("foo-1/Cargo.toml")
+        tar_info.size = len(SUB_CARGO_TOML)
+        tarf.addfile(tar_info, io.BytesIO(SUB_CARGO_TOML))
+        tar_info = tarfile.TarInfo("foo-1/data.bin")
+        tar_info.size = 1024 * 1024
+        tarf.addfile(tar_info, io.BytesIO(os.urandom(tar_info.size)))
+    # truncate the archive, to verify that the tail is not read
+    with open(path, "r+b") as f:
+        f.truncate(512 * 1024)
+
+    METRICS.reset()
+    assert (read_tarball_member(path, PurePath("foo-1/Cargo.toml")) ==
+            SUB_CARGO_TOML)
+    assert 0 < METRICS.counters["bytes_read"] < 512 * 1024
+    assert 0 < METRICS.counters["bytes_decompressed"] < 1024 * 1024
+
+
+def test_read_tarball_member_link(tmp_path):
+    path = tmp_path / "foo-1.crate"
+    with tarfile.open(path, "x:gz") as tarf:
+        tar_info = tarfile.TarInfo("foo-1/Cargo.toml.orig")
+        tar_info.size = len(SUB_CARGO_TOML)
+        tarf.addfile(tar_info, io.BytesIO(SUB_CARGO_TOML))
+        tar_info = tarfile.TarInfo("foo-1/Cargo.toml")
+        tar_info.type = tarfile.SYMTYPE
+        tar_info.linkname = "Cargo.toml.orig"
+        tarf.addfile(tar_info)
+
+    assert (read_tarball_member(path, PurePath("foo-1/Cargo.toml")) ==
+            SUB_CARGO_TOML)
+    with pytest.raises(RuntimeError):
+        read_tarball_member(path, PurePath("foo-1/missing"))
@@ -0,0 +1,124 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import lzma
+import os
+import sys
+import tarfile
+
+import pytest
+
+from pycargoebuild.compress import (
+    CompressionError,
+    ParallelXZWriter,
+    check_preset,
+    get_compression,
+    open_compressed_writer,
+    parse_xz_preset,
+)
+
+TEST_DATA = b"".join(os.urandom(64) * 16 + b"\0" * 1024 for _ in range(1000))
+
+
+@pytest.mark.parametrize("value,expected",
+                         [("0", 0),
+                          ("6", 6),
+                          ("9e", 9 | lzma.PRESET_EXTREME),
+                          ("e", CompressionError),
+                          ("10", CompressionError),
+                          ])
+def test_parse_xz_preset(value, expected):
+    if expected is CompressionError:
+        with pytest.raises(CompressionError):
+            parse_xz_preset(value)
+    else:
+        assert parse_xz_preset(value) == expected
+
+
+@pytest.mark.parametrize("compression,preset,valid",
+                         [("xz", "9e", True),
+                          ("xz", "19", False),
+                          ("zstd", "19", True),
+                          ("zstd", "9e", False),
+                          ("zstd", "0", False),
+                          ])
+def test_check_preset(compression, preset, valid):
+    if valid:
+        check_preset(compression, preset)
+    else:
+        with pytest.raises(CompressionError):
+            check_preset(compression, preset)
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+@pytest.mark.parametrize("data", [b"", b"short", TEST_DATA])
+def test_parallel_xz(data, jobs):
+    outf = io.BytesIO()
+    with ParallelXZWriter(outf, preset=1, jobs=jobs,
+                          block_size=256 * 1024) as xzf:
+        for i in range(0, len(data), 10000):
+            xzf.write(data[i:i + 10000])
+    assert not outf.closed
+    assert lzma.decompress(outf.getvalue()) == data
+
+
+def test_parallel_xz_deterministic():
+    outputs = []
+    for jobs in (1, 2, 4):
+        outf = io.BytesIO()
+        with ParallelXZWriter(outf, preset=1, jobs=jobs,
+                              block_size=256 * 1024) as xzf:
+            xzf.write(TEST_DATA)
+        outputs.append(outf.getvalue())
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_xz_writer_streams(jobs):
+    outf = io.BytesIO()
+    with open_compressed_writer(outf, "xz", preset="0", jobs=jobs) as xzf:
+        # use enough data to fill more than a single block
+        xzf.write(TEST_DATA * 2)
+    assert not outf.closed
+
+    data = outf.getvalue()
+    found = 0
+    while data:
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        decompressor.decompress(data)
+        data = decompressor.unused_data
+        found += 1
+    # a single stream is used without parallel compression
+    assert (found == 1) == (jobs == 1)
+
+
+@pytest.mark.parametrize("path", ["crates.tar.xz", "crates.tar.zst"])
+def test_compressed_tarball(path):
+    compression = get_compression(path)
+    if compression == "zstd" and sys.version_info < (3, 14):
+        pytest.importorskip("zstandard")
+
+    outf = io.BytesIO()
+    with (open_compressed_writer(outf, compression, preset="1",
+                                 jobs=2) as compressed_f,
+          tarfile.open(fileobj=compressed_f, mode="w|") as tarf):
+        tar_info = tarfile.TarInfo("test/data")
+        tar_info.size = len(TEST_DATA)
+        tarf.addfile(tar_info, io.BytesIO(TEST_DATA))
+
+    if compression == "zstd":
+        if sys.version_info >= (3, 14):
+            from compression import zstd
+            data = zstd.decompress(outf.getvalue())
+        else:
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(
+                outf.getvalue())
+    else:
+        data = lzma.decompress(outf.getvalue())
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tarf:
+        tarf_data = tarf.extractfile("test/data")
+        assert tarf_data is not None
+        assert tarf_data.read() == TEST_DATA
@@ -18,10 +18,13 @@ from pycargoebuild.ebuild import (
     bash_dquote_escape,
     collapse_whitespace,
     get_ebuild,
+    get_ebuild_CRATES,
+    get_unchanged_crates,
     update_ebuild,
     url_dquote_escape,
 )
 from pycargoebuild.license import MAPPING, UnmatchedLicense
+from pycargoebuild.metrics import METRICS
 
 
 @pytest.fixture(scope="session")
@@ -147,6 +150,25 @@ def test_get_ebuild(real_license_mapping,
     """)
 
 
+def test_get_ebuild_jobs(real_license_mapping, pkg_meta, crate_dir,
+                         crates_plus_git):
+    assert (get_ebuild(pkg_meta, crates_plus_git, crate_dir, jobs=4) ==
+            get_ebuild(pkg_meta, crates_plus_git, crate_dir))
+
+
+def test_get_ebuild_jobs_metrics(real_license_mapping, pkg_meta, crate_dir,
+                                 crates):
+    METRICS.reset()
+    ebuild = get_ebuild(pkg_meta, crates, crate_dir)
+    counters = METRICS.counters
+    assert counters["bytes_read"] > 0
+    assert counters["bytes_decompressed"] > 0
+    # counters from worker processes must be added up too
+    METRICS.reset()
+    assert get_ebuild(pkg_meta, crates, crate_dir, jobs=2) == ebuild
+    assert METRICS.counters == counters
+
+
 def test_get_ebuild_features(real_license_mapping, crate_dir, crates):
     pkg_meta = PackageMetadata(
         name="foo",
@@ -739,6 +761,37 @@ def test_update_add_git_crates(real_license_mapping, pkg_meta, crate_dir,
     """)
 
 
+def test_get_ebuild_CRATES():
+    assert get_ebuild_CRATES(textwrap.dedent("""\
+        EAPI=8
+
+        CRATES="
+        \tbar@2
+        \tfoo-1
+        "
+    """)) == {"bar@2", "foo-1"}
+
+
+def test_get_ebuild_CRATES_fail():
+    with pytest.raises(RuntimeError):
+        get_ebuild_CRATES("EAPI=8\n")
+
+
+def test_get_unchanged_crates(crates_plus_git):
+    ebuild = textwrap.dedent("""\
+        CRATES="
+        \tbar@1
+        \tfoo-1
+        \tbaz@3
+        \ttest@0.1
+        "
+    """)
+    assert get_unchanged_crates(ebuild, crates_plus_git) == {
+        FileCrate("foo", "1", ""),
+        FileCrate("baz", "3", ""),
+    }
+
+
 def test_collapse_whitespace():
     assert collapse_whitespace("\tfoo  bar \n baz \u00A0") == "foo bar baz"
 
@@ -765,14 +818,15 @@ def test_unmatched_license(real_license_mapping, pkg_meta, crates, crate_dir):
         assert (e.value.license_key, e.value.crate) == ("Apache-2.0", None)
 
 
+@pytest.mark.parametrize("jobs", [1, 2])
 def test_unmatched_crate_license(real_license_mapping, pkg_meta, crates,
-                                 crate_dir):
+                                 crate_dir, jobs):
     stripped_mapping = dict(MAPPING)
     del stripped_mapping["cc0-1.0"]
 
     with unittest.mock.patch("pycargoebuild.license.MAPPING",
                              new=stripped_mapping):
         with pytest.raises(UnmatchedLicense) as e:
-            get_ebuild(pkg_meta, crates, crate_dir)
+            get_ebuild(pkg_meta, crates, crate_dir, jobs=jobs)
         assert (e.value.license_key, e.value.crate
                 ) == ("CC0-1.0", "bar-2.crate")
@@ -2,10 +2,31 @@
 # (c) 2022-2024 Michał Górny <mgorny@gentoo.org>
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import concurrent.futures
+import unittest.mock
+from pathlib import Path
+
 import pytest
 
-from pycargoebuild.cargo import FileCrate
-from pycargoebuild.fetch import ChecksumMismatchError, verify_crates
+from pycargoebuild.cache import VerificationCache
+from pycargoebuild.cargo import FileCrate, GitCrate
+from pycargoebuild.fetch import (
+    PARALLEL_VERIFY_MIN_FILES,
+    ChecksumMismatchError,
+    FetchError,
+    Mirrors,
+    MultipleChecksumMismatchError,
+    MultipleFetchError,
+    check_crates_in_distdir,
+    fetch_crates_using_aria2,
+    fetch_crates_using_native,
+    fetch_files_using_native,
+    get_crate_urls,
+    get_mirrors,
+    import_crates_from_cargo_cache,
+    sha256_file,
+    verify_crates,
+)
 
 FOO_CSUM = "37d2046a395cbfcb2712ff5c96a727b1966876080047c56717009dbbc235f566"
 BAR_CSUM = "22d39d98821d4b60c3fcbd0fead3c873ddd568971cc530070254b769e18623f3"
@@ -19,10 +40,11 @@ def test_crates(tmp_path_factory):
     yield test_dir
 
 
-def test_verify_pass(test_crates):
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_verify_pass(test_crates, jobs):
     verify_crates([FileCrate("foo", "1", FOO_CSUM),
                    FileCrate("bar", "2", BAR_CSUM),
-                   ], distdir=test_crates)
+                   ] * 10, distdir=test_crates, jobs=jobs)
 
 
 def test_verify_fail(test_crates):
@@ -33,3 +55,330 @@ def test_verify_fail(test_crates):
 
     assert (e.value.path, e.value.current, e.value.expected
             ) == (test_crates / "bar-2.crate", BAR_CSUM, FOO_CSUM)
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_verify_fail_multiple(test_crates, jobs):
+    with pytest.raises(MultipleChecksumMismatchError) as e:
+        verify_crates([FileCrate("foo", "1", BAR_CSUM),
+                       FileCrate("bar", "2", BAR_CSUM),
+                       ] * 10 + [FileCrate("bar", "2", FOO_CSUM)],
+                      distdir=test_crates, jobs=jobs)
+
+    assert [(x.path, x.current, x.expected) for x in e.value.errors
+            ] == [(test_crates / "foo-1.crate", FOO_CSUM, BAR_CSUM)] * 10 + [
+                  (test_crates / "bar-2.crate", BAR_CSUM, FOO_CSUM)]
+    assert (e.value.path, e.value.current, e.value.expected
+            ) == (test_crates / "foo-1.crate", FOO_CSUM, BAR_CSUM)
+
+
+def test_fetch_native(tmp_path, http_server):
+    for i in range(10):
+        http_server.files[f"/files/{i}"] = f"file {i}\n".encode() * 1000
+    http_server.redirects["/redirect"] = "/files/0"
+
+    fetch_files_using_native(
+        [(http_server.url(f"/files/{i}"), tmp_path / f"{i}.crate", None)
+         for i in range(10)] +
+        [(http_server.url("/redirect"), tmp_path / "redirect.crate", None)],
+        max_connections=2)
+
+    for i in range(10):
+        assert ((tmp_path / f"{i}.crate").read_bytes() ==
+                http_server.files[f"/files/{i}"])
+    assert ((tmp_path / "redirect.crate").read_bytes() ==
+            http_server.files["/files/0"])
+    # connections should be kept alive and reused
+    assert len({addr for addr, path in http_server.requests}) <= 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        [f"{i}.crate" for i in range(10)] + ["redirect.crate"])
+
+
+@pytest.mark.parametrize("fail", ["missing", "mismatch"])
+def test_fetch_native_mirrors(tmp_path, http_server, fail):
+    http_server.files["/upstream/foo"] = b"test string\n"
+    if fail == "mismatch":
+        http_server.files["/mirror/foo"] = b"other string\n"
+    assert fetch_files_using_native([
+        ([http_server.url("/mirror/foo"), http_server.url("/upstream/foo")],
+         tmp_path / "foo-1.crate", FOO_CSUM),
+    ]) == {tmp_path / "foo-1.crate"}
+    assert (tmp_path / "foo-1.crate").read_bytes() == b"test string\n"
+    assert [path for addr, path in http_server.requests
+            ] == ["/mirror/foo", "/upstream/foo"]
+
+
+def test_fetch_native_mirrors_fail(tmp_path, http_server):
+    with pytest.raises(FetchError) as e:
+        fetch_files_using_native([
+            ([http_server.url("/mirror/foo"),
+              http_server.url("/upstream/foo")],
+             tmp_path / "foo-1.crate", FOO_CSUM),
+        ])
+    assert e.value.url == http_server.url("/upstream/foo")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_get_crate_urls():
+    mirrors = get_mirrors({
+        "crates": ["http://mirror/{name}/{version}", "http://m2/{filename}"],
+        "git": ["http://mirror/{repo_name}/{commit}"],
+    })
+    crate = FileCrate("foo", "1", FOO_CSUM)
+    git_crate = GitCrate("bar", "2", "https://github.com/projg2/bar",
+                         "5ace474ad2e92da836de60afd9014cbae7bdd481")
+    assert get_crate_urls(crate) == [crate.download_url]
+    assert get_crate_urls(crate, mirrors) == [
+        "http://mirror/foo/1", "http://m2/foo-1.crate", crate.download_url]
+    assert get_crate_urls(git_crate, mirrors) == [
+        "http://mirror/bar/5ace474ad2e92da836de60afd9014cbae7bdd481",
+        git_crate.download_url]
+    # no upstream, and no git mirrors
+    mirrors = mirrors._replace(git=[], upstream=False)
+    assert get_crate_urls(crate, mirrors) == [
+        "http://mirror/foo/1", "http://m2/foo-1.crate"]
+    with pytest.raises(FetchError):
+        get_crate_urls(git_crate, mirrors)
+
+
+def test_fetch_crates_native_no_urls(tmp_path, http_server):
+    http_server.files["/mirror/foo-1.crate"] = b"test string\n"
+    mirrors = Mirrors(crates=[http_server.url("/mirror/{filename}")],
+                      upstream=False)
+    git_crate = GitCrate("bar", "2", "https://github.com/projg2/bar",
+                         "5ace474ad2e92da836de60afd9014cbae7bdd481")
+    with pytest.raises(MultipleFetchError) as e:
+        fetch_crates_using_native([FileCrate("foo", "1", FOO_CSUM),
+                                   git_crate,
+                                   FileCrate("baz", "3", FOO_CSUM)],
+                                  distdir=tmp_path,
+                                  mirrors=mirrors)
+    # the crate with no URLs must not prevent fetching other crates
+    assert sorted(error.url for error in e.value.errors) == [
+        git_crate.filename, http_server.url("/mirror/baz-3.crate")]
+    assert [p.name for p in tmp_path.iterdir()] == ["foo-1.crate"]
+
+
+@pytest.mark.parametrize(
+    "config",
+    [{"crates": "http://mirror/{filename}"},
+     {"crates": ["http://mirror/{commit}"]},
+     {"git": ["http://mirror/{foo}"]},
+     {"git": ["http://mirror/{"]},
+     {"upstream": "no"},
+     ])
+def test_get_mirrors_invalid(config):
+    with pytest.raises(RuntimeError):
+        get_mirrors(config)
+
+
+def test_get_mirrors_default():
+    assert get_mirrors({}) == Mirrors()
+
+
+def test_check_crates_in_distdir(test_crates):
+    check_crates_in_distdir([FileCrate("foo", "1", FOO_CSUM)],
+                            distdir=test_crates)
+    with pytest.raises(MultipleFetchError) as e:
+        check_crates_in_distdir([FileCrate("foo", "1", FOO_CSUM),
+                                 FileCrate("foo", "2", FOO_CSUM),
+                                 FileCrate("bar", "1", BAR_CSUM)],
+                                distdir=test_crates)
+    assert [x.url for x in e.value.errors] == ["foo-2.crate", "bar-1.crate"]
+
+
+@pytest.mark.parametrize("complete", [False, True])
+def test_fetch_aria2_partial(tmp_path, complete):
+    (tmp_path / "foo-1.crate").write_bytes(b"test string\n")
+    (tmp_path / "bar-2.crate").write_bytes(b"other")
+    (tmp_path / "bar-2.crate.aria2").write_bytes(b"")
+    crates = [FileCrate("foo", "1", FOO_CSUM), FileCrate("bar", "2", BAR_CSUM)]
+
+    def aria2c(args, **kwargs):
+        file_list = Path(args[args.index("-i") + 1]).read_text()
+        assert file_list == f"{crates[1].download_url}\n\tout=bar-2.crate\n"
+        if complete:
+            (tmp_path / "bar-2.crate.aria2").unlink()
+        return 1
+
+    with (unittest.mock.patch("pycargoebuild.fetch.subprocess.call",
+                              side_effect=aria2c),
+          pytest.raises(FetchError) as e):
+        fetch_crates_using_aria2(crates, distdir=tmp_path)
+    assert not isinstance(e.value, MultipleFetchError)
+    assert e.value.url == (
+        "bar-2.crate" if complete else crates[1].download_url)
+
+    if complete:
+        check_crates_in_distdir(crates, distdir=tmp_path)
+    else:
+        with pytest.raises(FetchError):
+            check_crates_in_distdir(crates, distdir=tmp_path)
+
+
+def test_fetch_native_existing(tmp_path, http_server):
+    (tmp_path / "foo.crate").write_bytes(b"local")
+    assert fetch_files_using_native([(http_server.url("/foo"),
+                                      tmp_path / "foo.crate",
+                                      FOO_CSUM)]) == set()
+    assert (tmp_path / "foo.crate").read_bytes() == b"local"
+    assert http_server.requests == []
+
+
+def test_fetch_native_fail(tmp_path, http_server):
+    http_server.files["/good"] = b"good"
+    with pytest.raises(FetchError) as e:
+        fetch_files_using_native([
+            (http_server.url("/good"), tmp_path / "good.crate", None),
+            (http_server.url("/missing"), tmp_path / "missing.crate", None),
+        ])
+    assert e.value.url == http_server.url("/missing")
+    assert [p.name for p in tmp_path.iterdir()] == ["good.crate"]
+
+
+def test_fetch_native_verify(tmp_path, http_server):
+    http_server.files["/foo"] = b"test string\n"
+    http_server.files["/bar"] = b"other string\n"
+    assert fetch_files_using_native([
+        (http_server.url("/foo"), tmp_path / "foo-1.crate", FOO_CSUM),
+        (http_server.url("/bar"), tmp_path / "bar-2.crate", None),
+    ]) == {tmp_path / "foo-1.crate"}
+
+
+def test_fetch_native_verify_fail(tmp_path, http_server):
+    http_server.files["/bar"] = b"other string\n"
+    with pytest.raises(ChecksumMismatchError) as e:
+        fetch_files_using_native([
+            (http_server.url("/bar"), tmp_path / "bar-2.crate", FOO_CSUM),
+        ])
+
+    assert (e.value.path, e.value.current, e.value.expected
+            ) == (tmp_path / "bar-2.crate", BAR_CSUM, FOO_CSUM)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_fetch_native_fail_multiple(tmp_path, http_server):
+    http_server.files["/good"] = b"good"
+    with pytest.raises(MultipleFetchError) as e:
+        fetch_files_using_native([
+            (http_server.url("/missing1"), tmp_path / "missing1.crate", None),
+            (http_server.url("/good"), tmp_path / "good.crate", None),
+            (http_server.url("/missing2"), tmp_path / "missing2.crate", None),
+        ])
+    assert sorted(error.url for error in e.value.errors) == [
+        http_server.url("/missing1"), http_server.url("/missing2")]
+    assert [p.name for p in tmp_path.iterdir()] == ["good.crate"]
+
+
+def test_fetch_native_retry(tmp_path, http_server):
+    http_server.files["/foo"] = b"test string\n"
+    http_server.failures["/foo"] = 2
+    assert fetch_files_using_native(
+        [(http_server.url("/foo"), tmp_path / "foo-1.crate", FOO_CSUM)],
+        retry_delay=0.01) == {tmp_path / "foo-1.crate"}
+    assert [path for addr, path in http_server.requests] == ["/foo"] * 3
+
+
+def test_fetch_native_retry_fail(tmp_path, http_server):
+    http_server.files["/foo"] = b"test string\n"
+    http_server.failures["/foo"] = 3
+    with pytest.raises(FetchError) as e:
+        fetch_files_using_native(
+            [(http_server.url("/foo"), tmp_path / "foo-1.crate", FOO_CSUM)],
+            retries=2,
+            retry_delay=0.01)
+    assert e.value.reason == "HTTP 503 Service Unavailable"
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("part", [b"test", b"test string\n", b"bad string\n",
+                                  b"too long test string\n"])
+def test_fetch_native_resume(tmp_path, http_server, part):
+    http_server.files["/foo"] = b"test string\n"
+    (tmp_path / ".foo-1.crate.part").write_bytes(part)
+    assert fetch_files_using_native(
+        [(http_server.url("/foo"), tmp_path / "foo-1.crate", FOO_CSUM)],
+        retry_delay=0.01) == {tmp_path / "foo-1.crate"}
+    assert (tmp_path / "foo-1.crate").read_bytes() == b"test string\n"
+    assert ("/foo", f"bytes={len(part)}-") in http_server.ranges
+    assert [p.name for p in tmp_path.iterdir()] == ["foo-1.crate"]
+
+
+def test_fetch_native_per_host_limit(tmp_path, http_server):
+    http_server.delay = 0.05
+    for i in range(6):
+        http_server.files[f"/files/{i}"] = b"data"
+    fetch_files_using_native(
+        [(http_server.url(f"/files/{i}"), tmp_path / f"{i}.crate", None)
+         for i in range(6)],
+        max_connections=8,
+        max_connections_per_host=2)
+    assert http_server.max_active == 2
+
+
+def test_verify_cache(tmp_path):
+    (tmp_path / "foo-1.crate").write_bytes(b"test string\n")
+    (tmp_path / "bar-2.crate").write_bytes(b"other string\n")
+    crates = [FileCrate("foo", "1", FOO_CSUM), FileCrate("bar", "2", BAR_CSUM)]
+
+    def verify(**kwargs):
+        with unittest.mock.patch("pycargoebuild.fetch.sha256_file",
+                                 wraps=sha256_file) as mock:
+            with VerificationCache(tmp_path / "cache.sqlite",
+                                   **kwargs) as cache:
+                verify_crates(crates, distdir=tmp_path, cache=cache)
+        return sorted(call.args[0].name for call in mock.call_args_list)
+
+    assert verify() == ["bar-2.crate", "foo-1.crate"]
+    assert verify() == []
+    assert verify(reverify=True) == ["bar-2.crate", "foo-1.crate"]
+    # modifying the file should invalidate the cache
+    (tmp_path / "bar-2.crate").write_bytes(b"test string\n")
+    with pytest.raises(ChecksumMismatchError):
+        verify()
+    (tmp_path / "bar-2.crate").write_bytes(b"other string\n")
+    assert verify() == ["bar-2.crate"]
+
+
+@pytest.mark.parametrize("extra", [0, PARALLEL_VERIFY_MIN_FILES])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_import_from_cargo_cache(tmp_path, jobs, extra):
+    cache_dir = tmp_path / "cargo/registry/cache/index.crates.io-1234"
+    cache_dir.mkdir(parents=True)
+    (cache_dir / "foo-1.crate").write_bytes(b"test string\n")
+    (cache_dir / "bar-2.crate").write_bytes(b"other string\n")
+    (cache_dir / "baz-3.crate").write_bytes(b"other string\n")
+    (cache_dir / "qux-4.crate").write_bytes(b"test string\n")
+    # additional crates, to verify enough files in parallel
+    # (the last one is corrupted)
+    for i in range(extra):
+        (cache_dir / f"extra-{i}.crate").write_bytes(
+            b"test string\n" if i != extra - 1 else b"corrupted\n")
+    distdir = tmp_path / "distdir"
+    distdir.mkdir()
+    (distdir / "qux-4.crate").write_bytes(b"other string\n")
+
+    crates = [FileCrate("foo", "1", FOO_CSUM),
+              FileCrate("bar", "2", BAR_CSUM),
+              FileCrate("baz", "3", FOO_CSUM),
+              FileCrate("qux", "4", FOO_CSUM),
+              FileCrate("quux", "5", FOO_CSUM),
+              ] + [FileCrate("extra", str(i), FOO_CSUM) for i in range(extra)]
+    with unittest.mock.patch(
+            "pycargoebuild.fetch.concurrent.futures.ThreadPoolExecutor",
+            wraps=concurrent.futures.ThreadPoolExecutor) as executor:
+        assert import_crates_from_cargo_cache(
+            crates,
+            distdir=distdir,
+            cargo_home=tmp_path / "cargo",
+            jobs=jobs,
+        ) == {distdir / "foo-1.crate", distdir / "bar-2.crate"} | {
+            distdir / f"extra-{i}.crate" for i in range(extra - 1)}
+    assert executor.called == (jobs > 1 and extra > 0)
+    assert sorted(x.name for x in distdir.iterdir()) == sorted(
+        ["bar-2.crate", "foo-1.crate", "qux-4.crate"] +
+        [f"extra-{i}.crate" for i in range(extra - 1)])
+    assert (distdir / "foo-1.crate").read_bytes() == b"test string\n"
+    assert (distdir / "bar-2.crate").read_bytes() == b"other string\n"
+    # files that exist already must not be touched
+    assert (distdir / "qux-4.crate").read_bytes() == b"other string\n"
@@ -2,13 +2,22 @@
 # (c) 2022-2024 Michał Górny <mgorny@gentoo.org>
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import io
+import random
 import typing
 import unittest.mock
 
 import license_expression
 import pytest
 
-from pycargoebuild.license import spdx_to_ebuild, symbol_to_ebuild
+from pycargoebuild.cache import LicenseMappingCache
+from pycargoebuild.license import (
+    combine_licenses,
+    load_license_mapping,
+    parse_license,
+    spdx_to_ebuild,
+    symbol_to_ebuild,
+)
 
 TEST_LICENSE_MAPPING = {
     # keys are lowercase in MAPPING
@@ -89,3 +98,78 @@ def test_spdx_to_ebuild(spdx, value):
 @pytest.mark.parametrize("value", REAL_MAPPING_TEST_VALUES)
 def test_real_license_mapping(real_license_mapping, value):
     assert symbol_to_ebuild(value) == REAL_MAPPING_TEST_VALUES[value]
+
+
+def load_mapping(source: str,
+                 cache: LicenseMappingCache,
+                 ) -> typing.Dict[str, str]:
+    mapping: typing.Dict[str, str] = {}
+    with unittest.mock.patch("pycargoebuild.license.MAPPING", new=mapping):
+        load_license_mapping(io.StringIO(source), cache)
+    return mapping
+
+
+def test_license_mapping_cache(tmp_path):
+    source = "[spdx-to-ebuild]\nMIT = MIT\nBSD-3-Clause = BSD\n"
+    with LicenseMappingCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get(source) is None
+        assert load_mapping(source, cache) == {"mit": "MIT",
+                                               "bsd-3-clause": "BSD"}
+
+    with LicenseMappingCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get(source) == {"mit": "MIT", "bsd-3-clause": "BSD"}
+        # verify that the cached mapping is used
+        cache.put(source, {"mit": "cached"})
+        assert load_mapping(source, cache) == {"mit": "cached"}
+        # a different source is compiled anew
+        assert load_mapping(source + "0BSD = 0BSD\n", cache)["0bsd"] == "0BSD"
+
+
+def test_parse_license():
+    parsed = parse_license("MIT OR Apache-2.0")
+    assert str(parsed) == "MIT OR Apache-2.0"
+    assert parse_license("MIT OR Apache-2.0") is parsed
+    assert parse_license("") is None
+    with pytest.raises(license_expression.ExpressionError):
+        parse_license("MIT OR")
+
+
+def simplify_combined(licenses: typing.List[str]) -> str:
+    expected = parse_license(" AND ".join(f"( {x} )" for x in licenses))
+    assert expected is not None
+    return str(expected.simplify())
+
+
+@pytest.mark.parametrize(
+    "licenses",
+    [[],
+     ["MIT"],
+     ["MIT", "MIT"],
+     ["MIT", "MIT OR Apache-2.0"],
+     ["Apache-2.0 OR MIT", "MIT OR Apache-2.0"],
+     ["MIT OR Apache-2.0", "Apache-2.0 OR MIT OR Zlib", "Zlib"],
+     ["MIT AND BSD-3-Clause", "BSD-3-Clause OR Unlicense"],
+     ["(MIT OR Apache-2.0) AND Unicode-DFS-2016", "MIT OR Apache-2.0",
+      "Apache-2.0 WITH LLVM-exception OR Apache-2.0 OR MIT"],
+     ["MIT AND (MIT OR Apache-2.0)"],
+     ["(MIT AND Zlib) OR Apache-2.0", "Apache-2.0 OR (Zlib AND MIT)"],
+     ])
+def test_combine_licenses(licenses):
+    parsed = [parse_license(x) for x in licenses]
+    combined = combine_licenses(parsed)
+    if not licenses:
+        assert combined is None
+    else:
+        assert str(combined) == simplify_combined(licenses)
+
+
+def test_combine_licenses_random():
+    rng = random.Random(42)
+    symbols = ["MIT", "Apache-2.0", "Zlib", "BSD-3-Clause", "Unlicense",
+               "ISC", "0BSD"]
+    licenses = [" OR ".join(rng.sample(symbols, rng.randint(1, 4)))
+                for _ in range(50)]
+    licenses += [" AND ".join(rng.sample(symbols, rng.randint(2, 3)))
+                 for _ in range(5)]
+    combined = combine_licenses(parse_license(x) for x in licenses)
+    assert str(combined) == simplify_combined(licenses)
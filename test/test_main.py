@@ -0,0 +1,278 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import gzip
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import typing
+import unittest.mock
+from pathlib import Path
+
+import pytest
+
+import pycargoebuild
+import pycargoebuild.__main__
+from pycargoebuild.__main__ import get_portage_paths, main, repack_crates
+from pycargoebuild.cache import (
+    PortageConfigCache,
+    PortagePaths,
+    get_cache_dir,
+    get_portage_config_key,
+)
+from pycargoebuild.cargo import CRATE_REGISTRY, FileCrate
+
+CHECK_IMPORTS = """
+import sys
+from pycargoebuild.__main__ import main
+assert main("pycargoebuild", *sys.argv[1:]) == 0
+print(" ".join(x for x in ("jinja2", "license_expression", "asyncio")
+               if x in sys.modules))
+"""
+
+
+@pytest.mark.parametrize(
+    "args,expected",
+    [([], "jinja2 license_expression"),
+     (["-L"], "jinja2"),
+     # no crates, so there are no licenses to process
+     (["-i", "test.ebuild"], ""),
+     (["-L", "-i", "test-no-license.ebuild"], ""),
+     ])
+def test_lazy_imports(tmp_path, args, expected):
+    (tmp_path / "Cargo.toml").write_text(
+        '[package]\nname = "test"\nversion = "1"\nlicense = "MIT"\n')
+    (tmp_path / "Cargo.lock").write_text(
+        'version = 3\n\n[[package]]\nname = "test"\nversion = "1"\n')
+    (tmp_path / "license-mapping.conf").write_text(
+        "[spdx-to-ebuild]\nMIT = MIT\n")
+    (tmp_path / "test.ebuild").write_text(
+        'CRATES=""\n\n# Dependent crate licenses\nLICENSE+=""\n')
+    (tmp_path / "test-no-license.ebuild").write_text('CRATES=""\n')
+    (tmp_path / "distdir").mkdir()
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHECK_IMPORTS, "--no-config", "--no-cache",
+         "-d", "distdir", "-l", "license-mapping.conf", "-o", "out.ebuild",
+         *args, "."],
+        cwd=tmp_path,
+        env={**os.environ,
+             "PYTHONPATH": str(Path(pycargoebuild.__file__).parent.parent)},
+        text=True)
+    assert output.splitlines()[-1] == expected
+
+
+def test_portage_paths_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    paths = PortagePaths(distdir=tmp_path / "distdir",
+                         gentoo_repo=tmp_path / "gentoo")
+    for path in paths:
+        path.mkdir()
+    with PortageConfigCache(get_cache_dir() / "portage.sqlite") as cache:
+        cache.put(get_portage_config_key(), paths)
+    # make any attempt to import portage fail
+    monkeypatch.setitem(sys.modules, "portage", None)
+    assert get_portage_paths() == paths
+
+
+def test_portage_paths_no_cache(monkeypatch):
+    monkeypatch.setitem(sys.modules, "portage", None)
+    with unittest.mock.patch(
+            "pycargoebuild.__main__.get_portage_config_key") as config_key:
+        with pytest.raises(ImportError):
+            get_portage_paths(no_cache=True)
+    config_key.assert_not_called()
+
+
+def add_crate(http_server, name: str, version: str) -> str:
+    """Serve a new crate via http_server, return its Cargo.lock entry"""
+    crate = io.BytesIO()
+    # use a fixed mtime, to get the same checksum every time
+    with (gzip.GzipFile(fileobj=crate, mode="wb", mtime=0) as gzf,
+          tarfile.open(fileobj=gzf, mode="w") as tar):
+        data = (f'[package]\nname = "{name}"\nversion = "{version}"\n'
+                'license = "MIT"\n').encode()
+        tar_info = tarfile.TarInfo(f"{name}-{version}/Cargo.toml")
+        tar_info.size = len(data)
+        tar.addfile(tar_info, io.BytesIO(data))
+    http_server.files[f"/crates/{name}-{version}.crate"] = crate.getvalue()
+    checksum = hashlib.sha256(crate.getvalue()).hexdigest()
+    return (f'[[package]]\nname = "{name}"\nversion = "{version}"\n'
+            f'source = "{CRATE_REGISTRY}"\nchecksum = "{checksum}"\n')
+
+
+def write_workspace(directory: Path, name: str, *lock_entries: str
+                    ) -> None:
+    """Write Cargo.toml and Cargo.lock for package using crates"""
+    directory.mkdir(exist_ok=True)
+    (directory / "Cargo.toml").write_text(
+        f'[package]\nname = "{name}"\nversion = "1"\nlicense = "MIT"\n')
+    (directory / "Cargo.lock").write_text(
+        f'version = 3\n\n[[package]]\nname = "{name}"\nversion = "1"\n\n' +
+        "\n".join(lock_entries))
+
+
+@pytest.fixture
+def mirror_workspace(tmp_path, monkeypatch, http_server):
+    write_workspace(tmp_path, "test", add_crate(http_server, "foo", "1.2.3"))
+    (tmp_path / "license-mapping.conf").write_text(
+        "[spdx-to-ebuild]\nMIT = MIT\n")
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config/pycargoebuild.toml").write_text(
+        "[mirrors]\n"
+        f'crates = ["{http_server.url("/crates/{filename}")}"]\n'
+        "upstream = false\n")
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    monkeypatch.setenv("XDG_CONFIG_DIRS", str(tmp_path / "config"))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+
+
+MIRROR_ARGS = ["--no-cache", "--no-cargo-registry-cache", "-d", "distdir",
+               "-l", "license-mapping.conf", "-o", "out.ebuild", "-M"]
+
+
+def test_mirrors(mirror_workspace, http_server):
+    assert main("pycargoebuild", *MIRROR_ARGS, "-F", "native", ".") == 0
+    assert [path for addr, path in http_server.requests
+            ] == ["/crates/foo-1.2.3.crate"]
+    assert ((mirror_workspace / "distdir/foo-1.2.3.crate").read_bytes() ==
+            http_server.files["/crates/foo-1.2.3.crate"])
+    assert "\tfoo@1.2.3\n" in (mirror_workspace / "out.ebuild").read_text()
+
+
+def test_offline(mirror_workspace, http_server):
+    assert main("pycargoebuild", *MIRROR_ARGS, "--offline", ".") == 1
+    assert http_server.requests == []
+    assert not (mirror_workspace / "out.ebuild").exists()
+
+    (mirror_workspace / "distdir").mkdir()
+    (mirror_workspace / "distdir/foo-1.2.3.crate").write_bytes(
+        http_server.files["/crates/foo-1.2.3.crate"])
+    assert main("pycargoebuild", *MIRROR_ARGS, "--offline", ".") == 0
+    assert http_server.requests == []
+
+
+def test_invalid_preset(capsys):
+    with pytest.raises(SystemExit):
+        main("pycargoebuild", "--crate-tarball-path", "foo.tar.zst",
+             "--crate-tarball-preset", "9e")
+    assert "Invalid zstd level: '9e'" in capsys.readouterr().err
+
+
+def test_invalid_batch_manifest(tmp_path, capsys):
+    (tmp_path / "batch.toml").write_text("[[package]]\n")
+    with pytest.raises(SystemExit):
+        main("pycargoebuild", "-b", str(tmp_path / "batch.toml"))
+    assert "--batch: " in capsys.readouterr().err
+
+
+def test_repack_crates(tmp_path):
+    crates = set()
+    for name in ("foo", "bar"):
+        path = tmp_path / f"{name}-1.crate"
+        with tarfile.open(path, "w:gz") as tar:
+            for member in ("Cargo.toml", "src/lib.rs"):
+                data = f"{name}/{member}\n".encode()
+                tar_info = tarfile.TarInfo(f"{name}-1/{member}")
+                tar_info.size = len(data)
+                tar.addfile(tar_info, io.BytesIO(data))
+        crates.add(FileCrate(name, "1", hashlib.sha256(
+            path.read_bytes()).hexdigest()))
+
+    def repack(jobs: int) -> bytes:
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode="w|",
+                          format=tarfile.GNU_FORMAT) as tar_out:
+            repack_crates(tar_out, crates, tmp_path, prefix="cargo_home",
+                          jobs=jobs)
+        return out.getvalue()
+
+    # crates should be streamed rather than read into memory
+    with unittest.mock.patch("pycargoebuild.__main__.read_tarball_members",
+                             side_effect=AssertionError("buffered")):
+        serial = repack(1)
+    assert repack(2) == serial
+    with tarfile.open(fileobj=io.BytesIO(serial)) as tar:
+        assert tar.getnames() == [
+            "cargo_home/bar-1/Cargo.toml",
+            "cargo_home/bar-1/src/lib.rs",
+            "cargo_home/bar-1/.cargo-checksum.json",
+            "cargo_home/foo-1/Cargo.toml",
+            "cargo_home/foo-1/src/lib.rs",
+            "cargo_home/foo-1/.cargo-checksum.json",
+        ]
+        member_file = tar.extractfile("cargo_home/foo-1/src/lib.rs")
+        assert member_file is not None
+        assert member_file.read() == b"foo/src/lib.rs\n"
+
+
+def test_incremental(mirror_workspace, http_server):
+    args = ["--no-cargo-registry-cache", "-d", "distdir",
+            "-l", "license-mapping.conf", "-M", "-F", "native"]
+    (mirror_workspace / "test.ebuild").write_text(
+        'CRATES=""\n\n# Dependent crate licenses\nLICENSE+=""\n')
+    assert main("pycargoebuild", *args, "-i", "test.ebuild",
+                "-o", "full.ebuild", ".") == 0
+    http_server.requests.clear()
+
+    verified: typing.List[str] = []
+
+    def verify_crates(crates, **kwargs):
+        crates = list(crates)
+        verified.extend(crate.filename for crate in crates)
+        return real_verify_crates(crates, **kwargs)
+
+    real_verify_crates = pycargoebuild.__main__.verify_crates
+    with unittest.mock.patch("pycargoebuild.__main__.verify_crates",
+                             side_effect=verify_crates):
+        # unchanged crates are neither fetched nor verified, so they
+        # do not need to be present in distdir
+        (mirror_workspace / "distdir/foo-1.2.3.crate").unlink()
+        assert main("pycargoebuild", *args, "--incremental", "--offline",
+                    "-i", "full.ebuild", "-o", "unchanged.ebuild", ".") == 0
+        assert verified == []
+        assert ((mirror_workspace / "unchanged.ebuild").read_bytes() ==
+                (mirror_workspace / "full.ebuild").read_bytes())
+
+        # new crates are still fetched
+        write_workspace(mirror_workspace, "test",
+                        add_crate(http_server, "foo", "1.2.3"),
+                        add_crate(http_server, "bar", "2"))
+        assert main("pycargoebuild", *args, "--incremental",
+                    "-i", "full.ebuild", "-o", "changed.ebuild", ".") == 0
+        assert verified == []
+        assert [path for addr, path in http_server.requests
+                ] == ["/crates/bar-2.crate"]
+        assert not (mirror_workspace / "distdir/foo-1.2.3.crate").exists()
+    ebuild = (mirror_workspace / "changed.ebuild").read_text()
+    assert "\tbar@2\n\tfoo@1.2.3\n" in ebuild
+
+
+def test_batch(mirror_workspace, http_server):
+    foo = add_crate(http_server, "foo", "1.2.3")
+    write_workspace(mirror_workspace / "pkg1", "pkg1", foo,
+                    add_crate(http_server, "bar", "2"))
+    write_workspace(mirror_workspace / "pkg2", "pkg2", foo)
+    # no Cargo.toml
+    (mirror_workspace / "broken").mkdir()
+    (mirror_workspace / "batch.toml").write_text(
+        '[[package]]\ndirectory = "pkg1"\noutput = "pkg1.ebuild"\n\n'
+        '[[package]]\ndirectory = "broken"\noutput = "broken.ebuild"\n\n'
+        '[[package]]\ndirectory = "pkg2"\noutput = "pkg2.ebuild"\n')
+
+    assert main("pycargoebuild", "--no-cache", "--no-cargo-registry-cache",
+                "-d", "distdir", "-l", "license-mapping.conf", "-M",
+                "-F", "native", "-b", "batch.toml") == 1
+    # the shared crate is fetched only once
+    assert sorted(path for addr, path in http_server.requests
+                  ) == ["/crates/bar-2.crate", "/crates/foo-1.2.3.crate"]
+    assert ("\tbar@2\n\tfoo@1.2.3\n" in
+            (mirror_workspace / "pkg1.ebuild").read_text())
+    assert ("\tfoo@1.2.3\n" in
+            (mirror_workspace / "pkg2.ebuild").read_text())
+    assert not (mirror_workspace / "broken.ebuild").exists()
@@ -0,0 +1,83 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import threading
+import time
+
+from pycargoebuild.metrics import Metrics
+
+
+def test_phase_exclusive():
+    metrics = Metrics()
+    with metrics.phase("outer"):
+        time.sleep(0.02)
+        with metrics.phase("inner"):
+            time.sleep(0.05)
+    with metrics.phase("inner"):
+        pass
+
+    assert metrics.phases["inner"].calls == 2
+    assert metrics.phases["outer"].calls == 1
+    assert metrics.phases["inner"].wall >= 0.05
+    assert 0.02 <= metrics.phases["outer"].wall < 0.05
+
+
+def test_timed():
+    metrics = Metrics()
+
+    @metrics.timed("test")
+    def func(x: int) -> int:
+        return x + 1
+
+    assert func(1) == 2
+    assert func(2) == 3
+    assert metrics.phases["test"].calls == 2
+
+
+def test_counters_threads():
+    metrics = Metrics()
+
+    def worker() -> None:
+        for _ in range(1000):
+            metrics.add("bytes", 2)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.counters == {"bytes": 8000}
+
+
+def test_to_dict_outliers():
+    metrics = Metrics()
+    for i in range(5):
+        metrics.add_crate_time("verify", f"crate-{i}", float(i))
+    metrics.add_crate_time("verify", "crate-0", 10.0)
+
+    crates = metrics.to_dict(outliers=2)["crates"]
+    assert crates == {
+        "verify": {
+            "count": 5,
+            "total": 20.0,
+            "mean": 4.0,
+            "outliers": [
+                {"crate": "crate-0", "time": 10.0},
+                {"crate": "crate-4", "time": 4.0},
+            ],
+        },
+    }
+
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.add("bytes_read", 42)
+    with metrics.phase("test"):
+        pass
+    metrics.write(tmp_path / "metrics.json")
+    data = json.loads((tmp_path / "metrics.json").read_text())
+    assert data["counters"] == {"bytes_read": 42}
+    assert list(data["phases"]) == ["test"]
+    assert metrics.to_dict()["phases"]["test"]["calls"] == 1
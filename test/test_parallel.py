@@ -0,0 +1,37 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import random
+import threading
+import time
+
+import pytest
+
+from pycargoebuild.parallel import imap_ordered
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_imap_ordered(jobs):
+    def func(x: int) -> int:
+        time.sleep(random.random() / 100)
+        return x * 2
+
+    assert list(imap_ordered(func, range(50), jobs=jobs)) == [
+        x * 2 for x in range(50)]
+
+
+def test_imap_ordered_lookahead():
+    started = []
+    lock = threading.Lock()
+
+    def func(x: int) -> int:
+        with lock:
+            started.append(x)
+        return x
+
+    it = imap_ordered(func, range(100), jobs=4, lookahead=8)
+    assert next(it) == 0
+    time.sleep(0.05)
+    assert len(started) <= 9
+    assert list(it) == list(range(1, 100))
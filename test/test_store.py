@@ -0,0 +1,91 @@
+# pycargoebuild
+# (c) 2022-2025 Michał Górny <mgorny@gentoo.org>
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import hashlib
+import os
+import shutil
+import typing
+import unittest.mock
+
+import pytest
+
+from pycargoebuild.cargo import Crate, FileCrate, GitCrate
+from pycargoebuild.store import CrateStore
+
+
+@pytest.fixture
+def crates(tmp_path):
+    distdir = tmp_path / "distdir"
+    distdir.mkdir()
+    ret: typing.List[Crate] = []
+    for name in ("foo", "bar"):
+        data = f"{name} crate".encode()
+        (distdir / f"{name}-1.crate").write_bytes(data)
+        ret.append(FileCrate(name, "1", hashlib.sha256(data).hexdigest()))
+    ret.append(GitCrate("baz", "1", "https://github.com/projg2/baz",
+                        "5ace474ad2e92da836de60afd9014cbae7bdd481"))
+    yield ret
+
+
+def test_crate_store(tmp_path, crates):
+    store = CrateStore(tmp_path / "store")
+    distdir = tmp_path / "distdir"
+    assert store.import_crates(crates, distdir=distdir) == set()
+    assert store.add_crates(crates, distdir=distdir) == 2
+    # second call is no-op
+    assert store.add_crates(crates, distdir=distdir) == 0
+
+    foo_path = store.get_path(crates[0].checksum)
+    assert foo_path == (tmp_path / "store/sha256" / crates[0].checksum[:2] /
+                        crates[0].checksum)
+    assert foo_path.read_bytes() == b"foo crate"
+
+    other_distdir = tmp_path / "other"
+    assert store.import_crates(crates, distdir=other_distdir) == {
+        other_distdir / "foo-1.crate",
+        other_distdir / "bar-1.crate",
+    }
+    assert (other_distdir / "bar-1.crate").read_bytes() == b"bar crate"
+
+
+def test_crate_store_hardlinked(tmp_path, crates):
+    store = CrateStore(tmp_path / "store")
+    distdir = tmp_path / "distdir"
+    # replace foo with a hardlink to stored file
+    store.add_crates(crates[:1], distdir=distdir)
+    foo_path = distdir / "foo-1.crate"
+    foo_path.unlink()
+    foo_path.hardlink_to(store.get_path(crates[0].checksum))
+
+    assert store.is_stored(foo_path, crates[0].checksum)
+    assert not store.is_stored(distdir / "bar-1.crate", crates[1].checksum)
+    assert store.import_crates(crates, distdir=distdir) == {foo_path}
+
+
+def test_crate_store_copied(tmp_path, crates):
+    store = CrateStore(tmp_path / "store")
+    distdir = tmp_path / "distdir"
+    other_distdir = tmp_path / "other"
+    # simulate filesystems where files get reflinked (or copied)
+    with unittest.mock.patch("pycargoebuild.store.link_or_copy",
+                             side_effect=shutil.copyfile):
+        assert store.add_crates(crates, distdir=distdir) == 2
+        assert store.import_crates(crates, distdir=other_distdir) == {
+            other_distdir / "foo-1.crate",
+            other_distdir / "bar-1.crate",
+        }
+
+    # the copies are known to match, so they need not be verified again
+    assert store.import_crates(crates, distdir=distdir) == {
+        distdir / "foo-1.crate",
+        distdir / "bar-1.crate",
+    }
+    # modified files are not trusted anymore
+    bar_path = other_distdir / "bar-1.crate"
+    st = bar_path.stat()
+    bar_path.write_bytes(b"bad")
+    os.utime(bar_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert store.import_crates(crates, distdir=other_distdir) == {
+        other_distdir / "foo-1.crate",
+    }